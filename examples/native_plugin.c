@@ -0,0 +1,67 @@
+/*
+------------------------------------------------------------------------------------------------------------------------
+native_plugin.c
+Copyright (C) 2019-20 - NFStream Developers
+This file is part of NFStream, a Flexible Network Data Analysis Framework (https://www.nfstream.org/).
+NFStream is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+version.
+NFStream is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+You should have received a copy of the GNU Lesser General Public License along with NFStream.
+If not, see <http://www.gnu.org/licenses/>.
+------------------------------------------------------------------------------------------------------------------------
+Native NFPlugin example: payload bytes histogram and entropy.
+Build: gcc -shared -fPIC -O2 -I<nfstream package directory> native_plugin.c -o native_plugin.so -lm
+Usage: NFStreamer(source="facebook.pcap", udps=NFNativePlugin("native_plugin.so"))
+*/
+
+#include <math.h>
+#include "nfplugin.h"
+
+// Per flow state: public members are exported as udps (payload_bytes, payload_entropy and max_burst_packets).
+NF_PLUGIN_STATE(payload_state,
+  uint64_t payload_bytes;
+  double payload_entropy;
+  uint64_t max_burst_packets;
+  uint64_t _burst_packets;
+  uint8_t _burst_direction;
+  uint64_t _histogram[256];
+);
+
+
+/**
+ * payload_update: Account packet payload bytes and bursts (same direction packets within 1 msec of each other).
+ */
+static void payload_update(void *data, const struct nf_packet *packet) {
+  struct payload_state *state = (struct payload_state *)data;
+  uint32_t offset = packet->ip_size - packet->payload_size; // IP and transport headers.
+  for (uint32_t i = offset; i < packet->ip_content_len; i++) state->_histogram[packet->ip_content[i]]++;
+  state->payload_bytes += packet->payload_size;
+  if (state->_burst_packets && (packet->direction == state->_burst_direction) && (packet->delta_time <= 1)) {
+    state->_burst_packets++;
+  } else { // New burst.
+    state->_burst_packets = 1;
+    state->_burst_direction = packet->direction;
+  }
+  if (state->_burst_packets > state->max_burst_packets) state->max_burst_packets = state->_burst_packets;
+}
+
+
+/**
+ * payload_expire: Compute payload entropy from bytes histogram.
+ */
+static void payload_expire(void *data) {
+  struct payload_state *state = (struct payload_state *)data;
+  uint64_t total = 0;
+  for (int i = 0; i < 256; i++) total += state->_histogram[i];
+  for (int i = 0; i < 256; i++) {
+    if (state->_histogram[i]) {
+      double p = (double)state->_histogram[i] / total;
+      state->payload_entropy -= p * log2(p);
+    }
+  }
+}
+
+
+NF_PLUGIN(payload_state, payload_update, payload_update, payload_expire);
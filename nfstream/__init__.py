@@ -18,7 +18,7 @@ If not, see <http://www.gnu.org/licenses/>.
 
 
 from .streamer import NFStreamer
-from .plugin import NFPlugin
+from .plugin import NFPlugin, NFNativePlugin
 
 
 # streamer module is the core module of nfstream package.
@@ -23,11 +23,19 @@ import cffi
 #   - headers and APIs for observation stage (packet capture and processing).
 #   - headers and APIs for nDPI (the dissection part).
 #   - headers and APIs for Metering stage (flow intialization, update, expiration and cleaning)
+#   - headers and APIs for native engine (flow table, lookup, update and expiration without interpreter per packet)
 # We group it in a "context" initialized by meter as start in order to share the same ffi instance between stages.
 
 cc_observer_headers = """
 struct pcap;
 typedef struct pcap pcap_t;
+struct nf_observer;
+typedef struct nf_observer nf_observer_t;
+typedef struct nf_mark {
+  uint64_t time;
+  uint64_t offset;
+  uint8_t header;
+} nf_mark_t;
 typedef struct nf_packet {
   uint8_t direction;
   uint64_t time;
@@ -36,7 +44,8 @@ typedef struct nf_packet {
   uint16_t dst_port;
   uint8_t protocol;
   uint16_t vlan_id;
-  char src_name[48], dst_name[48];
+  uint8_t src_addr[16], dst_addr[16];
+  uint8_t flow_key[40];
   uint8_t ip_version;
   uint16_t fin:1, syn:1, rst:1, psh:1, ack:1, urg:1, ece:1, cwr:1; /* TCP Flags */
   uint16_t raw_size;
@@ -45,6 +54,7 @@ typedef struct nf_packet {
   uint16_t payload_size;
   uint16_t ip_content_len;
   uint8_t *ip_content;
+  uint64_t hashval;
 } nf_packet_t;
 typedef struct nf_stat {
   unsigned received;
@@ -1095,6 +1105,8 @@ typedef struct nf_flow {
   uint8_t protocol;
   uint8_t ip_version;
   uint16_t vlan_id;
+  uint8_t src_addr[16];
+  uint8_t dst_addr[16];
   uint64_t bidirectional_first_seen_ms;
   uint64_t bidirectional_last_seen_ms;
   uint64_t bidirectional_duration_ms;
@@ -1175,20 +1187,77 @@ typedef struct nf_flow {
   ndpi_protocol detected_protocol;
   uint8_t guessed;
   uint8_t detection_completed;
+  int8_t expiration_id;
+  uint64_t plugins_state[];
 } nf_flow_t;
+
+typedef struct nf_plugin {
+  uint32_t abi_version;
+  const char *state;
+  uint32_t state_size;
+  void (*on_init)(void *state, const struct nf_packet *packet);
+  void (*on_update)(void *state, const struct nf_packet *packet);
+  void (*on_expire)(void *state);
+} nf_plugin_t;
+
+typedef struct nf_plugins {
+  uint32_t n_plugins;
+  struct nf_plugin **plugins;
+  uint32_t *offsets;
+  uint32_t state_size;
+} nf_plugins_t;
+
+struct nf_node;
+typedef struct nf_engine {
+  struct nf_node **buckets;
+  uint64_t n_buckets;
+  uint64_t n_flows;
+  struct nf_node *wheel[11][64];
+  uint64_t wheel_tick;
+  struct nf_flow **expired;
+  uint64_t expired_size;
+  uint64_t expired_head;
+  uint64_t expired_tail;
+  uint64_t idle_timeout;
+  uint64_t active_timeout;
+  uint8_t accounting_mode;
+  uint8_t statistics;
+  uint8_t splt;
+  uint8_t n_dissections;
+  struct ndpi_detection_module_struct *dissector;
+  struct nf_plugins *plugins;
+  uint64_t tick;
+  uint64_t scan_tick;
+  uint64_t processed_packets;
+  uint64_t ignored_packets;
+} nf_engine_t;
 """
 
 cc_observer_apis = """
-pcap_t * observer_open(const uint8_t * pcap_file, int mode, int root_idx);
-int observer_set_fanout(pcap_t * pcap_handle, int mode, int root_idx);
-int observer_set_timeout(pcap_t * pcap_handle, int mode, int root_idx);
-int observer_set_promisc(pcap_t * pcap_handle, int mode, int root_idx, int promisc);
-int observer_set_snaplen(pcap_t * pcap_handle, int mode, int root_idx, unsigned snaplen);
-int observer_set_filter(pcap_t * pcap_handle, char * bpf_filter, int root_idx);
-int observer_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tunnels, int n_roots, int root_idx, int mode);
-void observer_stats(pcap_t * pcap_handle, struct nf_stat *nf_statistics, unsigned mode);
-void observer_close(pcap_t * pcap_handle);
-int observer_activate(pcap_t * pcap_handle, int mode, int root_idx);
+struct nf_observer * observer_open(const uint8_t * pcap_file, int mode, int root_idx);
+struct nf_observer * observer_merge(struct nf_observer **observers, int n_observers);
+int observer_set_fanout(struct nf_observer *observer, int mode, int root_idx, int fanout_mode, int fanout_defrag,
+                        int fanout_group_id);
+int observer_set_timeout(struct nf_observer *observer, int mode, int root_idx, int timeout);
+int observer_set_buffer_size(struct nf_observer *observer, int mode, int root_idx, int buffer_size);
+int observer_set_immediate_mode(struct nf_observer *observer, int mode, int root_idx, int immediate);
+int observer_set_promisc(struct nf_observer *observer, int mode, int root_idx, int promisc);
+int observer_set_snaplen(struct nf_observer *observer, int mode, int root_idx, unsigned snaplen);
+int observer_set_filter(struct nf_observer *observer, char * bpf_filter, int root_idx);
+void observer_set_window(struct nf_observer *observer, uint64_t start_time, uint64_t end_time);
+int observer_seek(struct nf_observer *observer, int root_idx, uint64_t start_offset, uint64_t end_offset,
+                  uint64_t *headers, int n_headers);
+int observer_index(struct nf_observer *observer, struct nf_mark *marks, int n_marks, uint64_t interval);
+int observer_next(struct nf_observer *observer, struct nf_packet *nf_pkt, int decode_tunnels, int n_roots, int root_idx,
+                  int mode, int hash_mode);
+int observer_next_batch(struct nf_observer *observer, struct nf_packet *nf_pkts, int *nf_rets, uint8_t *buffers,
+                        unsigned buffer_size, int batch_size, int decode_tunnels, int n_roots, int root_idx,
+                        int mode, int hash_mode);
+unsigned observer_snapshot(struct nf_observer *observer);
+void observer_rebase(struct nf_packet *nf_pkts, int n_pkts, uint8_t *content);
+void observer_stats(struct nf_observer *observer, struct nf_stat *nf_statistics, unsigned mode);
+void observer_close(struct nf_observer *observer);
+int observer_activate(struct nf_observer *observer, int mode, int root_idx);
 """
 
 cc_dissector_apis = """
@@ -1200,15 +1269,32 @@ void dissector_cleanup(struct ndpi_detection_module_struct *dissector);
 cc_meter_apis = """
 struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounting_mode, uint8_t statistics, 
                                       uint8_t splt, uint8_t n_dissections, 
-                                      struct ndpi_detection_module_struct *dissector);
+                                      struct ndpi_detection_module_struct *dissector, struct nf_plugins *plugins);
 uint8_t meter_update_flow(struct nf_flow *flow, struct nf_packet *packet, uint64_t idle_timeout, 
                           uint64_t active_timeout, uint8_t accounting_mode, uint8_t statistics, uint8_t splt,
-                          uint8_t n_dissections, struct ndpi_detection_module_struct *dissector);
-void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_detection_module_struct *dissector);
+                          uint8_t n_dissections, struct ndpi_detection_module_struct *dissector,
+                          struct nf_plugins *plugins);
+void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_detection_module_struct *dissector,
+                       struct nf_plugins *plugins);
 void meter_free_flow(struct nf_flow *flow, uint8_t n_dissections, uint8_t splt);
 void free_splt_data(struct nf_flow *flow);
 """
 
+cc_engine_apis = """
+struct nf_engine *engine_init(uint64_t idle_timeout, uint64_t active_timeout, uint8_t accounting_mode,
+                              uint8_t statistics, uint8_t splt, uint8_t n_dissections,
+                              struct ndpi_detection_module_struct *dissector, struct nf_plugins *plugins);
+uint64_t engine_process_batch(struct nf_engine *engine, struct nf_packet *nf_pkts, int *nf_rets, int n_pkts);
+uint64_t engine_cleanup(struct nf_engine *engine);
+uint64_t engine_expired(struct nf_engine *engine, struct nf_flow **flows, uint64_t max_flows);
+void engine_free(struct nf_engine *engine);
+"""
+
+# Native plugins libraries export their descriptor (see nfplugin.h).
+cc_plugin_apis = """
+extern struct nf_plugin nf_plugin;
+"""
+
 
 def create_context():
     """ context creation function, return the loaded native nfstream context and it's ffi interface"""
@@ -1221,4 +1307,6 @@ def create_context():
     ffi.cdef(cc_observer_apis, override=True)
     ffi.cdef(cc_dissector_apis, override=True)
     ffi.cdef(cc_meter_apis, override=True)
+    ffi.cdef(cc_engine_apis, override=True)
+    ffi.cdef(cc_plugin_apis, override=True)
     return ffi, lib
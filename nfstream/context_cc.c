@@ -21,9 +21,13 @@ If not, see <http://www.gnu.org/licenses/>.
 #include <stdint.h>
 #include <string.h>
 #include <sys/time.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
 #include <ndpi_api.h>
 #include <ndpi_main.h>
 #include <ndpi_typedefs.h>
+#include "nfplugin.h"
 #if defined(__FreeBSD__) || defined(__NetBSD__) || defined(__OpenBSD__)
 #include <machine/endian.h>
 #endif
@@ -324,25 +328,7 @@ struct nfstream_vxlanhdr {
 } PACK_OFF;
 
 
-// Main structure for packet information.
-typedef struct nf_packet {
-  uint8_t direction;
-  uint64_t time;
-  uint64_t delta_time;
-  uint16_t src_port;
-  uint16_t dst_port;
-  uint8_t protocol;
-  uint16_t vlan_id;
-  char src_name[48], dst_name[48];
-  uint8_t ip_version;
-  uint16_t fin:1, syn:1, rst:1, psh:1, ack:1, urg:1, ece:1, cwr:1; /* TCP Flags */
-  uint16_t raw_size;
-  uint16_t ip_size;
-  uint16_t transport_size;
-  uint16_t payload_size;
-  uint16_t ip_content_len;
-  uint8_t *ip_content;
-} nf_packet_t;
+// Main structure for packet information (nf_packet) is shared with native plugins (see nfplugin.h).
 
 
 typedef struct nf_stat {
@@ -392,6 +378,81 @@ int nfstream_handle_ipv6_extension_headers(const uint8_t **l4ptr, uint16_t *l4le
 }
 
 
+/**
+ * set_nf_packet_key: Pack canonical symmetric flow key: lower (address, port) endpoint first, then higher one,
+ *                    vlan_id, protocol and ip_version. Both directions of a flow produce the same 40 bytes.
+ */
+static void set_nf_packet_key(struct nf_packet *nf_pkt) {
+  uint8_t *key = nf_pkt->flow_key;
+  int order = memcmp(nf_pkt->src_addr, nf_pkt->dst_addr, 16);
+  if ((order < 0) || ((order == 0) && (nf_pkt->src_port <= nf_pkt->dst_port))) {
+    memcpy(key, nf_pkt->src_addr, 16);
+    memcpy(key + 16, nf_pkt->dst_addr, 16);
+    memcpy(key + 32, &nf_pkt->src_port, 2);
+    memcpy(key + 34, &nf_pkt->dst_port, 2);
+  } else {
+    memcpy(key, nf_pkt->dst_addr, 16);
+    memcpy(key + 16, nf_pkt->src_addr, 16);
+    memcpy(key + 32, &nf_pkt->dst_port, 2);
+    memcpy(key + 34, &nf_pkt->src_port, 2);
+  }
+  memcpy(key + 36, &nf_pkt->vlan_id, 2);
+  key[38] = nf_pkt->protocol;
+  key[39] = nf_pkt->ip_version;
+}
+
+
+/**
+ * nf_hash_mix: 64 bits murmur3 finalizer.
+ */
+static inline uint64_t nf_hash_mix(uint64_t hashval) {
+  hashval ^= hashval >> 33;
+  hashval *= 0xff51afd7ed558ccdULL;
+  hashval ^= hashval >> 33;
+  hashval *= 0xc4ceb9fe1a85ec53ULL;
+  hashval ^= hashval >> 33;
+  return hashval;
+}
+
+
+/**
+ * nf_hash_key: Mixed hash over the full canonical flow key, symmetric as the key is.
+ */
+static uint64_t nf_hash_key(const uint8_t *key) {
+  uint64_t hashval = 0x9e3779b97f4a7c15ULL;
+  for (int i = 0; i < 40; i += 8) {
+    uint64_t word;
+    memcpy(&word, key + i, 8);
+    hashval = nf_hash_mix(hashval ^ word);
+  }
+  return hashval;
+}
+
+
+/**
+ * nf_hash_toeplitz: Toeplitz hash with symmetric RSS key (0x6d5a repeated) over addresses and ports.
+ *                   As the key is periodic on 16 bits, hash only depends on the 16 bits xor fold of the input,
+ *                   which is what makes it symmetric.
+ */
+static uint64_t nf_hash_toeplitz(struct nf_packet *nf_pkt) {
+  int addr_len = (nf_pkt->ip_version == IPVERSION) ? 4 : 16;
+  uint16_t fold = htons(nf_pkt->src_port) ^ htons(nf_pkt->dst_port);
+  for (int i = 0; i < addr_len; i += 2) {
+    uint16_t src_word, dst_word;
+    memcpy(&src_word, nf_pkt->src_addr + i, 2);
+    memcpy(&dst_word, nf_pkt->dst_addr + i, 2);
+    fold ^= src_word ^ dst_word;
+  }
+  fold = ntohs(fold);
+  uint32_t window = 0x6d5a6d5a, hashval = 0;
+  for (int bit = 15; bit >= 0; bit--) {
+    if (fold & (1 << bit)) hashval ^= window;
+    window = (window << 1) | (window >> 31);
+  }
+  return hashval;
+}
+
+
 /**
  * get_nf_packet_info: nf_packet structure filler.
  */
@@ -412,7 +473,8 @@ int get_nf_packet_info(const uint8_t version,
                        struct timeval when, struct nf_packet *nf_pkt,
                        int n_roots,
                        int root_idx,
-                       int mode) {
+                       int mode,
+                       int hash_mode) {
   uint32_t l4_offset;
   const uint8_t *l3, *l4;
   uint32_t l4_data_len = 0XFEEDFACE;
@@ -488,21 +550,32 @@ int get_nf_packet_info(const uint8_t version,
   nf_pkt->payload_size = *payload_len;
   nf_pkt->ip_content_len = ipsize;
   nf_pkt->delta_time = 0; // This will be filled by meter.
-  uint64_t hashval = 0; // Compute hashval as the sum of 6-tuple fields.
-
-  hashval = nf_pkt->protocol + nf_pkt->vlan_id + iph->saddr + iph->daddr + nf_pkt->src_port + nf_pkt->dst_port;
+  uint64_t hashval = 0;
+  // Raw addresses are compared on their full length, we clear them as packet structures can be reused.
+  // Text formatting is done by meter only once per flow.
+  memset(nf_pkt->src_addr, 0, sizeof(nf_pkt->src_addr));
+  memset(nf_pkt->dst_addr, 0, sizeof(nf_pkt->dst_addr));
 
   if(version == IPVERSION) {
-	inet_ntop(AF_INET, &iph->saddr, nf_pkt->src_name, sizeof(nf_pkt->src_name));
-	inet_ntop(AF_INET, &iph->daddr, nf_pkt->dst_name, sizeof(nf_pkt->dst_name));
+	memcpy(nf_pkt->src_addr, &iph->saddr, 4);
+	memcpy(nf_pkt->dst_addr, &iph->daddr, 4);
 	nf_pkt->ip_size= ntohs(iph->tot_len);
 	nf_pkt->ip_content = (uint8_t *)iph;
   } else {
-	inet_ntop(AF_INET6, &iph6->ip6_src, nf_pkt->src_name, sizeof(nf_pkt->src_name));
-	inet_ntop(AF_INET6, &iph6->ip6_dst, nf_pkt->dst_name, sizeof(nf_pkt->dst_name));
+	memcpy(nf_pkt->src_addr, &iph6->ip6_src, 16);
+	memcpy(nf_pkt->dst_addr, &iph6->ip6_dst, 16);
 	nf_pkt->ip_size = ntohs(iph->tot_len);
 	nf_pkt->ip_content = (uint8_t *)iph6;
   }
+  set_nf_packet_key(nf_pkt);
+  if (hash_mode == 1) { // Symmetric Toeplitz on (src, dst, sport, dport) as computed by RSS capable NICs.
+    hashval = nf_hash_toeplitz(nf_pkt);
+  } else if (hash_mode == 2) { // Legacy: sum of 6-tuple fields.
+    hashval = nf_pkt->protocol + nf_pkt->vlan_id + iph->saddr + iph->daddr + nf_pkt->src_port + nf_pkt->dst_port;
+  } else { // Default: mixed hash over canonical flow key.
+    hashval = nf_hash_key(nf_pkt->flow_key);
+  }
+  nf_pkt->hashval = hashval; // Exposed for single pass reader dispatching.
   if (mode == 0) { // Offline, we perform fanout like strategy
     if ((hashval % n_roots) == root_idx) { // If packet match meter idx, he will consume it and process it.
       return 1;
@@ -537,7 +610,8 @@ static int get_nf_packet_info6(uint16_t vlan_id,
                                uint8_t *proto,
                                uint8_t **payload,
                                uint16_t *payload_len,
-                               struct timeval when, struct nf_packet *nf_pkt, int n_roots, int root_idx, int mode) {
+                               struct timeval when, struct nf_packet *nf_pkt, int n_roots, int root_idx, int mode,
+                               int hash_mode) {
   // We move field to iph to treat it by the same function for IPV4
   struct nfstream_iphdr iph;
   memset(&iph, 0, sizeof(iph));
@@ -556,7 +630,7 @@ static int get_nf_packet_info6(uint16_t vlan_id,
 			    &iph, iph6, ip_offset, ipsize,
 			    ntohs(iph6->ip6_hdr.ip6_un1_plen),
 			    tcph, udph, sport, dport, proto, payload,
-			    payload_len, when, nf_pkt, n_roots, root_idx, mode));
+			    payload_len, when, nf_pkt, n_roots, root_idx, mode, hash_mode));
 }
 
 
@@ -577,7 +651,8 @@ int parse_packet(const uint64_t time,
                  struct nf_packet *nf_pkt,
                  int n_roots,
                  int root_idx,
-                 int mode) {
+                 int mode,
+                 int hash_mode) {
   uint8_t proto;
   struct nfstream_tcphdr *tcph = NULL;
   struct nfstream_udphdr *udph = NULL;
@@ -589,10 +664,10 @@ int parse_packet(const uint64_t time,
   // According to IPVERSION, we extract required information for metering layer.
   if(iph)
     return get_nf_packet_info(IPVERSION, vlan_id, tunnel_type, iph, NULL, ip_offset, ipsize, ntohs(iph->tot_len) - (iph->ihl * 4),
-			      &tcph, &udph, &sport, &dport, &proto, &payload, &payload_len, when, nf_pkt, n_roots, root_idx, mode);
+			      &tcph, &udph, &sport, &dport, &proto, &payload, &payload_len, when, nf_pkt, n_roots, root_idx, mode, hash_mode);
   else
     return get_nf_packet_info6(vlan_id, tunnel_type, iph6, ip_offset, ipsize, &tcph, &udph, &sport, &dport, &proto,
-                        &payload, &payload_len, when, nf_pkt, n_roots, root_idx, mode);
+                        &payload, &payload_len, when, nf_pkt, n_roots, root_idx, mode, hash_mode);
 }
 
 
@@ -600,7 +675,7 @@ int parse_packet(const uint64_t time,
  * process_packet: Main packet processing function.
  */
 int process_packet(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const uint8_t *packet, int decode_tunnels,
-                   struct nf_packet *nf_pkt, int n_roots, int root_idx, int mode) {
+                   struct nf_packet *nf_pkt, int n_roots, int root_idx, int mode, int hash_mode) {
   // Ethernet header
   const struct nfstream_ethhdr *ethernet;
   // LLC header
@@ -954,42 +1029,491 @@ int process_packet(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const
     }
   }
   return parse_packet(time, vlan_id, tunnel_type, iph, iph6, ip_offset, header->caplen - ip_offset, header->len,
-                      header, packet, header->ts, nf_pkt, n_roots, root_idx, mode);
+                      header, packet, header->ts, nf_pkt, n_roots, root_idx, mode, hash_mode);
+}
+
+
+#define NF_MAX_INTERFACES 256
+#define NF_MAX_SNAPLEN 262144
+#define NF_MAP_RELEASE 67108864 // Consumed mapped file is released by chunks, the last one is kept.
+#define PCAPNG_SECTION_HEADER 0x0A0D0D0A
+#define PCAPNG_INTERFACE_DESCRIPTION 1
+#define PCAPNG_PACKET 2
+#define PCAPNG_SIMPLE_PACKET 3
+#define PCAPNG_ENHANCED_PACKET 6
+#define PCAPNG_IF_TSRESOL 9
+#define LINKTYPE_RAW 101
+
+
+/**
+ * nf_observer: Observer handle, a libpcap handle, a memory mapped capture file or merged capture files.
+ */
+typedef struct nf_observer {
+  pcap_t * pcap_handle; // On mapped files, dead handle carrying link type and snapshot length.
+  uint8_t *map; // Mapped capture file, NULL when reading through libpcap.
+  uint64_t map_size;
+  uint64_t offset; // Next record offset within map.
+  uint64_t record_offset; // Last read record offset within map.
+  uint64_t end_offset; // Reading stops at this offset (0: end of file).
+  uint64_t released; // Mapped file prefix released from process memory.
+  uint64_t start_time; // Packets before start time are skipped (ms).
+  uint64_t end_time; // Reading stops at first packet reaching end time (ms, 0: none).
+  uint64_t index_tick;
+  uint8_t format; // 1: pcap, 2: pcapng
+  uint8_t swapped; // File byte order differs from host one.
+  uint8_t filtered;
+  int linktype;
+  uint32_t snaplen;
+  uint32_t n_interfaces;
+  uint64_t units[NF_MAX_INTERFACES]; // Timestamp units per second of each pcapng interface.
+  struct bpf_program fcode;
+  struct pcap_pkthdr hdr;
+  const uint8_t *data;
+  struct nf_observer *current; // Source of last read packet (observer itself when not merged).
+  struct nf_observer **sources; // Merged capture files, NULL when not merged.
+  struct nf_observer **heap; // Merged sources min heap on their head packet time.
+  int n_sources;
+  int n_heap; // -1 until merged sources heads are loaded.
+  int rank; // Rank within merged sources, breaks head packet time ties.
+  struct pcap_pkthdr *head_hdr;
+  const uint8_t *head_data;
+} nf_observer_t;
+
+
+/**
+ * observer_u16: Read 16 bits value in file byte order.
+ */
+static inline uint16_t observer_u16(struct nf_observer *observer, const uint8_t *p) {
+  uint16_t v;
+  memcpy(&v, p, sizeof(v));
+  return observer->swapped ? __builtin_bswap16(v) : v;
+}
+
+
+/**
+ * observer_u32: Read 32 bits value in file byte order.
+ */
+static inline uint32_t observer_u32(struct nf_observer *observer, const uint8_t *p) {
+  uint32_t v;
+  memcpy(&v, p, sizeof(v));
+  return observer->swapped ? __builtin_bswap32(v) : v;
+}
+
+
+/**
+ * observer_dlt: Map file link type to DLT value as libpcap does.
+ */
+static int observer_dlt(uint32_t linktype) {
+  linktype &= 0x03FFFFFF; // Strip FCS information bits.
+  if (linktype == LINKTYPE_RAW) return DLT_RAW;
+  return (int)linktype;
+}
+
+
+/**
+ * observer_pcapng_section: Set byte order from pcapng section header block.
+ */
+static int observer_pcapng_section(struct nf_observer *observer, const uint8_t *block) {
+  uint32_t magic;
+  if (observer->map_size - (uint64_t)(block - observer->map) < 12) return -1;
+  memcpy(&magic, block + 8, sizeof(magic));
+  if (magic == 0x1A2B3C4D) observer->swapped = 0;
+  else if (magic == 0x4D3C2B1A) observer->swapped = 1;
+  else return -1;
+  observer->n_interfaces = 0; // Interfaces are scoped to their section.
+  return 0;
+}
+
+
+/**
+ * observer_pcapng_interface: Register pcapng interface description block.
+ */
+static int observer_pcapng_interface(struct nf_observer *observer, const uint8_t *block, uint32_t block_len) {
+  if (block_len < 20) return -1;
+  if (observer_dlt(observer_u16(observer, block + 8)) != observer->linktype) {
+    printf("ERROR: Capture interfaces with different link types are not supported.\n");
+    return -1;
+  }
+  uint64_t units = 1000000; // Microseconds by default.
+  const uint8_t *option = block + 16;
+  const uint8_t *end = block + block_len - 4;
+  while (option + 4 <= end) {
+    uint16_t code = observer_u16(observer, option);
+    uint16_t len = observer_u16(observer, option + 2);
+    if (code == 0) break; // End of options
+    if ((code == PCAPNG_IF_TSRESOL) && (len >= 1) && (option + 5 <= end)) {
+      uint8_t resolution = option[4] & 0x7F;
+      if (option[4] & 0x80) { // Negative power of 2
+        if (resolution > 63) return -1;
+        units = (uint64_t)1 << resolution;
+      } else { // Negative power of 10
+        if (resolution > 19) return -1;
+        units = 1;
+        for (uint8_t i = 0; i < resolution; i++) units *= 10;
+      }
+    }
+    option += 4 + (((uint32_t)len + 3) & ~3U);
+  }
+  if (observer->n_interfaces < NF_MAX_INTERFACES) observer->units[observer->n_interfaces] = units;
+  observer->n_interfaces++;
+  return 0;
+}
+
+
+/**
+ * observer_pcapng_packet: Set header of packet captured on interface_id at timestamp (in interface units).
+ */
+static int observer_pcapng_packet(struct nf_observer *observer, uint32_t interface_id, uint64_t timestamp,
+                                  uint32_t caplen, uint32_t len, const uint8_t *data) {
+  if ((interface_id >= observer->n_interfaces) || (interface_id >= NF_MAX_INTERFACES)) return 0;
+  uint64_t units = observer->units[interface_id];
+  uint64_t fraction = timestamp % units;
+  observer->hdr.ts.tv_sec = (time_t)(timestamp / units);
+  if (units % 1000000 == 0) observer->hdr.ts.tv_usec = (suseconds_t)(fraction / (units / 1000000));
+  else observer->hdr.ts.tv_usec = (suseconds_t)((double)fraction * 1000000.0 / (double)units);
+  observer->hdr.caplen = caplen;
+  observer->hdr.len = len;
+  observer->data = data;
+  return 1;
+}
+
+
+/**
+ * observer_pcapng_block: Read next pcapng block (0: end of file, 1: packet, 2: section or interface, 3: other).
+ */
+static int observer_pcapng_block(struct nf_observer *observer) {
+  if (observer->offset + 12 > observer->map_size) return 0;
+  const uint8_t *block = observer->map + observer->offset;
+  uint32_t block_type = observer_u32(observer, block); // Section header type reads the same in both orders.
+  if ((block_type == PCAPNG_SECTION_HEADER) && (observer_pcapng_section(observer, block) != 0)) return 0;
+  uint32_t block_len = observer_u32(observer, block + 4);
+  if ((block_len < 12) || (block_len % 4) || (block_len > observer->map_size - observer->offset)) return 0;
+  observer->record_offset = observer->offset;
+  observer->offset += block_len;
+  if (block_type == PCAPNG_SECTION_HEADER) return 2;
+  if (block_type == PCAPNG_INTERFACE_DESCRIPTION) {
+    if (observer_pcapng_interface(observer, block, block_len) != 0) return 0;
+    return 2;
+  }
+  if ((block_type == PCAPNG_ENHANCED_PACKET) || (block_type == PCAPNG_PACKET)) {
+    if (block_len < 32) return 0;
+    uint32_t caplen = observer_u32(observer, block + 20);
+    if (caplen > block_len - 32) return 0;
+    uint32_t interface_id = (block_type == PCAPNG_PACKET) ? observer_u16(observer, block + 8) :
+                                                            observer_u32(observer, block + 8);
+    uint64_t timestamp = ((uint64_t)observer_u32(observer, block + 12) << 32) | observer_u32(observer, block + 16);
+    return observer_pcapng_packet(observer, interface_id, timestamp, caplen, observer_u32(observer, block + 24),
+                                  block + 28) ? 1 : 3;
+  }
+  if ((block_type == PCAPNG_SIMPLE_PACKET) && (block_len >= 16) && (observer->n_interfaces > 0)) {
+    // Simple packets have no timestamp: previous packet one is kept.
+    uint32_t len = observer_u32(observer, block + 8);
+    uint32_t caplen = nfstream_min(len, block_len - 16);
+    if (observer->snaplen) caplen = nfstream_min(caplen, observer->snaplen);
+    observer->hdr.caplen = caplen;
+    observer->hdr.len = len;
+    observer->data = block + 12;
+    return 1;
+  }
+  return 3;
+}
+
+
+/**
+ * observer_pcap_next: Move to next pcap record, 0 on end of file.
+ */
+static int observer_pcap_next(struct nf_observer *observer) {
+  if (observer->offset + 16 > observer->map_size) return 0;
+  const uint8_t *record = observer->map + observer->offset;
+  uint32_t caplen = observer_u32(observer, record + 8);
+  if (caplen > observer->map_size - observer->offset - 16) return 0; // Truncated record
+  uint32_t fraction = observer_u32(observer, record + 4);
+  observer->hdr.ts.tv_sec = (time_t)observer_u32(observer, record);
+  observer->hdr.ts.tv_usec = (suseconds_t)((observer->units[0] == 1000000) ? fraction : fraction / 1000);
+  observer->hdr.caplen = caplen;
+  observer->hdr.len = observer_u32(observer, record + 12);
+  observer->data = record + 16;
+  observer->record_offset = observer->offset;
+  observer->offset += 16 + (uint64_t)caplen;
+  return 1;
+}
+
+
+/**
+ * observer_map_header: Parse mapped file header, set link type and snapshot length (-1 when unsupported).
+ */
+static int observer_map_header(struct nf_observer *observer) {
+  uint32_t magic;
+  memcpy(&magic, observer->map, sizeof(magic));
+  if ((magic == 0xa1b2c3d4) || (magic == 0xa1b23c4d)) observer->swapped = 0;
+  else if ((magic == 0xd4c3b2a1) || (magic == 0x4d3cb2a1)) observer->swapped = 1;
+  else if (magic == PCAPNG_SECTION_HEADER) {
+    // Link type and snapshot length are taken from first interface, blocks are then read from section start.
+    if (observer_pcapng_section(observer, observer->map) != 0) return -1;
+    uint64_t offset = 0;
+    while (offset + 12 <= observer->map_size) {
+      const uint8_t *block = observer->map + offset;
+      uint32_t block_type = observer_u32(observer, block);
+      uint32_t block_len = observer_u32(observer, block + 4);
+      if ((block_len < 12) || (block_len % 4) || (block_len > observer->map_size - offset)) return -1;
+      if (block_type == PCAPNG_INTERFACE_DESCRIPTION) {
+        if (block_len < 20) return -1;
+        observer->format = 2;
+        observer->linktype = observer_dlt(observer_u16(observer, block + 8));
+        observer->snaplen = observer_u32(observer, block + 12);
+        return 0;
+      }
+      if ((block_type != PCAPNG_SECTION_HEADER) || (offset == 0)) offset += block_len;
+      else return -1;
+    }
+    return -1;
+  } else return -1; // Unsupported format is left to libpcap.
+  observer->format = 1;
+  observer->units[0] = ((magic == 0xa1b23c4d) || (magic == 0x4d3cb2a1)) ? 1000000000 : 1000000;
+  observer->snaplen = observer_u32(observer, observer->map + 16);
+  observer->linktype = observer_dlt(observer_u32(observer, observer->map + 20));
+  observer->offset = 24;
+  return 0;
+}
+
+
+/**
+ * observer_map: Map offline capture file, NULL when it is not a regular pcap or pcapng file.
+ */
+static struct nf_observer * observer_map(const char * pcap_file) {
+  int fd = open(pcap_file, O_RDONLY);
+  if (fd < 0) return NULL;
+  struct stat file_stat;
+  if ((fstat(fd, &file_stat) != 0) || (!S_ISREG(file_stat.st_mode)) || (file_stat.st_size < 24)) {
+    close(fd);
+    return NULL;
+  }
+  uint8_t *map = mmap(NULL, (size_t)file_stat.st_size, PROT_READ, MAP_PRIVATE, fd, 0);
+  close(fd); // Mapping remains valid once descriptor is closed.
+  if (map == MAP_FAILED) return NULL;
+  madvise(map, (size_t)file_stat.st_size, MADV_SEQUENTIAL); // Aggressive read-ahead.
+  struct nf_observer *observer = (struct nf_observer *)calloc(1, sizeof(struct nf_observer));
+  if (observer != NULL) {
+    observer->map = map;
+    observer->map_size = (uint64_t)file_stat.st_size;
+    observer->current = observer;
+    if (observer_map_header(observer) == 0) {
+      // Unlimited snapshot length would make compiled filters reject every packet.
+      if ((observer->snaplen == 0) || (observer->snaplen > NF_MAX_SNAPLEN)) observer->snaplen = NF_MAX_SNAPLEN;
+      observer->pcap_handle = pcap_open_dead(observer->linktype, (int)observer->snaplen);
+      if (observer->pcap_handle != NULL) return observer;
+    }
+    free(observer);
+  }
+  munmap(map, (size_t)file_stat.st_size);
+  return NULL;
+}
+
+
+/**
+ * observer_release: Release consumed mapped file chunks, keeping the last one for packets still in use.
+ */
+static void observer_release(struct nf_observer *observer) {
+  if (observer->offset < observer->released + 2 * (uint64_t)NF_MAP_RELEASE) return;
+  uint64_t end = (observer->offset / NF_MAP_RELEASE - 1) * NF_MAP_RELEASE;
+  // Read only private mapping: released pages are read again from file if ever accessed.
+  madvise(observer->map + observer->released, (size_t)(end - observer->released), MADV_DONTNEED);
+  observer->released = end;
+}
+
+
+/**
+ * observer_step: Read next mapped file record (0: end of file, 1: packet, 2: section or interface, 3: other).
+ */
+static int observer_step(struct nf_observer *observer) {
+  if ((observer->end_offset != 0) && (observer->offset >= observer->end_offset)) return 0; // End of range
+  observer_release(observer);
+  if (observer->format == 1) return observer_pcap_next(observer);
+  return observer_pcapng_block(observer);
+}
+
+
+/**
+ * observer_source_read: Read next packet from a single source (pcap_next_ex semantics).
+ */
+static int observer_source_read(struct nf_observer *observer, struct pcap_pkthdr **hdr, const uint8_t **data) {
+  int rv_handle;
+  while (1) {
+    if (observer->map == NULL) {
+      rv_handle = pcap_next_ex(observer->pcap_handle, hdr, data);
+      if (rv_handle != 1) return rv_handle;
+    } else { // Packets are read in place: data points into the mapped file.
+      rv_handle = observer_step(observer);
+      if (rv_handle == 0) return -2; // End of file
+      if (rv_handle != 1) continue;
+      if (observer->filtered && (pcap_offline_filter(&observer->fcode, &observer->hdr, observer->data) == 0)) continue;
+      *hdr = &observer->hdr;
+      *data = observer->data;
+    }
+    if (observer->start_time || observer->end_time) { // Time window
+      uint64_t time = ((uint64_t) (*hdr)->ts.tv_sec) * TICK_RESOLUTION +
+                      (*hdr)->ts.tv_usec / (1000000 / TICK_RESOLUTION);
+      if (time < observer->start_time) continue;
+      if (observer->end_time && (time >= observer->end_time)) return -2;
+    }
+    return 1;
+  }
+}
+
+
+/**
+ * observer_earlier: Check if merged source a head packet comes before source b one.
+ */
+static inline int observer_earlier(struct nf_observer *a, struct nf_observer *b) {
+  if (a->head_hdr->ts.tv_sec != b->head_hdr->ts.tv_sec) return a->head_hdr->ts.tv_sec < b->head_hdr->ts.tv_sec;
+  if (a->head_hdr->ts.tv_usec != b->head_hdr->ts.tv_usec) return a->head_hdr->ts.tv_usec < b->head_hdr->ts.tv_usec;
+  return a->rank < b->rank;
+}
+
+
+/**
+ * observer_sift: Restore merged sources heap order below idx.
+ */
+static void observer_sift(struct nf_observer *observer, int idx) {
+  struct nf_observer **heap = observer->heap;
+  while (1) {
+    int earliest = idx, left = 2 * idx + 1, right = 2 * idx + 2;
+    if ((left < observer->n_heap) && observer_earlier(heap[left], heap[earliest])) earliest = left;
+    if ((right < observer->n_heap) && observer_earlier(heap[right], heap[earliest])) earliest = right;
+    if (earliest == idx) return;
+    struct nf_observer *tmp = heap[idx];
+    heap[idx] = heap[earliest];
+    heap[earliest] = tmp;
+    idx = earliest;
+  }
+}
+
+
+/**
+ * observer_merge_read: Read next packet of merged sources, the earliest of their heads (k-way merge).
+ */
+static int observer_merge_read(struct nf_observer *observer, struct pcap_pkthdr **hdr, const uint8_t **data) {
+  if (observer->n_heap < 0) { // First read: each source head is loaded.
+    observer->n_heap = 0;
+    for (int i = 0; i < observer->n_sources; i++) {
+      struct nf_observer *source = observer->sources[i];
+      if (observer_source_read(source, &source->head_hdr, &source->head_data) == 1) {
+        observer->heap[observer->n_heap++] = source;
+      }
+    }
+    for (int i = observer->n_heap / 2 - 1; i >= 0; i--) observer_sift(observer, i);
+  } else if (observer->n_heap > 0) { // Top head was returned by previous read: replaced by its source next one.
+    struct nf_observer *top = observer->heap[0];
+    if (observer_source_read(top, &top->head_hdr, &top->head_data) != 1) {
+      observer->heap[0] = observer->heap[--observer->n_heap]; // Source exhausted.
+    }
+    observer_sift(observer, 0);
+  }
+  if (observer->n_heap == 0) return -2; // End of all sources
+  observer->current = observer->heap[0];
+  *hdr = observer->current->head_hdr;
+  *data = observer->current->head_data;
+  return 1;
+}
+
+
+/**
+ * observer_read: Read next packet from observer (pcap_next_ex semantics).
+ */
+static int observer_read(struct nf_observer *observer, struct pcap_pkthdr **hdr, const uint8_t **data) {
+  if (observer->sources != NULL) return observer_merge_read(observer, hdr, data);
+  return observer_source_read(observer, hdr, data);
+}
+
+
+/**
+ * observer_close: Close observer handle.
+ */
+void observer_close(struct nf_observer *observer) {
+  if (observer->sources != NULL) {
+    for (int i = 0; i < observer->n_sources; i++) observer_close(observer->sources[i]);
+    free(observer->sources);
+    free(observer);
+    return;
+  }
+  if (observer->map != NULL) {
+    if (observer->filtered) pcap_freecode(&observer->fcode);
+    munmap(observer->map, (size_t)observer->map_size);
+  } else {
+    pcap_breakloop(observer->pcap_handle);
+  }
+  pcap_close(observer->pcap_handle);
+  free(observer);
 }
 
 
 /**
  * observer_open: Open a pcap file or a specified device.
  */
-pcap_t * observer_open(const uint8_t * pcap_file, int mode, int root_idx) {
+struct nf_observer * observer_open(const uint8_t * pcap_file, int mode, int root_idx) {
+  struct nf_observer *observer = NULL;
   pcap_t * pcap_handle = NULL;
   char pcap_error_buffer[PCAP_ERRBUF_SIZE];
   if (mode == 0) {
-    pcap_handle = pcap_open_offline((char*)pcap_file, pcap_error_buffer);
+    observer = observer_map((char*)pcap_file);
+    if (observer != NULL) return observer;
+    pcap_handle = pcap_open_offline((char*)pcap_file, pcap_error_buffer); // Not mappable: read through libpcap.
   }
   if (mode == 1) {
     pcap_handle = pcap_create((char*)pcap_file, pcap_error_buffer);
   }
   if (pcap_handle != NULL) {
-    return pcap_handle;
-  } else {
-    if (root_idx == 0) printf("ERROR: Unable to open source %s: %s\n", pcap_file, pcap_error_buffer);
-    return NULL;
+    observer = (struct nf_observer *)calloc(1, sizeof(struct nf_observer));
+    if (observer != NULL) {
+      observer->pcap_handle = pcap_handle;
+      observer->current = observer;
+      return observer;
+    }
+    pcap_close(pcap_handle);
+    snprintf(pcap_error_buffer, PCAP_ERRBUF_SIZE, "unable to allocate observer");
   }
+  if (root_idx == 0) printf("ERROR: Unable to open source %s: %s\n", pcap_file, pcap_error_buffer);
+  return NULL;
 }
 
 
 /**
- * observer_set_fanout: set fanout mode.
+ * observer_merge: Merge offline observers into a single one reading their packets in time order.
+ */
+struct nf_observer * observer_merge(struct nf_observer **observers, int n_observers) {
+  struct nf_observer *observer = (struct nf_observer *)calloc(1, sizeof(struct nf_observer));
+  if (observer != NULL) {
+    observer->sources = (struct nf_observer **)calloc(2 * (size_t)n_observers, sizeof(struct nf_observer *));
+    if (observer->sources != NULL) {
+      memcpy(observer->sources, observers, (size_t)n_observers * sizeof(struct nf_observer *));
+      observer->heap = observer->sources + n_observers; // Both arrays share a single allocation.
+      observer->n_sources = n_observers;
+      observer->n_heap = -1;
+      observer->current = observers[0];
+      for (int i = 0; i < n_observers; i++) observers[i]->rank = i;
+      return observer;
+    }
+    free(observer);
+  }
+  printf("ERROR: Unable to allocate observer.\n");
+  for (int i = 0; i < n_observers; i++) observer_close(observers[i]);
+  return NULL;
+}
+
+/**
+ * observer_set_fanout: set fanout mode (PACKET_FANOUT_* type), defragmentation flag and group id.
  */
-int observer_set_fanout(pcap_t * pcap_handle, int mode, int root_idx) {
+int observer_set_fanout(struct nf_observer *observer, int mode, int root_idx, int fanout_mode, int fanout_defrag,
+                        int fanout_group_id) {
   int set_fanout = 0;
   if (mode == 0) return set_fanout;
   else {
 #ifdef __linux__
-    set_fanout = pcap_set_fanout_linux(pcap_handle, 1, 0x8000, 0);
+    uint16_t fanout_type = (uint16_t)fanout_mode;
+    if (fanout_defrag) fanout_type |= 0x8000; // PACKET_FANOUT_FLAG_DEFRAG
+    set_fanout = pcap_set_fanout_linux(observer->pcap_handle, 1, fanout_type, (uint16_t)fanout_group_id);
     if (set_fanout != 0) {
-      pcap_close(pcap_handle);
+      observer_close(observer);
       if (root_idx == 0) printf("ERROR: Unable to setup fanout mode.\n");
     }
 #endif
@@ -1001,13 +1525,13 @@ int observer_set_fanout(pcap_t * pcap_handle, int mode, int root_idx) {
 /**
  * observer_activate: activate observer.
  */
-int observer_activate(pcap_t * pcap_handle, int mode, int root_idx) {
+int observer_activate(struct nf_observer *observer, int mode, int root_idx) {
   int set_activate = 0;
   if (mode == 0) return set_activate;
   else {
-    set_activate = pcap_activate(pcap_handle);
+    set_activate = pcap_activate(observer->pcap_handle);
     if (set_activate != 0) {
-      pcap_close(pcap_handle);
+      observer_close(observer);
       if (root_idx == 0) printf("ERROR: Unable to activate source.\n");
     }
   return set_activate;
@@ -1016,15 +1540,15 @@ int observer_activate(pcap_t * pcap_handle, int mode, int root_idx) {
 
 
 /**
- * observer_set_timeout: set buffer timeout.
+ * observer_set_timeout: set buffer timeout (msecs).
  */
-int observer_set_timeout(pcap_t * pcap_handle, int mode, int root_idx) {
+int observer_set_timeout(struct nf_observer *observer, int mode, int root_idx, int timeout) {
   int set_timeout = 0;
   if (mode == 0) return set_timeout;
   else {
-    set_timeout = pcap_set_timeout(pcap_handle, 1000);
+    set_timeout = pcap_set_timeout(observer->pcap_handle, timeout);
     if (set_timeout != 0) {
-      pcap_close(pcap_handle);
+      observer_close(observer);
       if (root_idx == 0) printf("ERROR: Unable to set buffer timeout.\n");
     }
   return set_timeout;
@@ -1032,16 +1556,50 @@ int observer_set_timeout(pcap_t * pcap_handle, int mode, int root_idx) {
 }
 
 
+/**
+ * observer_set_buffer_size: set kernel buffer size (bytes), 0 keeps libpcap default.
+ */
+int observer_set_buffer_size(struct nf_observer *observer, int mode, int root_idx, int buffer_size) {
+  int set_buffer_size = 0;
+  if ((mode == 0) || (buffer_size == 0)) return set_buffer_size;
+  else {
+    set_buffer_size = pcap_set_buffer_size(observer->pcap_handle, buffer_size);
+    if (set_buffer_size != 0) {
+      observer_close(observer);
+      if (root_idx == 0) printf("ERROR: Unable to set buffer size.\n");
+    }
+  return set_buffer_size;
+  }
+}
+
+
+/**
+ * observer_set_immediate_mode: set immediate mode (packets delivered as soon as they arrive).
+ */
+int observer_set_immediate_mode(struct nf_observer *observer, int mode, int root_idx, int immediate) {
+  int set_immediate = 0;
+  if ((mode == 0) || (immediate == 0)) return set_immediate;
+  else {
+    set_immediate = pcap_set_immediate_mode(observer->pcap_handle, immediate);
+    if (set_immediate != 0) {
+      observer_close(observer);
+      if (root_idx == 0) printf("ERROR: Unable to set immediate mode.\n");
+    }
+  return set_immediate;
+  }
+}
+
+
 /**
  * observer_set_promisc: set promisc mode.
  */
-int observer_set_promisc(pcap_t * pcap_handle, int mode, int root_idx, int promisc) {
+int observer_set_promisc(struct nf_observer *observer, int mode, int root_idx, int promisc) {
   int set_promisc = 0;
   if (mode == 0) return set_promisc;
   else {
-    set_promisc = pcap_set_promisc(pcap_handle, promisc);
+    set_promisc = pcap_set_promisc(observer->pcap_handle, promisc);
     if (set_promisc != 0) {
-      pcap_close(pcap_handle);
+      observer_close(observer);
       if (root_idx == 0) printf("ERROR: Unable to set promisc mode.\n");
     }
   return set_promisc;
@@ -1052,13 +1610,13 @@ int observer_set_promisc(pcap_t * pcap_handle, int mode, int root_idx, int promi
 /**
  * observer_set_snaplen: set snaplen.
  */
-int observer_set_snaplen(pcap_t * pcap_handle, int mode, int root_idx, unsigned snaplen) {
+int observer_set_snaplen(struct nf_observer *observer, int mode, int root_idx, unsigned snaplen) {
   int set_snaplen = 0;
   if (mode == 0) return set_snaplen;
   else {
-    set_snaplen = pcap_set_snaplen(pcap_handle, snaplen);
+    set_snaplen = pcap_set_snaplen(observer->pcap_handle, snaplen);
     if (set_snaplen != 0) {
-      pcap_close(pcap_handle);
+      observer_close(observer);
       if (root_idx == 0) printf("ERROR: Unable to set snaplen.\n");
     }
   return set_snaplen;
@@ -1069,17 +1627,21 @@ int observer_set_snaplen(pcap_t * pcap_handle, int mode, int root_idx, unsigned
 /**
  * observer_set_filter: Configure pcap_t with specified bpf_filter.
  */
-int observer_set_filter(pcap_t * pcap_handle, char * bpf_filter, int root_idx) {
+int observer_set_filter(struct nf_observer *observer, char * bpf_filter, int root_idx) {
   if(bpf_filter != NULL) {
     struct bpf_program fcode;
-    if(pcap_compile(pcap_handle, &fcode, bpf_filter, 1, 0xFFFFFF00) < 0) {
+    if(pcap_compile(observer->pcap_handle, &fcode, bpf_filter, 1, 0xFFFFFF00) < 0) {
       if (root_idx == 0) printf("ERROR: Unable to compile BPF filter.\n");
-      pcap_close(pcap_handle);
+      observer_close(observer);
       return 1;
+    } else if (observer->map != NULL) { // Mapped file: filter is applied on read.
+      observer->fcode = fcode;
+      observer->filtered = 1;
+      return 0;
     } else {
-      if(pcap_setfilter(pcap_handle, &fcode) < 0) {
+      if(pcap_setfilter(observer->pcap_handle, &fcode) < 0) {
 	    if (root_idx == 0) printf("ERROR: Unable to compile BPF filter.\n");
-	    pcap_close(pcap_handle);
+	    observer_close(observer);
 	    return 1;
       } else {
 	    return 0;
@@ -1090,15 +1652,94 @@ int observer_set_filter(pcap_t * pcap_handle, char * bpf_filter, int root_idx) {
   }
 }
 
+/**
+ * observer_set_window: Restrict offline reading to packets within [start_time, end_time[ (ms, 0 for unbounded).
+ */
+void observer_set_window(struct nf_observer *observer, uint64_t start_time, uint64_t end_time) {
+  observer->start_time = start_time;
+  observer->end_time = end_time;
+}
+
+
+/**
+ * observer_seek: Restrict mapped file reading to [start_offset, end_offset[ (0 for unbounded).
+ */
+int observer_seek(struct nf_observer *observer, int root_idx, uint64_t start_offset, uint64_t end_offset,
+                  uint64_t *headers, int n_headers) {
+  if ((start_offset == 0) && (end_offset == 0)) return 0;
+  if ((observer->map == NULL) || (start_offset > observer->map_size)) {
+    if (root_idx == 0) printf("ERROR: Unable to seek within source.\n");
+    observer_close(observer);
+    return 1;
+  }
+  if (start_offset) {
+    // pcapng sections and interfaces preceding start offset are replayed to restore byte order and time units.
+    for (int i = 0; (i < n_headers) && (headers[i] < start_offset); i++) {
+      observer->offset = headers[i];
+      if (observer_pcapng_block(observer) != 2) {
+        if (root_idx == 0) printf("ERROR: Unable to seek within source.\n");
+        observer_close(observer);
+        return 1;
+      }
+    }
+    observer->offset = start_offset;
+  }
+  observer->end_offset = end_offset;
+  return 0;
+}
+
+
+/**
+ * nf_mark: Capture file index mark (packet time and record offset, or pcapng section/interface block offset).
+ */
+typedef struct nf_mark {
+  uint64_t time;
+  uint64_t offset;
+  uint8_t header;
+} nf_mark_t;
+
+
+/**
+ * observer_index: Fill up to n_marks index marks (a packet mark each interval ms), 0 on end of file.
+ */
+int observer_index(struct nf_observer *observer, struct nf_mark *marks, int n_marks, uint64_t interval) {
+  int n = 0;
+  if (observer->map == NULL) return -1; // Only mapped files can be indexed.
+  while (n < n_marks) {
+    int rv = observer_step(observer);
+    if (rv == 0) break;
+    if (rv == 2) {
+      marks[n].time = 0;
+      marks[n].offset = observer->record_offset;
+      marks[n].header = 1;
+      n++;
+    } else if (rv == 1) {
+      uint64_t time = ((uint64_t) observer->hdr.ts.tv_sec) * TICK_RESOLUTION +
+                      observer->hdr.ts.tv_usec / (1000000 / TICK_RESOLUTION);
+      if ((observer->index_tick == 0) || (time >= observer->index_tick + interval)) {
+        observer->index_tick = time;
+        marks[n].time = time;
+        marks[n].offset = observer->record_offset;
+        marks[n].header = 0;
+        n++;
+      }
+    }
+  }
+  return n;
+}
+
+
 /**
  * observer_next: Get next packet information from pcap handle.
  */
-int observer_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tunnels, int n_roots, int root_idx, int mode) {
+int observer_next(struct nf_observer *observer, struct nf_packet *nf_pkt, int decode_tunnels, int n_roots, int root_idx,
+                  int mode, int hash_mode) {
   struct pcap_pkthdr *hdr = NULL;
   const uint8_t *data = NULL;
-  int rv_handle = pcap_next_ex(pcap_handle, &hdr, &data);
+  int rv_handle = observer_read(observer, &hdr, &data);
   if (rv_handle == 1) { // Everything is OK.
-    int rv_processor = process_packet(pcap_handle, hdr, data, decode_tunnels, nf_pkt, n_roots, root_idx, mode);
+    int rv_processor = process_packet(observer->current->pcap_handle, hdr, data, decode_tunnels, nf_pkt, n_roots,
+                                      root_idx, mode, hash_mode);
     if (rv_processor == 0) {
         return 0; // Packet ignored due to parsing
     } else if (rv_processor == 1) { // Packet parsed correctly and match root_idx
@@ -1114,7 +1755,8 @@ int observer_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tun
       if ((hdr == NULL) || (data == NULL)) { // Timeout with no packet
         return -1;
       } else { // packet read at buffer timeout
-        int rv_processor = process_packet(pcap_handle, hdr, data, decode_tunnels, nf_pkt, n_roots, root_idx, mode);
+        int rv_processor = process_packet(observer->current->pcap_handle, hdr, data, decode_tunnels, nf_pkt, n_roots,
+                                      root_idx, mode, hash_mode);
         if (rv_processor == 0) {
           return 0; // Packet ignored due to parsing
         } else if (rv_processor == 1) { // Packet parsed correctly and match root_idx
@@ -1132,14 +1774,122 @@ int observer_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tun
 }
 
 
+/**
+ * nf_batch: Batch state shared with dispatch handler.
+ */
+typedef struct nf_batch {
+  struct nf_observer *observer;
+  struct nf_packet *nf_pkts;
+  int *nf_rets;
+  uint8_t *buffers;
+  unsigned buffer_size;
+  int n_pkts;
+  int decode_tunnels;
+  int n_roots;
+  int root_idx;
+  int mode;
+  int hash_mode;
+} nf_batch_t;
+
+
+/**
+ * observer_batch_handler: Dispatch callback filling next batch slot.
+ */
+static void observer_batch_handler(uint8_t *user, const struct pcap_pkthdr *hdr, const uint8_t *data) {
+  struct nf_batch *batch = (struct nf_batch *)user;
+  struct nf_packet *nf_pkt = &batch->nf_pkts[batch->n_pkts];
+  int rv_processor = process_packet(batch->observer->current->pcap_handle, hdr, data, batch->decode_tunnels, nf_pkt,
+                                    batch->n_roots, batch->root_idx, batch->mode, batch->hash_mode);
+  if (rv_processor > 0) {
+    nf_pkt->ip_content_len = nfstream_min(nf_pkt->ip_content_len, batch->buffer_size);
+    if (batch->observer->current->map == NULL) {
+      // Capture buffer is reused once we return, so IP content is copied to the slot own buffer.
+      uint8_t *slot = batch->buffers + ((size_t)batch->n_pkts * batch->buffer_size);
+      memcpy(slot, nf_pkt->ip_content, nf_pkt->ip_content_len);
+      nf_pkt->ip_content = slot;
+    } // Mapped file content remains valid until observer is closed: slot keeps pointing into it.
+  }
+  batch->nf_rets[batch->n_pkts] = rv_processor;
+  batch->n_pkts++;
+}
+
+
+/**
+ * observer_next_batch: Fill up to batch_size packets information from pcap handle in a single call.
+ */
+int observer_next_batch(struct nf_observer *observer, struct nf_packet *nf_pkts, int *nf_rets, uint8_t *buffers,
+                        unsigned buffer_size, int batch_size, int decode_tunnels, int n_roots, int root_idx,
+                        int mode, int hash_mode) {
+  struct nf_batch batch;
+  batch.observer = observer;
+  batch.nf_pkts = nf_pkts;
+  batch.nf_rets = nf_rets;
+  batch.buffers = buffers;
+  batch.buffer_size = buffer_size;
+  batch.n_pkts = 0;
+  batch.decode_tunnels = decode_tunnels;
+  batch.n_roots = n_roots;
+  batch.root_idx = root_idx;
+  batch.mode = mode;
+  batch.hash_mode = hash_mode;
+  int rv_handle = 0;
+  if (mode == 0) { // Offline: records are read one by one to apply range and time window.
+    struct pcap_pkthdr *hdr = NULL;
+    const uint8_t *data = NULL;
+    while ((batch.n_pkts < batch_size) && (observer_read(observer, &hdr, &data) == 1)) {
+      observer_batch_handler((uint8_t *)&batch, hdr, data);
+    }
+  } else {
+    rv_handle = pcap_dispatch(observer->pcap_handle, batch_size, observer_batch_handler, (uint8_t *)&batch);
+  }
+  if (batch.n_pkts > 0) return batch.n_pkts; // Packets available in batch
+  if (rv_handle == 0) {
+    if (mode == 0) return -2; // End of file
+    return -1; // Timeout with no packet
+  }
+  if (rv_handle == -2) return -2; // Loop broken
+  return -1; // Read error
+}
+
+
+/**
+ * observer_snapshot: Get observer snapshot length.
+ */
+unsigned observer_snapshot(struct nf_observer *observer) {
+  if (observer->sources != NULL) { // Merged sources: largest one.
+    unsigned snapshot = 0;
+    for (int i = 0; i < observer->n_sources; i++) {
+      unsigned source_snapshot = observer_snapshot(observer->sources[i]);
+      snapshot = nfstream_max(snapshot, source_snapshot);
+    }
+    return snapshot;
+  }
+  int snapshot = pcap_snapshot(observer->pcap_handle);
+  if (snapshot <= 0) return 65535;
+  return nfstream_min((unsigned)snapshot, 65535);
+}
+
+
+/**
+ * observer_rebase: Point batch packets content to their location within a contiguous content buffer.
+ */
+void observer_rebase(struct nf_packet *nf_pkts, int n_pkts, uint8_t *content) {
+  uint64_t offset = 0;
+  for (int i = 0; i < n_pkts; i++) {
+    nf_pkts[i].ip_content = content + offset;
+    offset += nf_pkts[i].ip_content_len;
+  }
+}
+
+
 /**
  * observer_stats: Get observer stats.
  */
-void observer_stats(pcap_t * pcap_handle, struct nf_stat *nf_statistics, unsigned mode) {
+void observer_stats(struct nf_observer *observer, struct nf_stat *nf_statistics, unsigned mode) {
   if (mode == 0) return;
   else {
     struct pcap_stat statistics;
-    int ret = pcap_stats(pcap_handle, &statistics);
+    int ret = pcap_stats(observer->pcap_handle, &statistics);
     if (ret == 0) {
       nf_statistics->received = statistics.ps_recv;
       nf_statistics->dropped = statistics.ps_drop;
@@ -1150,15 +1900,6 @@ void observer_stats(pcap_t * pcap_handle, struct nf_stat *nf_statistics, unsigne
   }
 }
 
-
-/**
- * observer_close: Close observer handle.
- */
-void observer_close(pcap_t * pcap_handle) {
-  pcap_breakloop(pcap_handle);
-  pcap_close(pcap_handle);
-}
-
 /*
 ------------------------------------------------------------------------------------------------------------------------
                                            Dissector Layer
@@ -1227,6 +1968,8 @@ typedef struct nf_flow {
   uint8_t protocol;
   uint8_t ip_version;
   uint16_t vlan_id;
+  uint8_t src_addr[16];
+  uint8_t dst_addr[16];
   uint64_t bidirectional_first_seen_ms;
   uint64_t bidirectional_last_seen_ms;
   uint64_t bidirectional_duration_ms;
@@ -1307,9 +2050,20 @@ typedef struct nf_flow {
   ndpi_protocol detected_protocol;
   uint8_t guessed;
   uint8_t detection_completed;
+  int8_t expiration_id;
+  uint64_t plugins_state[]; // Native plugins state blocks (8 bytes aligned).
 } nf_flow_t;
 
 
+// Native plugins registry: plugin state blocks are laid out after flow structure at their offsets.
+typedef struct nf_plugins {
+  uint32_t n_plugins;
+  struct nf_plugin **plugins;
+  uint32_t *offsets;
+  uint32_t state_size;
+} nf_plugins_t;
+
+
 /**
  * meter_account_packet: Return packet_size according to configured accounting mode.
  */
@@ -1397,16 +2151,25 @@ void free_splt_data(struct nf_flow *flow) {
 }
 
 
+/**
+ * plugin_state: Return native plugin state block within flow.
+ */
+static inline void *plugin_state(struct nf_flow *flow, struct nf_plugins *plugins, uint32_t idx) {
+  return (uint8_t *)flow->plugins_state + plugins->offsets[idx];
+}
+
+
 /**
  * meter_initialize_flow: Initialize flow based on packet values and set packet direction.
  */
 struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounting_mode, uint8_t statistics,
                                       uint8_t splt, uint8_t n_dissections,
-                                      struct ndpi_detection_module_struct *dissector) {
-
-  struct nf_flow *flow = (struct nf_flow*)ndpi_malloc(sizeof(struct nf_flow));
+                                      struct ndpi_detection_module_struct *dissector, struct nf_plugins *plugins) {
+  // Native plugins state blocks are allocated with flow structure.
+  size_t flow_size = sizeof(struct nf_flow) + (plugins ? plugins->state_size : 0);
+  struct nf_flow *flow = (struct nf_flow*)ndpi_malloc(flow_size);
   if(flow == NULL) return NULL; // not enough memory for flow.
-  memset(flow, 0, sizeof(struct nf_flow));
+  memset(flow, 0, flow_size);
 
   if (splt) {
     flow->splt_direction = (int8_t*)ndpi_malloc(sizeof(int8_t) * splt); // direction on int8 is more than sufficient.
@@ -1473,9 +2236,12 @@ struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounti
   flow->bidirectional_last_seen_ms = packet->time;
   flow->src2dst_first_seen_ms = packet->time;
   flow->src2dst_last_seen_ms = packet->time;
-  memcpy(flow->src_ip, packet->src_name, 48);
+  memcpy(flow->src_addr, packet->src_addr, 16);
+  memcpy(flow->dst_addr, packet->dst_addr, 16);
+  // Addresses text formatting is done once per flow.
+  inet_ntop((packet->ip_version == IPVERSION) ? AF_INET : AF_INET6, flow->src_addr, flow->src_ip, 48);
+  inet_ntop((packet->ip_version == IPVERSION) ? AF_INET : AF_INET6, flow->dst_addr, flow->dst_ip, 48);
   flow->src_port = packet->src_port;
-  memcpy(flow->dst_ip, packet->dst_name, 48);
   flow->dst_port = packet->dst_port;
   flow->protocol = packet->protocol;
   flow->ip_version = packet->ip_version;
@@ -1535,6 +2301,11 @@ struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounti
       flow->src2dst_fin_packets++;
     }
   }
+  if (plugins) { // Native plugins initialization with first packet.
+    for (uint32_t i = 0; i < plugins->n_plugins; i++) {
+      if (plugins->plugins[i]->on_init) plugins->plugins[i]->on_init(plugin_state(flow, plugins, i), packet);
+    }
+  }
   return flow; // we return a pointer to the created flow in order to be cached by Python side.
 }
 
@@ -1544,22 +2315,26 @@ struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounti
  */
 uint8_t meter_update_flow(struct nf_flow *flow, struct nf_packet *packet, uint64_t idle_timeout,
                            uint64_t active_timeout, uint8_t accounting_mode, uint8_t statistics, uint8_t splt,
-                           uint8_t n_dissections, struct ndpi_detection_module_struct *dissector) {
-  if ((packet->time - flow->bidirectional_last_seen_ms) >= idle_timeout) {
+                           uint8_t n_dissections, struct ndpi_detection_module_struct *dissector,
+                           struct nf_plugins *plugins) {
+  uint8_t idle = (packet->time - flow->bidirectional_last_seen_ms) >= idle_timeout;
+  uint8_t active = (packet->time - flow->bidirectional_first_seen_ms) >= active_timeout;
+  if (idle && active) { // Both reached: we report the first one reached, as timer wheel does.
+    if ((flow->bidirectional_last_seen_ms - flow->bidirectional_first_seen_ms) + idle_timeout <= active_timeout) {
+      return 1; // Inactive expiration
+    }
+    return 2; // active expiration
+  }
+  if (idle) {
     return 1; // Inactive expiration
   }
-  if ((packet->time - flow->bidirectional_first_seen_ms) >= active_timeout) {
+  if (active) {
     return 2; // active expiration
   }
 
-  // We first check ports to determine direction.
-  if ((flow->src_port != packet->src_port) || (flow->src_port != packet->src_port)) {
+  // Flow key is symmetric: packet is src2dst only if its source endpoint is the flow source one.
+  if ((flow->src_port != packet->src_port) || (memcmp(flow->src_addr, packet->src_addr, 16) != 0)) {
     packet->direction = 1;
-  // Then IPs
-  } else {
-    if ((memcmp(flow->src_ip, packet->src_name, 48) != 0) || (memcmp(flow->dst_ip, packet->dst_name, 48) != 0)) {
-      packet->direction = 1;
-    }
   }
   // --------------------------------------- bidirectional processing --------------------------------------------------
   uint64_t bidirectional_piat_ms = packet->time - flow->bidirectional_last_seen_ms;
@@ -1767,6 +2542,11 @@ uint8_t meter_update_flow(struct nf_flow *flow, struct nf_packet *packet, uint64
       }
     }
   }
+  if (plugins) { // Native plugins update.
+    for (uint32_t i = 0; i < plugins->n_plugins; i++) {
+      if (plugins->plugins[i]->on_update) plugins->plugins[i]->on_update(plugin_state(flow, plugins, i), packet);
+    }
+  }
   return 0; // Update done, we return 0.
 }
 
@@ -1774,7 +2554,8 @@ uint8_t meter_update_flow(struct nf_flow *flow, struct nf_packet *packet, uint64
 /**
  * meter_expire_flow: Flow expiration. Mainly to guess idle flows that were not detected.
  */
-void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_detection_module_struct *dissector) {
+void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_detection_module_struct *dissector,
+                       struct nf_plugins *plugins) {
   if (n_dissections) {
     if ((flow->detected_protocol.app_protocol == NDPI_PROTOCOL_UNKNOWN) && (flow->detection_completed == 0)) {
       flow->detected_protocol = ndpi_detection_giveup(dissector, flow->ndpi_flow, 1, &flow->guessed);
@@ -1785,6 +2566,11 @@ void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_
     }
     flow->detection_completed = 1; // IMPORTANT: This will force copy on non sync mode.
   }
+  if (plugins) { // Native plugins expiration: state blocks are then exported by Python side.
+    for (uint32_t i = 0; i < plugins->n_plugins; i++) {
+      if (plugins->plugins[i]->on_expire) plugins->plugins[i]->on_expire(plugin_state(flow, plugins, i));
+    }
+  }
 }
 
 
@@ -1800,4 +2586,365 @@ void meter_free_flow(struct nf_flow *flow, uint8_t n_dissections, uint8_t splt)
   }
   ndpi_free(flow);
   flow = NULL;
-}
\ No newline at end of file
+}
+
+/*
+------------------------------------------------------------------------------------------------------------------------
+                                           Engine Layer
+------------------------------------------------------------------------------------------------------------------------
+*/
+
+
+#define ENGINE_INITIAL_BUCKETS 4096
+#define ENGINE_SCAN_INTERVAL 10 // Expiration check each 10 msecs as done by Python meter.
+#define WHEEL_LEVELS 11 // 11 levels of 64 slots cover all 64 bits deadlines with 1 msec resolution on first level.
+#define WHEEL_SLOTS 64
+#define WHEEL_BITS 6
+
+
+// Flow table entry: flow key and links.
+typedef struct nf_node {
+  uint8_t key[40];
+  uint64_t hashval;
+  struct nf_flow *flow;
+  struct nf_node *next; // Bucket chaining.
+  uint64_t deadline; // Scheduled deadline, never later than the flow actual one (lazy rescheduling).
+  struct nf_node *wheel_next; // Timer wheel slot chaining.
+  struct nf_node **wheel_pprev;
+} nf_node_t;
+
+
+// Native engine: flow table, expiration timer wheel and exported flows queue.
+typedef struct nf_engine {
+  struct nf_node **buckets;
+  uint64_t n_buckets;
+  uint64_t n_flows;
+  struct nf_node *wheel[WHEEL_LEVELS][WHEEL_SLOTS];
+  uint64_t wheel_tick;
+  struct nf_flow **expired;
+  uint64_t expired_size;
+  uint64_t expired_head;
+  uint64_t expired_tail;
+  uint64_t idle_timeout;
+  uint64_t active_timeout;
+  uint8_t accounting_mode;
+  uint8_t statistics;
+  uint8_t splt;
+  uint8_t n_dissections;
+  struct ndpi_detection_module_struct *dissector;
+  struct nf_plugins *plugins;
+  uint64_t tick;
+  uint64_t scan_tick;
+  uint64_t processed_packets;
+  uint64_t ignored_packets;
+} nf_engine_t;
+
+
+/**
+ * engine_key_match: Check if node matches packet flow key.
+ */
+static inline uint8_t engine_key_match(struct nf_node *node, uint64_t hashval, struct nf_packet *packet) {
+  return (node->hashval == hashval) && (memcmp(node->key, packet->flow_key, 40) == 0);
+}
+
+
+/**
+ * engine_deadline: Compute flow expiration deadline (idle or active, the earliest) and its expiration reason.
+ */
+static uint64_t engine_deadline(struct nf_engine *engine, struct nf_flow *flow, int8_t *reason) {
+  uint64_t idle_deadline = flow->bidirectional_last_seen_ms + engine->idle_timeout;
+  uint64_t active_deadline = flow->bidirectional_first_seen_ms + engine->active_timeout;
+  if (idle_deadline < flow->bidirectional_last_seen_ms) idle_deadline = UINT64_MAX; // Saturate on overflow.
+  if (active_deadline < flow->bidirectional_first_seen_ms) active_deadline = UINT64_MAX;
+  if (idle_deadline <= active_deadline) {
+    *reason = 0; // Idle expiration
+    return idle_deadline;
+  }
+  *reason = 1; // Active expiration
+  return active_deadline;
+}
+
+
+/**
+ * engine_schedule: Insert node in the timer wheel according to its deadline.
+ */
+static void engine_schedule(struct nf_engine *engine, struct nf_node *node, uint64_t deadline) {
+  node->deadline = deadline;
+  // Already reached deadlines are scheduled on next wheel tick.
+  uint64_t slot_deadline = nfstream_max(deadline, engine->wheel_tick + 1);
+  uint64_t delta = slot_deadline - engine->wheel_tick;
+  int level = (63 - __builtin_clzll(delta)) / WHEEL_BITS;
+  struct nf_node **slot = &engine->wheel[level][(slot_deadline >> (level * WHEEL_BITS)) & (WHEEL_SLOTS - 1)];
+  node->wheel_next = *slot;
+  if (*slot) (*slot)->wheel_pprev = &node->wheel_next;
+  node->wheel_pprev = slot;
+  *slot = node;
+}
+
+
+/**
+ * engine_unschedule: Remove node from the timer wheel.
+ */
+static void engine_unschedule(struct nf_node *node) {
+  if (node->wheel_pprev == NULL) return;
+  *node->wheel_pprev = node->wheel_next;
+  if (node->wheel_next) node->wheel_next->wheel_pprev = node->wheel_pprev;
+  node->wheel_next = NULL;
+  node->wheel_pprev = NULL;
+}
+
+
+/**
+ * engine_grow: Double buckets count when load factor reaches 1.
+ */
+static void engine_grow(struct nf_engine *engine) {
+  uint64_t n_buckets = engine->n_buckets * 2;
+  struct nf_node **buckets = (struct nf_node **)ndpi_calloc(n_buckets, sizeof(struct nf_node *));
+  if (buckets == NULL) return; // We keep going with current buckets.
+  for (uint64_t i = 0; i < engine->n_buckets; i++) {
+    struct nf_node *node = engine->buckets[i];
+    while (node) {
+      struct nf_node *next = node->next;
+      uint64_t idx = node->hashval & (n_buckets - 1);
+      node->next = buckets[idx];
+      buckets[idx] = node;
+      node = next;
+    }
+  }
+  ndpi_free(engine->buckets);
+  engine->buckets = buckets;
+  engine->n_buckets = n_buckets;
+}
+
+
+/**
+ * engine_remove: Remove node from flow table and release it.
+ */
+static void engine_remove(struct nf_engine *engine, struct nf_node *node) {
+  struct nf_node **link = &engine->buckets[node->hashval & (engine->n_buckets - 1)];
+  while (*link && (*link != node)) link = &(*link)->next;
+  if (*link) *link = node->next;
+  engine_unschedule(node);
+  engine->n_flows--;
+  ndpi_free(node);
+}
+
+
+/**
+ * engine_export: Expire flow and push it on exported flows queue.
+ */
+static void engine_export(struct nf_engine *engine, struct nf_flow *flow, int8_t expiration_id) {
+  flow->expiration_id = expiration_id;
+  meter_expire_flow(flow, engine->n_dissections, engine->dissector, engine->plugins);
+  if (engine->expired_tail == engine->expired_size) {
+    if (engine->expired_head > 0) { // Reuse consumed space first.
+      memmove(engine->expired, engine->expired + engine->expired_head,
+              (engine->expired_tail - engine->expired_head) * sizeof(struct nf_flow *));
+      engine->expired_tail -= engine->expired_head;
+      engine->expired_head = 0;
+    } else {
+      struct nf_flow **expired = (struct nf_flow **)realloc(engine->expired,
+                                                            2 * engine->expired_size * sizeof(struct nf_flow *));
+      if (expired == NULL) { // We cannot keep it, we release it.
+        printf("WARNING: Failed to allocate memory space for flow export. Flow dropped.\n");
+        meter_free_flow(flow, engine->n_dissections, engine->splt);
+        return;
+      }
+      engine->expired = expired;
+      engine->expired_size *= 2;
+    }
+  }
+  engine->expired[engine->expired_tail++] = flow;
+}
+
+
+/**
+ * engine_advance: Advance timer wheel to tick, expire flows which deadline is reached and reschedule the others.
+ */
+static void engine_advance(struct nf_engine *engine, uint64_t tick) {
+  struct nf_node *popped = NULL;
+  // Collect slots crossed on each level, a level is crossed only if its upper one changed.
+  for (int level = 0; level < WHEEL_LEVELS; level++) {
+    uint64_t old_idx = engine->wheel_tick >> (level * WHEEL_BITS);
+    uint64_t new_idx = tick >> (level * WHEEL_BITS);
+    if (new_idx == old_idx) break;
+    uint64_t last_idx = nfstream_min(new_idx, old_idx + WHEEL_SLOTS);
+    for (uint64_t idx = old_idx + 1; idx <= last_idx; idx++) {
+      struct nf_node **slot = &engine->wheel[level][idx & (WHEEL_SLOTS - 1)];
+      while (*slot) {
+        struct nf_node *node = *slot;
+        engine_unschedule(node);
+        node->wheel_next = popped;
+        popped = node;
+      }
+    }
+  }
+  engine->wheel_tick = tick;
+  while (popped) {
+    struct nf_node *node = popped;
+    popped = node->wheel_next;
+    node->wheel_next = NULL;
+    if (node->deadline > tick) { // Cascade to a lower level.
+      engine_schedule(engine, node, node->deadline);
+      continue;
+    }
+    int8_t reason = 0;
+    uint64_t deadline = engine_deadline(engine, node->flow, &reason);
+    if (deadline <= tick) { // Earliest reached deadline gives expiration reason.
+      engine_export(engine, node->flow, reason);
+      engine_remove(engine, node);
+    } else { // Flow was updated since scheduling: we reschedule it on its actual deadline.
+      engine_schedule(engine, node, deadline);
+    }
+  }
+}
+
+
+/**
+ * engine_consume: Consume a packet: flow lookup, update or creation.
+ */
+static void engine_consume(struct nf_engine *engine, struct nf_packet *packet) {
+  // Dispatch hash is selectable and its low bits are shared by all meter flows: we use our own mixed one.
+  uint64_t hashval = nf_hash_mix(nf_hash_key(packet->flow_key));
+  struct nf_node *node = engine->buckets[hashval & (engine->n_buckets - 1)];
+  while (node && !engine_key_match(node, hashval, packet)) node = node->next;
+  if (node) { // Update flow
+    uint8_t ret = meter_update_flow(node->flow, packet, engine->idle_timeout, engine->active_timeout,
+                                    engine->accounting_mode, engine->statistics, engine->splt,
+                                    engine->n_dissections, engine->dissector, engine->plugins);
+    if (ret > 0) { // Idle or active expiration: we export it and start a new one with current packet.
+      engine_export(engine, node->flow, ret - 1);
+      node->flow = meter_initialize_flow(packet, engine->accounting_mode, engine->statistics, engine->splt,
+                                         engine->n_dissections, engine->dissector, engine->plugins);
+      if (node->flow == NULL) {
+        printf("WARNING: Failed to allocate memory space for flow creation. Flow creation aborted.\n");
+        engine_remove(engine, node);
+        return;
+      }
+    } // Deadline is only moved forward by update, node is rescheduled lazily when its slot is reached.
+  } else { // Create flow
+    struct nf_flow *flow = meter_initialize_flow(packet, engine->accounting_mode, engine->statistics, engine->splt,
+                                                 engine->n_dissections, engine->dissector, engine->plugins);
+    node = (struct nf_node *)ndpi_malloc(sizeof(struct nf_node));
+    if ((flow == NULL) || (node == NULL)) {
+      printf("WARNING: Failed to allocate memory space for flow creation. Flow creation aborted.\n");
+      if (flow) meter_free_flow(flow, engine->n_dissections, engine->splt);
+      if (node) ndpi_free(node);
+      return;
+    }
+    memcpy(node->key, packet->flow_key, 40);
+    node->hashval = hashval;
+    node->flow = flow;
+    uint64_t idx = node->hashval & (engine->n_buckets - 1);
+    node->next = engine->buckets[idx];
+    engine->buckets[idx] = node;
+    node->wheel_pprev = NULL;
+    int8_t reason = 0;
+    engine_schedule(engine, node, engine_deadline(engine, flow, &reason));
+    engine->n_flows++;
+    if (engine->n_flows > engine->n_buckets) engine_grow(engine);
+  }
+}
+
+
+/**
+ * engine_init: Native engine initializer.
+ */
+struct nf_engine *engine_init(uint64_t idle_timeout, uint64_t active_timeout, uint8_t accounting_mode,
+                              uint8_t statistics, uint8_t splt, uint8_t n_dissections,
+                              struct ndpi_detection_module_struct *dissector, struct nf_plugins *plugins) {
+  struct nf_engine *engine = (struct nf_engine *)ndpi_calloc(1, sizeof(struct nf_engine));
+  if (engine == NULL) return NULL;
+  engine->buckets = (struct nf_node **)ndpi_calloc(ENGINE_INITIAL_BUCKETS, sizeof(struct nf_node *));
+  engine->expired = (struct nf_flow **)malloc(ENGINE_INITIAL_BUCKETS * sizeof(struct nf_flow *));
+  if ((engine->buckets == NULL) || (engine->expired == NULL)) {
+    if (engine->buckets) ndpi_free(engine->buckets);
+    if (engine->expired) free(engine->expired);
+    ndpi_free(engine);
+    return NULL;
+  }
+  engine->n_buckets = ENGINE_INITIAL_BUCKETS;
+  engine->expired_size = ENGINE_INITIAL_BUCKETS;
+  engine->idle_timeout = idle_timeout;
+  engine->active_timeout = active_timeout;
+  engine->accounting_mode = accounting_mode;
+  engine->statistics = statistics;
+  engine->splt = splt;
+  engine->n_dissections = n_dissections;
+  engine->dissector = dissector;
+  engine->plugins = plugins;
+  return engine;
+}
+
+
+/**
+ * engine_process_batch: Process a batch of packets, return the number of exported flows ready to be collected.
+ */
+uint64_t engine_process_batch(struct nf_engine *engine, struct nf_packet *nf_pkts, int *nf_rets, int n_pkts) {
+  for (int i = 0; i < n_pkts; i++) {
+    struct nf_packet *packet = &nf_pkts[i];
+    if (nf_rets[i] > 0) { // Valid packet or time ticker.
+      if (packet->time > engine->tick) engine->tick = packet->time;
+      else packet->time = engine->tick; // Force time order
+      if (nf_rets[i] == 1) { // Must be processed
+        engine->processed_packets++;
+        engine_consume(engine, packet);
+      }
+      if (engine->tick - engine->scan_tick >= ENGINE_SCAN_INTERVAL) {
+        engine_advance(engine, engine->tick);
+        engine->scan_tick = engine->tick;
+      }
+    } else if (nf_rets[i] == 0) { // Ignored packet
+      engine->ignored_packets++;
+    }
+  }
+  return engine->expired_tail - engine->expired_head;
+}
+
+
+/**
+ * engine_cleanup: Expire all remaining flows, return the number of exported flows ready to be collected.
+ */
+uint64_t engine_cleanup(struct nf_engine *engine) {
+  for (uint64_t i = 0; i < engine->n_buckets; i++) {
+    while (engine->buckets[i]) {
+      struct nf_node *node = engine->buckets[i];
+      engine_export(engine, node->flow, 0);
+      engine_remove(engine, node);
+    }
+  }
+  return engine->expired_tail - engine->expired_head;
+}
+
+
+/**
+ * engine_expired: Collect up to max_flows exported flows. Collected flows must be released using meter_free_flow.
+ */
+uint64_t engine_expired(struct nf_engine *engine, struct nf_flow **flows, uint64_t max_flows) {
+  uint64_t n_flows = nfstream_min(max_flows, engine->expired_tail - engine->expired_head);
+  memcpy(flows, engine->expired + engine->expired_head, n_flows * sizeof(struct nf_flow *));
+  engine->expired_head += n_flows;
+  if (engine->expired_head == engine->expired_tail) engine->expired_head = engine->expired_tail = 0;
+  return n_flows;
+}
+
+
+/**
+ * engine_free: Native engine freer.
+ */
+void engine_free(struct nf_engine *engine) {
+  if (engine == NULL) return;
+  for (uint64_t i = 0; i < engine->n_buckets; i++) {
+    while (engine->buckets[i]) {
+      struct nf_node *node = engine->buckets[i];
+      meter_free_flow(node->flow, engine->n_dissections, engine->splt);
+      engine_remove(engine, node);
+    }
+  }
+  for (uint64_t i = engine->expired_head; i < engine->expired_tail; i++) {
+    meter_free_flow(engine->expired[i], engine->n_dissections, engine->splt);
+  }
+  ndpi_free(engine->buckets);
+  free(engine->expired);
+  ndpi_free(engine);
+}
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+------------------------------------------------------------------------------------------------------------------------
+exporter.py
+Copyright (C) 2019-20 - NFStream Developers
+This file is part of NFStream, a Flexible Network Data Analysis Framework (https://www.nfstream.org/).
+NFStream is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+version.
+NFStream is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+You should have received a copy of the GNU Lesser General Public License along with NFStream.
+If not, see <http://www.gnu.org/licenses/>.
+------------------------------------------------------------------------------------------------------------------------
+"""
+
+import socket
+import struct
+import time as tm
+from threading import Lock
+from .flow import NFlow
+from .utils import column_type, RepeatedTimer
+
+# IANA information elements (IPFIX and NetFlow v9 share these numbers): name -> (enterprise, IPFIX id, v9 type).
+# Reverse direction counters use RFC 5103 reverse enterprise number for IPFIX and OUT_BYTES/OUT_PKTS for v9.
+IANA_ELEMENTS = {'expiration_id': (0, 136, 136),
+                 'src_port': (0, 7, 7),
+                 'dst_port': (0, 11, 11),
+                 'protocol': (0, 4, 4),
+                 'ip_version': (0, 60, 60),
+                 'vlan_id': (0, 58, 58),
+                 'bidirectional_first_seen_ms': (0, 152, 152),
+                 'bidirectional_last_seen_ms': (0, 153, 153),
+                 'src2dst_bytes': (0, 1, 1),
+                 'src2dst_packets': (0, 2, 2),
+                 'dst2src_bytes': (29305, 1, 23),
+                 'dst2src_packets': (29305, 2, 24),
+                 'application_name': (0, 96, 96)}
+IP_ELEMENTS = {4: {'src_ip': 8, 'dst_ip': 12}, 6: {'src_ip': 27, 'dst_ip': 28}}
+# Other flow features are enterprise specific elements, numbered by their NFlow slot position (stable across feature
+# sets). udps ones are numbered from UDPS_ELEMENTS by their position. NetFlow v9 uses them from V9_ELEMENTS.
+ENTERPRISE_ELEMENTS = [name for name in NFlow.__slots__ if name not in IANA_ELEMENTS and name not in
+                       ['id', 'src_ip', 'dst_ip', 'udps']]
+UDPS_ELEMENTS = 1024
+V9_ELEMENTS = 32768
+# NetFlow v9 has no variable length fields: texts are truncated or zero padded to a fixed length.
+V9_TEXT_LENGTHS = {'requested_server_name': 128, 'user_agent': 256}
+V9_TEXT_LENGTH = 64
+# Flow expiration id to IPFIX flowEndReason: idle timeout, active timeout, otherwise forced end.
+END_REASONS = {0: 1, 1: 2}
+
+
+class NFExporter(object):
+    """
+        IPFIX (version 10) and NetFlow v9 flows exporter: flows are encoded against one template per IP version,
+        derived from flows keys, and packed in datagrams up to MTU size sent to a collector over UDP.
+        Templates are sent first and refreshed every template_refresh seconds. Pending records are sent by a timer
+        once they lingered for linger seconds, even when no more flows are exported.
+    """
+    def __init__(self, collector, keys, splt, version=10, mtu=1400, template_refresh=600, observation_domain_id=0,
+                 enterprise_number=32473, linger=1.0):
+        self.version = version
+        self.mtu = mtu
+        self.template_refresh = template_refresh
+        self.observation_domain_id = observation_domain_id
+        self.enterprise_number = enterprise_number
+        self.linger = linger  # Pending records are sent once the oldest one lingered for linger time (secs).
+        family, _, _, _, self.address = socket.getaddrinfo(collector[0], collector[1], type=socket.SOCK_DGRAM)[0]
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.start_time = tm.time()
+        self.header_size = 16 if version == 10 else 20
+        # A record must fit a datagram with its set header and v9 padding.
+        self.max_record_size = mtu - self.header_size - 4 - 3
+        self.templates = {4: self.template(keys, splt, 4, 256), 6: self.template(keys, splt, 6, 257)}
+        for template in self.templates.values():  # Variable length fields take at least their length byte.
+            if template[3].size + len(template[4]) > self.max_record_size:
+                raise ValueError("Please specify a valid mtu parameter (flows records of {} bytes do not fit)."
+                                 .format(template[3].size + len(template[4])))
+        self.templates_time = None
+        self.pending = {}
+        self.pending_size = 0
+        self.pending_time = 0
+        self.n_records = 0  # IPFIX sequence: data records sent.
+        self.n_packets = 0  # NetFlow v9 sequence: packets sent.
+        self.lock = Lock()  # Pending records are shared with linger timer.
+        self.timer = RepeatedTimer(linger / 2, self.flush_lingering) if linger > 0 else None
+
+    def element(self, name, udps_idx, splt, ip_version):
+        """ Template field as (enterprise, element id, length) and its encoding: struct code or 'text' """
+        if name in ['src_ip', 'dst_ip']:
+            return (0, IP_ELEMENTS[ip_version][name], 4 if ip_version == 4 else 16), \
+                '4s' if ip_version == 4 else '16s'
+        if name in IANA_ELEMENTS:
+            enterprise, element_id, v9_type = IANA_ELEMENTS[name]
+            if self.version == 9:
+                enterprise, element_id = 0, v9_type
+        elif name.startswith('udps.'):
+            enterprise, element_id = self.enterprise_number, UDPS_ELEMENTS + udps_idx
+        else:
+            enterprise, element_id = self.enterprise_number, ENTERPRISE_ELEMENTS.index(name) + 1
+        if self.version == 9 and enterprise:  # No enterprise numbers in v9: vendor range types.
+            enterprise, element_id = 0, V9_ELEMENTS + element_id
+        kind = column_type(name)
+        if name == 'expiration_id':  # Exported as flowEndReason.
+            kind = 'B'
+        elif name in ['splt_direction', 'splt_ps', 'splt_piat_ms']:  # Octet arrays of big endian values.
+            kind = '{}{}'.format(splt, {'splt_direction': 'b', 'splt_ps': 'i', 'splt_piat_ms': 'q'}[name])
+        elif kind == 'category' or kind is None:  # udps values are exported as text.
+            if self.version == 10:
+                return (enterprise, element_id, 65535), 'text'
+            kind = '{}s'.format(V9_TEXT_LENGTHS.get(name, V9_TEXT_LENGTH))
+        return (enterprise, element_id, struct.calcsize('>' + kind)), kind
+
+    def template(self, keys, splt, ip_version, template_id):
+        """ Template as (id, template record, fixed length fields (name, kind) and struct, text fields names) """
+        fields = []
+        for name in keys:
+            if name != 'id':
+                fields.append((name,) + self.element(name, len([f for f in fields if f[0].startswith('udps.')]),
+                                                     splt, ip_version))
+        # Fixed length fields first: record is a single struct followed by variable length ones.
+        fields = [field for field in fields if field[2] != 'text'] + [field for field in fields if field[2] == 'text']
+        record = struct.pack('>HH', template_id, len(fields))
+        for name, (enterprise, element_id, length), kind in fields:
+            if enterprise:
+                record += struct.pack('>HHI', element_id | 0x8000, length, enterprise)
+            else:
+                record += struct.pack('>HH', element_id, length)
+        fixed = [(name, kind) for name, _, kind in fields if kind != 'text']
+        return (template_id, record, fixed, struct.Struct('>' + ''.join([kind for _, kind in fixed])),
+                [name for name, _, kind in fields if kind == 'text'])
+
+    def encode(self, flow):
+        """ Encode flow as a data record of its IP version template """
+        template = self.templates.get(flow.ip_version)
+        if template is None:
+            return None, None
+        values = []
+        try:
+            for name, kind in template[2]:
+                value = getattr(flow.udps, name[5:]) if name.startswith('udps.') else getattr(flow, name)
+                if name in ['src_ip', 'dst_ip']:
+                    values.append(socket.inet_pton(socket.AF_INET if flow.ip_version == 4 else socket.AF_INET6, value))
+                elif name == 'expiration_id':
+                    values.append(END_REASONS.get(value, 4))
+                elif name.startswith('splt_'):
+                    values += value
+                elif kind.endswith('s'):  # NetFlow v9 fixed length text.
+                    values.append(str(value).encode('utf-8'))
+                else:
+                    values.append(value)
+            record = template[3].pack(*values)
+            for idx, name in enumerate(template[4]):
+                content = str(getattr(flow.udps, name[5:]) if name.startswith('udps.') else getattr(flow, name))
+                # Texts are truncated so the record fits MTU: next ones keep at least their length byte.
+                available = self.max_record_size - len(record) - (len(template[4]) - idx - 1)
+                content = content.encode('utf-8')
+                if len(content) + (1 if len(content) < 255 else 3) > available:
+                    content = content[:available - 3 if available >= 258 else min(254, available - 1)]
+                    content = content.decode('utf-8', 'ignore').encode('utf-8')  # No partial character.
+                if len(content) < 255:
+                    record += struct.pack('>B', len(content)) + content
+                else:
+                    record += struct.pack('>BH', 255, len(content)) + content
+        except (AttributeError, TypeError, OSError, struct.error):
+            raise ValueError("Flow attributes altered by plugins cannot be exported as IPFIX, "
+                             "please use udps to store plugins values.")
+        return template[0], record
+
+    def export(self, flow):
+        """ Add flow to pending datagram, send it when full, return False if flow IP version has no template """
+        template_id, record = self.encode(flow)
+        if record is None:
+            return False
+        with self.lock:
+            self.pend(template_id, record)
+        return True
+
+    def pend(self, template_id, record):
+        """ Add record to pending datagram, send it when full or lingering """
+        size = len(record) + (0 if template_id in self.pending else 4 + 3)  # set header and v9 padding.
+        if self.pending_size and self.header_size + self.pending_size + size > self.mtu:
+            self.flush()
+            size = len(record) + 4 + 3
+        if not self.pending_size:
+            self.pending_time = tm.monotonic()
+        self.pending.setdefault(template_id, []).append(record)
+        self.pending_size += size
+        if tm.monotonic() - self.pending_time >= self.linger:
+            self.flush()
+
+    def flush_lingering(self):
+        """ Send pending records once the oldest one lingered for linger time """
+        with self.lock:
+            if self.pending_size and tm.monotonic() - self.pending_time >= self.linger:
+                self.flush()
+
+    def message(self, sets, n_records):
+        """ Message from (set id, records) sets: IPFIX or NetFlow v9 header followed by padded sets """
+        content = b''
+        for set_id, records in sets:
+            records = b''.join(records)
+            padding = (4 - (4 + len(records)) % 4) % 4 if self.version == 9 else 0
+            content += struct.pack('>HH', set_id, 4 + len(records) + padding) + records + b'\x00' * padding
+        now = tm.time()
+        if self.version == 10:
+            header = struct.pack('>HHIII', 10, self.header_size + len(content), int(now),
+                                 self.n_records & 0xFFFFFFFF, self.observation_domain_id)
+        else:
+            header = struct.pack('>HHIIII', 9, n_records, int((now - self.start_time) * 1000) & 0xFFFFFFFF, int(now),
+                                 self.n_packets & 0xFFFFFFFF, self.observation_domain_id)
+        self.n_packets += 1
+        return header + content
+
+    def send_templates(self):
+        """ Send both IP versions templates, in a single message when it fits MTU """
+        records = [self.templates[4][1], self.templates[6][1]]
+        set_id = 2 if self.version == 10 else 0
+        if self.header_size + 4 + len(records[0]) + len(records[1]) + 6 <= self.mtu:
+            self.socket.sendto(self.message([(set_id, records)], len(records)), self.address)
+        else:
+            for record in records:
+                self.socket.sendto(self.message([(set_id, [record])], 1), self.address)
+        self.templates_time = tm.monotonic()
+
+    def flush(self):
+        """ Send pending records datagram, preceded by templates when they must be (re)sent """
+        if not self.pending_size:
+            return
+        if self.templates_time is None or tm.monotonic() - self.templates_time >= self.template_refresh:
+            self.send_templates()
+        n_records = sum([len(records) for records in self.pending.values()])
+        self.socket.sendto(self.message(sorted(self.pending.items()), n_records), self.address)
+        self.n_records += n_records
+        self.pending = {}
+        self.pending_size = 0
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.stop()
+        with self.lock:
+            self.flush()
+        self.socket.close()
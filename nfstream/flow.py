@@ -17,10 +17,14 @@ If not, see <http://www.gnu.org/licenses/>.
 """
 
 from collections import namedtuple
+from socket import inet_ntop, AF_INET, AF_INET6
 from math import sqrt
 import ipaddress
+import numpy as np
+import pickle
+import struct
 
-# When NFStream is extended with plugins, packer C structure is pythonized using the following namedtuple.
+# Plugins opting in packet_copy get packet C structure pythonized using the following namedtuple.
 nf_packet = namedtuple('NFPacket', ['time',
                                     'delta_time',
                                     'direction',
@@ -49,8 +53,122 @@ nf_packet = namedtuple('NFPacket', ['time',
 class UDPS(object):
     """ dummy class that add udps slot the flexibility required for extensions """
 
+def format_address(address, ip_version, ffi):
+    """ format a raw packet address as text """
+    if ip_version == 4:
+        return inet_ntop(AF_INET, ffi.buffer(address, 4)[:])
+    return inet_ntop(AF_INET6, ffi.buffer(address, 16)[:])
+
+
+class NFPacket(object):
+    """
+        NFPacket: lazy view on packet C structure passed to plugins entrypoints. Fields are read on access and
+        ip_packet is a zero copy memoryview, both valid only during entrypoint call.
+    """
+    __slots__ = ('_C', '_ffi')
+
+    def __init__(self, packet, ffi):
+        self._C = packet
+        self._ffi = ffi
+
+    @property
+    def time(self):
+        return self._C.time
+
+    @property
+    def delta_time(self):
+        return self._C.delta_time
+
+    @property
+    def direction(self):
+        return self._C.direction
+
+    @property
+    def raw_size(self):
+        return self._C.raw_size
+
+    @property
+    def ip_size(self):
+        return self._C.ip_size
+
+    @property
+    def transport_size(self):
+        return self._C.transport_size
+
+    @property
+    def payload_size(self):
+        return self._C.payload_size
+
+    @property
+    def src_ip(self):
+        return format_address(self._C.src_addr, self._C.ip_version, self._ffi)
+
+    @property
+    def dst_ip(self):
+        return format_address(self._C.dst_addr, self._C.ip_version, self._ffi)
+
+    @property
+    def src_port(self):
+        return self._C.src_port
+
+    @property
+    def dst_port(self):
+        return self._C.dst_port
+
+    @property
+    def protocol(self):
+        return self._C.protocol
+
+    @property
+    def vlan_id(self):
+        return self._C.vlan_id
+
+    @property
+    def ip_version(self):
+        return self._C.ip_version
+
+    @property
+    def ip_packet(self):
+        return memoryview(self._ffi.buffer(self._C.ip_content, self._C.ip_content_len))
+
+    @property
+    def syn(self):
+        return self._C.syn
+
+    @property
+    def cwr(self):
+        return self._C.cwr
+
+    @property
+    def ece(self):
+        return self._C.ece
+
+    @property
+    def urg(self):
+        return self._C.urg
+
+    @property
+    def ack(self):
+        return self._C.ack
+
+    @property
+    def psh(self):
+        return self._C.psh
+
+    @property
+    def rst(self):
+        return self._C.rst
+
+    @property
+    def fin(self):
+        return self._C.fin
+
+    def __repr__(self):
+        return repr(pythonize_packet(self._C, self._ffi))
+
+
 def pythonize_packet(packet, ffi):
-    """ convert a cdata packet to a namedtuple """
+    """ convert a cdata packet to a namedtuple (copy of all fields) """
     return nf_packet(time=packet.time,
                      delta_time=packet.delta_time,
                      direction=packet.direction,
@@ -58,8 +176,8 @@ def pythonize_packet(packet, ffi):
                      ip_size=packet.ip_size,
                      transport_size=packet.transport_size,
                      payload_size=packet.payload_size,
-                     src_ip=ffi.string(packet.src_name).decode('utf-8', errors='ignore'),
-                     dst_ip=ffi.string(packet.dst_name).decode('utf-8', errors='ignore'),
+                     src_ip=format_address(packet.src_addr, packet.ip_version, ffi),
+                     dst_ip=format_address(packet.dst_addr, packet.ip_version, ffi),
                      src_port=packet.src_port,
                      dst_port=packet.dst_port,
                      protocol=packet.protocol,
@@ -76,6 +194,51 @@ def pythonize_packet(packet, ffi):
                      fin=packet.fin)
 
 
+# Flow attributes synced from C structure on update: counters, statistics (stddev ones are derived), dissection
+# texts (synced once detection completed, with C structure names) and splt arrays.
+SYNC_COUNTERS = ['bidirectional_last_seen_ms', 'bidirectional_duration_ms', 'bidirectional_packets',
+                 'bidirectional_bytes', 'src2dst_last_seen_ms', 'src2dst_duration_ms', 'src2dst_packets',
+                 'src2dst_bytes', 'dst2src_first_seen_ms', 'dst2src_last_seen_ms', 'dst2src_duration_ms',
+                 'dst2src_packets', 'dst2src_bytes']
+SYNC_STATISTICS = ['{}_{}_{}'.format(direction, metric, unit) for direction in ['bidirectional', 'src2dst', 'dst2src']
+                   for unit in ['ps', 'piat_ms'] for metric in ['min', 'mean', 'max']] + \
+                  ['{}_{}_packets'.format(direction, flag) for direction in ['bidirectional', 'src2dst', 'dst2src']
+                   for flag in ['syn', 'cwr', 'ece', 'urg', 'ack', 'psh', 'rst', 'fin']]
+SYNC_TEXTS = {'application_name': 'application_name', 'application_category_name': 'category_name',
+              'application_is_guessed': 'guessed', 'requested_server_name': 'requested_server_name',
+              'client_fingerprint': 'c_hash', 'server_fingerprint': 's_hash', 'user_agent': 'user_agent',
+              'content_type': 'content_type'}
+SYNC_SPLT = ['splt_direction', 'splt_ps', 'splt_piat_ms']
+
+
+def sync_plan(fields, n_dissections, statistics, splt):
+    """
+    Update sync plan of plugins declared flow fields, as (counters, stddevs, texts, splt) where stddevs are
+    (field, packets field, n offset). Fields not updated by meter (e.g. flow key) are already synced on creation.
+    """
+    counters = [field for field in fields if field in SYNC_COUNTERS or (statistics and field in SYNC_STATISTICS)]
+    stddevs = []
+    if statistics:
+        for field in fields:
+            if field.endswith('_stddev_ps'):
+                stddevs.append((field, field.replace('_stddev_ps', '_packets'), 1))
+            elif field.endswith('_stddev_piat_ms'):
+                stddevs.append((field, field.replace('_stddev_piat_ms', '_packets'), 2))
+    texts = [(field, SYNC_TEXTS[field]) for field in fields if n_dissections and field in SYNC_TEXTS]
+    return counters, stddevs, texts, bool(splt) and len(set(fields) & set(SYNC_SPLT)) > 0
+
+
+def merge_moments(n_a, mean_a, stddev_a, n_b, mean_b, stddev_b):
+    """ combine mean and sample stddev of two samples """
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = (stddev_a ** 2) * max(n_a - 1, 0) + (stddev_b ** 2) * max(n_b - 1, 0) + (delta ** 2) * n_a * n_b / n
+    if n > 1:
+        return mean, sqrt(m2 / (n - 1))
+    return mean, 0.0
+
+
 class NFlow(object):
     """
         NFlow is NFStream representation of a network flow.
@@ -174,14 +337,44 @@ class NFlow(object):
                  '_C',
                  'udps')
 
-    def __init__(self, packet, ffi, lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector):
+    def __init__(self, packet, ffi, lib, hooks, sync, accounting_mode, n_dissections, statistics, splt, dissector):
         self.id = -1  # id always at -1 and will be handled by NFStreamer side.
         self.expiration_id = 0
         # Initialize C structure.
-        self._C = lib.meter_initialize_flow(packet, accounting_mode, statistics, splt, n_dissections, dissector)
+        self._C = lib.meter_initialize_flow(packet, accounting_mode, statistics, splt, n_dissections, dissector,
+                                            ffi.NULL if hooks is None else hooks.natives)
         if self._C == ffi.NULL:  # raise OSError in order to be handled by meter.
             raise OSError("Not enough memory for new flow creation.")
         # Here we go for the first copy in order to make defined slots available
+        self.init_sync(n_dissections, statistics, splt, ffi)
+        if hooks is not None:  # NFStream running with Plugins
+            self.udps = UDPS()
+            if hooks.on_init:  # on_init entrypoint, packet is pythonized only for plugins overriding it.
+                py_packet = pythonize_packet(packet, ffi) if hooks.packet_copy else NFPacket(packet, ffi)
+                for udp in hooks.on_init:
+                    udp.on_init(py_packet, self)
+            if hooks.batch is not None:  # on_update_batch entrypoint, packets are accumulated across flows.
+                hooks.batch.add(self, packet, ffi)
+
+    @classmethod
+    def from_native(cls, C, hooks, n_dissections, statistics, splt, ffi, lib):
+        """ Build an NFlow from a flow expired by native engine (no interpreter involved until expiration) """
+        flow = cls.__new__(cls)
+        flow.id = -1
+        flow.expiration_id = C.expiration_id
+        flow._C = C
+        flow.init_sync(n_dissections, statistics, splt, ffi)
+        flow.sync(n_dissections, statistics, splt, ffi, lib, False)
+        if hooks is not None:  # Running with NFPlugins without per packet Python entrypoints
+            flow.udps = UDPS()
+            for udp in hooks.on_expire:
+                udp.on_expire(flow)
+        lib.meter_free_flow(flow._C, n_dissections, splt)
+        del flow._C
+        return flow
+
+    def init_sync(self, n_dissections, statistics, splt, ffi):
+        """ NFlow first copy from C structure, called once at creation """
         self.src_ip = ffi.string(self._C.src_ip).decode('utf-8', errors='ignore')
         self.src_ip_is_private = int(ipaddress.ip_address(self.src_ip).is_private)
         self.src_port = self._C.src_port
@@ -268,36 +461,40 @@ class NFlow(object):
             self.splt_direction = ffi.unpack(self._C.splt_direction, splt)
             self.splt_ps = ffi.unpack(self._C.splt_ps, splt)
             self.splt_piat_ms = ffi.unpack(self._C.splt_piat_ms, splt)
-        if sync:  # NFStream running with Plugins
-            self.udps = UDPS()
-            for udp in udps:  # on_init entrypoint
-                udp.on_init(pythonize_packet(packet, ffi), self)
 
-    def update(self, packet, idle_timeout, active_timeout, ffi, lib, udps, sync, accounting_mode,
+    def update(self, packet, idle_timeout, active_timeout, ffi, lib, hooks, sync, accounting_mode,
                n_dissections, statistics, splt, dissector):
         """ NFlow update method """
         # First, we update internal C structure.
         ret = lib.meter_update_flow(self._C, packet, idle_timeout, active_timeout, accounting_mode, statistics, splt,
-                                    n_dissections, dissector)
+                                    n_dissections, dissector, ffi.NULL if hooks is None else hooks.natives)
         if ret > 0:  # If update done it will be zero, idle and active are matched to 1 and 2.
             self.expiration_id = ret - 1
-            return self.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector)  # expire it.
-        if sync:  # If running with Plugins
-            self.sync(n_dissections, statistics, splt, ffi, lib, sync)
+            return self.expire(hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector)  # expire it.
+        if hooks is not None and hooks.batch is not None:  # Running with on_update_batch Plugins
+            hooks.batch.add(self, packet, ffi)
+        if sync:  # If running with Plugins overriding on_update
+            if hooks.fields is None:
+                self.sync(n_dissections, statistics, splt, ffi, lib, sync)
+            else:  # Plugins declared flow fields they read: others will be synced at expiration.
+                self.sync_fields(hooks.fields, splt, ffi, lib)
             # We need to copy computed values on C struct.
-            for udp in udps:  # Then call each plugin on_update entrypoint.
-                udp.on_update(pythonize_packet(packet, ffi), self)
+            py_packet = pythonize_packet(packet, ffi) if hooks.packet_copy else NFPacket(packet, ffi)
+            for udp in hooks.on_update:  # Then call each plugin on_update entrypoint.
+                udp.on_update(py_packet, self)
             if self.expiration_id == -1: # One of the plugins set expiration to custom value (-1)
-                return self.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector)  # Expire it.
+                return self.expire(hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector)  # Expire it.
 
-    def expire(self, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector):
+    def expire(self, hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector):
         """ NFlow expiration method """
         # Call expiration of C structure.
-        lib.meter_expire_flow(self._C, n_dissections, dissector)
-        # Then sync (second copy in case of non sync mode)
-        self.sync(n_dissections, statistics, splt, ffi, lib, sync)
-        if sync:  # Running with NFPlugins
-            for udp in udps:
+        lib.meter_expire_flow(self._C, n_dissections, dissector, ffi.NULL if hooks is None else hooks.natives)
+        # Then sync (second copy in case of non sync mode or splt not synced on update)
+        self.sync(n_dissections, statistics, splt, ffi, lib, sync and (hooks.fields is None or hooks.fields[3]))
+        if hooks is not None:  # Running with NFPlugins
+            if hooks.batch is not None:  # Flow pending packets are delivered first.
+                hooks.batch.expire(self)
+            for udp in hooks.on_expire:
                 udp.on_expire(self)  # Call each Plugin on_expire entrypoint
         lib.meter_free_flow(self._C, n_dissections, splt)  # then free C struct
         del self._C  # and remove it from NFlow slots.
@@ -306,8 +503,8 @@ class NFlow(object):
     def sync(self, n_dissections, statistics, splt, ffi, lib, sync_mode):
         """
         NFlow synchronizer method
-           Will be called only twice when running without Plugins
-           Will be called at each update when running with Plugins
+           Will be called only twice when running without Plugins overriding on_update
+           Will be called at each update when running with Plugins overriding on_update
         """
         self.bidirectional_last_seen_ms = self._C.bidirectional_last_seen_ms
         self.bidirectional_duration_ms = self._C.bidirectional_duration_ms
@@ -394,23 +591,123 @@ class NFlow(object):
                 self.application_is_guessed = self._C.guessed
         if splt:
             if sync_mode: # Same for splt, once we reach splt limit, there is no need to sync it anymore.
-                if self._C.bidirectional_packets <= splt:
-                    self.splt_direction = ffi.unpack(self._C.splt_direction, splt)
-                    self.splt_ps = ffi.unpack(self._C.splt_ps, splt)
-                    self.splt_piat_ms = ffi.unpack(self._C.splt_piat_ms, splt)
-                else:
-                    if self._C.splt_closed == 0:  # we also release the memory to keep only the obtained list.
-                        lib.free_splt_data(self._C)
+                self.sync_splt(splt, ffi, lib)
             else:
                 self.splt_direction = ffi.unpack(self._C.splt_direction, splt)
                 self.splt_ps = ffi.unpack(self._C.splt_ps, splt)
                 self.splt_piat_ms = ffi.unpack(self._C.splt_piat_ms, splt)
                 # Memory will be released by freer.
 
+    def sync_splt(self, splt, ffi, lib):
+        """ NFlow splt synchronizer on update: arrays are copied until splt limit, then C memory is released """
+        if self._C.bidirectional_packets <= splt:
+            self.splt_direction = ffi.unpack(self._C.splt_direction, splt)
+            self.splt_ps = ffi.unpack(self._C.splt_ps, splt)
+            self.splt_piat_ms = ffi.unpack(self._C.splt_piat_ms, splt)
+        else:
+            if self._C.splt_closed == 0:  # we also release the memory to keep only the obtained list.
+                lib.free_splt_data(self._C)
+
+    def sync_fields(self, plan, splt, ffi, lib):
+        """ NFlow partial synchronizer: only fields declared by plugins are synced on update (see sync_plan) """
+        counters, stddevs, texts, splt_sync = plan
+        for field in counters:
+            setattr(self, field, getattr(self._C, field))
+        for field, packets_field, offset in stddevs:
+            packets = getattr(self._C, packets_field)
+            if packets > offset:
+                setattr(self, field, sqrt(getattr(self._C, field) / (packets - offset)))
+        if texts and self._C.detection_completed == 1:
+            for field, c_field in texts:
+                if field == 'application_is_guessed':
+                    self.application_is_guessed = self._C.guessed
+                else:
+                    setattr(self, field, ffi.string(getattr(self._C, c_field)).decode('utf-8', errors='ignore'))
+        if splt_sync:
+            self.sync_splt(splt, ffi, lib)
+
+    def merge(self, other, statistics, splt):
+        """ NFlow merge method: append other NFlow, the same flow observed right after this one """
+        reverse = (other.src_ip, other.src_port) != (self.src_ip, self.src_port)
+        directions = [('bidirectional', 'bidirectional')]
+        if reverse:
+            directions += [('src2dst', 'dst2src'), ('dst2src', 'src2dst')]
+        else:
+            directions += [('src2dst', 'src2dst'), ('dst2src', 'dst2src')]
+        if splt and self.bidirectional_packets < splt:  # SPLT is completed with other first packets.
+            self.splt_direction, self.splt_ps = list(self.splt_direction), list(self.splt_ps)
+            self.splt_piat_ms = list(self.splt_piat_ms)
+            for i in range(splt - self.bidirectional_packets):
+                if other.splt_direction[i] < 0:
+                    break
+                idx = self.bidirectional_packets + i
+                self.splt_direction[idx] = 1 - other.splt_direction[i] if reverse else other.splt_direction[i]
+                self.splt_ps[idx] = other.splt_ps[i]
+                if i == 0:
+                    self.splt_piat_ms[idx] = other.bidirectional_first_seen_ms - self.bidirectional_last_seen_ms
+                else:
+                    self.splt_piat_ms[idx] = other.splt_piat_ms[i]
+        for direction, other_direction in directions:
+            n_a = getattr(self, direction + '_packets')
+            n_b = getattr(other, other_direction + '_packets')
+            if n_b == 0:
+                continue
+            fields = ['_first_seen_ms', '_last_seen_ms', '_duration_ms', '_packets', '_bytes']
+            if statistics:
+                fields += ['_min_ps', '_mean_ps', '_stddev_ps', '_max_ps', '_min_piat_ms', '_mean_piat_ms',
+                           '_stddev_piat_ms', '_max_piat_ms', '_syn_packets', '_cwr_packets', '_ece_packets',
+                           '_urg_packets', '_ack_packets', '_psh_packets', '_rst_packets', '_fin_packets']
+            if n_a == 0:  # Direction only observed on other.
+                for field in fields:
+                    setattr(self, direction + field, getattr(other, other_direction + field))
+                continue
+            a = {field: getattr(self, direction + field) for field in fields}
+            b = {field: getattr(other, other_direction + field) for field in fields}
+            gap = b['_first_seen_ms'] - a['_last_seen_ms']
+            if statistics:
+                mean, stddev = merge_moments(n_a, a['_mean_ps'], a['_stddev_ps'], n_b, b['_mean_ps'], b['_stddev_ps'])
+                setattr(self, direction + '_min_ps', min(a['_min_ps'], b['_min_ps']))
+                setattr(self, direction + '_mean_ps', mean)
+                setattr(self, direction + '_stddev_ps', stddev)
+                setattr(self, direction + '_max_ps', max(a['_max_ps'], b['_max_ps']))
+                # Inter arrival times: both sides samples and the one between them.
+                samples = [(n_a - 1, a['_mean_piat_ms'], a['_stddev_piat_ms'], a['_min_piat_ms'], a['_max_piat_ms']),
+                           (1, float(gap), 0.0, gap, gap),
+                           (n_b - 1, b['_mean_piat_ms'], b['_stddev_piat_ms'], b['_min_piat_ms'], b['_max_piat_ms'])]
+                samples = [sample for sample in samples if sample[0] > 0]
+                n, mean, stddev = samples[0][:3]
+                for sample in samples[1:]:
+                    mean, stddev = merge_moments(n, mean, stddev, sample[0], sample[1], sample[2])
+                    n += sample[0]
+                setattr(self, direction + '_min_piat_ms', min(sample[3] for sample in samples))
+                setattr(self, direction + '_mean_piat_ms', mean)
+                setattr(self, direction + '_stddev_piat_ms', stddev)
+                setattr(self, direction + '_max_piat_ms', max(sample[4] for sample in samples))
+                for flag in ['_syn_packets', '_cwr_packets', '_ece_packets', '_urg_packets', '_ack_packets',
+                             '_psh_packets', '_rst_packets', '_fin_packets']:
+                    setattr(self, direction + flag, a[flag] + b[flag])
+            setattr(self, direction + '_last_seen_ms', b['_last_seen_ms'])
+            setattr(self, direction + '_duration_ms', b['_last_seen_ms'] - a['_first_seen_ms'])
+            setattr(self, direction + '_packets', n_a + n_b)
+            setattr(self, direction + '_bytes', a['_bytes'] + b['_bytes'])
+        self.expiration_id = other.expiration_id
+        return self
+
     def is_idle(self, tick, idle_timeout):
         """ is_idle method to check if NFlow is idle accoring to configured timeout """
         return (tick - idle_timeout) >= self._C.bidirectional_last_seen_ms
 
+    def deadline(self, idle_timeout, active_timeout):
+        """ deadline method returns the earliest time NFlow can expire (idle or active) """
+        return min(self._C.bidirectional_last_seen_ms + idle_timeout,
+                   self._C.bidirectional_first_seen_ms + active_timeout)
+
+    def expiration_reason(self, idle_timeout, active_timeout):
+        """ expiration_reason method returns the earliest deadline reason (0 for idle, 1 for active) """
+        if self._C.bidirectional_last_seen_ms + idle_timeout <= self._C.bidirectional_first_seen_ms + active_timeout:
+            return 0
+        return 1
+
     def __str__(self):
         """ String representation of NFlow """
         started = False
@@ -463,3 +760,145 @@ class NFlow(object):
             except AttributeError:
                 pass
         return ret
+
+
+class NFRecord(object):
+    """
+        NFRecord is the fixed layout binary record of an expired NFlow, as shipped from meters to streamer.
+        Layout only depends on streamer configuration: numeric slots and text slots lengths are packed in a fixed
+        header, followed by text slots content and, when running with plugins, pickled udps values.
+    """
+    __slots__ = ('header', 'fields', 'numerics', 'texts', 'splt', 'udps')
+
+    def __init__(self, n_dissections, statistics, splt, udps):
+        self.numerics = ['expiration_id', 'src_ip_is_private', 'src_port', 'dst_ip_is_private', 'dst_port',
+                         'protocol', 'ip_version', 'vlan_id']
+        for direction in ['bidirectional', 'src2dst', 'dst2src']:
+            self.numerics += [direction + '_first_seen_ms', direction + '_last_seen_ms', direction + '_duration_ms',
+                              direction + '_packets', direction + '_bytes']
+        codes = 'q' * len(self.numerics)
+        if statistics:
+            for suffix in ['_ps', '_piat_ms']:
+                for direction in ['bidirectional', 'src2dst', 'dst2src']:
+                    self.numerics += [direction + '_min' + suffix, direction + '_mean' + suffix,
+                                      direction + '_stddev' + suffix, direction + '_max' + suffix]
+                    codes += 'qddq'
+            for direction in ['bidirectional', 'src2dst', 'dst2src']:
+                for flag in ['syn', 'cwr', 'ece', 'urg', 'ack', 'psh', 'rst', 'fin']:
+                    self.numerics.append(direction + '_' + flag + '_packets')
+                    codes += 'q'
+        self.texts = ['src_ip', 'dst_ip']
+        if n_dissections:
+            self.numerics.append('application_is_guessed')
+            codes += 'q'
+            self.texts += ['application_name', 'application_category_name', 'requested_server_name',
+                           'client_fingerprint', 'server_fingerprint', 'user_agent', 'content_type']
+        self.splt = splt
+        codes += '{}b{}i{}q'.format(splt, splt, splt) if splt else ''
+        self.udps = udps
+        # Record size, numeric slots, splt values, text slots lengths and udps content length.
+        self.header = struct.Struct('<I' + codes + 'H' * len(self.texts) + ('I' if udps else ''))
+        # Same header as a numpy structured type, records headers are then decoded as columns.
+        self.fields = [('size', '<u4')] + [(name, '<' + code) for name, code in zip(self.numerics, codes)]
+        if splt:
+            self.fields += [('splt_direction', '<i1', (splt,)), ('splt_ps', '<i4', (splt,)),
+                            ('splt_piat_ms', '<i8', (splt,))]
+        self.fields += [(name + '_length', '<u2') for name in self.texts] + ([('udps_length', '<u4')] if udps else [])
+
+    def pack(self, flow):
+        """ Pack NFlow as a binary record, raise ValueError if a slot does not fit the layout """
+        try:
+            values = [getattr(flow, name) for name in self.numerics]
+            if self.splt:
+                values += flow.splt_direction
+                values += flow.splt_ps
+                values += flow.splt_piat_ms
+            contents = [getattr(flow, name).encode('utf-8') for name in self.texts]
+            values += [len(content) for content in contents]
+            if self.udps:
+                contents.append(pickle.dumps(flow.udps.__dict__, protocol=pickle.HIGHEST_PROTOCOL))
+                values.append(len(contents[-1]))
+            size = self.header.size + sum([len(content) for content in contents])
+            return self.header.pack(size, *values) + b''.join(contents)
+        except (AttributeError, TypeError, struct.error) as pack_error:  # Slot altered by a plugin.
+            raise ValueError(pack_error)
+
+    def unpack(self, record, offset=0):
+        """ Build an NFlow from binary record at offset """
+        values = self.header.unpack_from(record, offset)
+        flow = NFlow.__new__(NFlow)
+        flow.id = -1
+        idx = 1
+        for name in self.numerics:
+            setattr(flow, name, values[idx])
+            idx += 1
+        if self.splt:
+            flow.splt_direction = list(values[idx:idx + self.splt])
+            flow.splt_ps = list(values[idx + self.splt:idx + 2 * self.splt])
+            flow.splt_piat_ms = list(values[idx + 2 * self.splt:idx + 3 * self.splt])
+            idx += 3 * self.splt
+        offset += self.header.size
+        for name in self.texts:
+            setattr(flow, name, record[offset:offset + values[idx]].decode('utf-8'))
+            offset += values[idx]
+            idx += 1
+        if self.udps:
+            flow.udps = UDPS()
+            flow.udps.__dict__.update(pickle.loads(record[offset:offset + values[idx]]))
+        return flow
+
+    def keys(self, udps_keys):
+        """ Records columns names, ordered as NFlow keys """
+        keys = []
+        for name in NFlow.__slots__:
+            if name == 'id' or name in self.numerics or name in self.texts or \
+                    (self.splt and name.startswith('splt_')):
+                keys.append(name)
+            elif name == 'udps' and self.udps:
+                keys += ['udps.' + udps_key for udps_key in udps_keys]
+        return keys
+
+    def offsets(self, records):
+        """ Offsets of consecutive binary records """
+        offsets = []
+        offset = 0
+        while offset < len(records):
+            offsets.append(offset)
+            offset += struct.unpack_from('<I', records, offset)[0]
+        return offsets
+
+    def columns(self, records, offsets):
+        """
+            Decode consecutive binary records as columns without building NFlow: numeric and splt slots as numpy
+            arrays, text slots as (value offsets, utf-8 data) arrays and udps as a list of dicts.
+        """
+        content = np.frombuffer(records, dtype=np.uint8)
+        starts = np.asarray(offsets, dtype=np.int64)
+        # Headers are gathered in a single pass then viewed through the structured type.
+        headers = content[starts[:, None] + np.arange(self.header.size)].view(np.dtype(self.fields))[:, 0]
+        columns = {}
+        for name in self.numerics:
+            columns[name] = headers[name]
+        if self.splt:
+            for name in ['splt_direction', 'splt_ps', 'splt_piat_ms']:
+                columns[name] = headers[name]
+        starts = starts + self.header.size
+        for name in self.texts:
+            lengths = headers[name + '_length'].astype(np.int64)
+            value_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=value_offsets[1:])
+            # Each byte index is its record text start shifted by its position in the text.
+            data = content[np.repeat(starts - value_offsets[:-1], lengths) + np.arange(value_offsets[-1])]
+            columns[name] = (value_offsets.astype(np.int32), data)
+            starts = starts + lengths
+        if self.udps:
+            columns['udps'] = [pickle.loads(records[start:start + length])
+                               for start, length in zip(starts.tolist(), headers['udps_length'].tolist())]
+        return columns
+
+    def unpack_all(self, records):
+        """ NFlow generator over consecutive binary records, flows are built on demand """
+        offset = 0
+        while offset < len(records):
+            yield self.unpack(records, offset)
+            offset += struct.unpack_from('<I', records, offset)[0]
@@ -17,9 +17,13 @@ If not, see <http://www.gnu.org/licenses/>.
 """
 
 from collections import OrderedDict
+import multiprocessing as mp
+import time as tm
 from .context import create_context
-from .flow import NFlow
-from .utils import set_affinity
+from .flow import NFlow, NFRecord, sync_plan
+from .plugin import NFHooks
+from .utils import set_affinity, anonymizer, anonymize_batch, csv_converter, csv_rows, arrow_batch, NFParquetSink, pa
+from .utils import open_file
 
 
 class NFCache(OrderedDict):
@@ -37,46 +41,262 @@ class NFCache(OrderedDict):
     def __eq__(self, other):
         return super().__eq__(other)
 
-    def get_lru_key(self):
-        return next(iter(self))
 
+class NFWheel(object):
+    """ Hierarchical timing wheel: 64 slots per level and 1 msec resolution on first level """
+    __slots__ = ('tick', 'levels')
 
-def meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections, statistics, splt, ffi, lib,
-               dissector):
-    remaining = True  # We suppose that there is something to expire
-    scanned = 0
-    while remaining and scanned < 1000:  # idle scan budget (each 10ms we scan 1000 as maximum)
-        try:
-            flow_key = cache.get_lru_key()  # will return the LRU flow key.
-            flow = cache[flow_key]
-            if flow.is_idle(meter_tick, idle_timeout):  # idle, expire it.
-                channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
-                del cache[flow_key]
-                del flow
-                scanned += 1
+    def __init__(self, n_levels=11):  # 11 levels cover all 64 bits deadlines.
+        self.tick = 0
+        self.levels = [[[] for _ in range(64)] for _ in range(n_levels)]
+
+    def schedule(self, deadline, entry):
+        """ Schedule entry at deadline, already reached deadlines are scheduled on next tick """
+        slot_deadline = max(deadline, self.tick + 1)
+        level = min(((slot_deadline - self.tick).bit_length() - 1) // 6, len(self.levels) - 1)
+        self.levels[level][(slot_deadline >> (6 * level)) & 63].append((deadline, entry))
+
+    def advance(self, tick):
+        """ Advance wheel to tick and return entries which deadline is reached """
+        popped = []
+        shift = 0
+        for slots in self.levels:  # A level is crossed only if its upper one changed.
+            old_idx, new_idx = self.tick >> shift, tick >> shift
+            if new_idx == old_idx:
+                break
+            for idx in range(old_idx + 1, min(new_idx, old_idx + 64) + 1):
+                slot = slots[idx & 63]
+                if slot:
+                    popped.extend(slot)
+                    slot.clear()
+            shift += 6
+        self.tick = tick
+        due = []
+        for deadline, entry in popped:
+            if deadline > tick:  # Cascade to a lower level.
+                self.schedule(deadline, entry)
             else:
-                remaining = False  # LRU flow is not yet idle.
-        except StopIteration:  # Empty cache
-            remaining = False
-    return scanned
+                due.append(entry)
+        return due
+
+
+class NFRing(object):
+    """ Shared memory ring of flow records: written by a single meter, read by streamer """
+    __slots__ = ('buffer', 'size', 'tail')
+
+    def __init__(self, size=1048576):
+        self.buffer = mp.RawArray('B', size)
+        self.size = size
+        self.tail = mp.RawValue('Q', 0)  # Bytes released by streamer, meter keeps its own head.
+
+    def write(self, head, records):
+        """ Copy records at head position, wrapping around ring end """
+        view = memoryview(self.buffer).cast('B')
+        start = head % self.size
+        first = min(len(records), self.size - start)
+        view[start:start + first] = records[:first]
+        view[:len(records) - first] = records[first:]
+
+    def read(self, n_bytes):
+        """ Copy and release next n_bytes of records """
+        view = memoryview(self.buffer).cast('B')
+        start = self.tail.value % self.size
+        first = min(n_bytes, self.size - start)
+        records = bytes(view[start:start + first]) + bytes(view[:n_bytes - first])
+        self.tail.value += n_bytes
+        return records
+
+
+class NFRingChannel(object):
+    """ Channel proxy packing flows as records in meter ring, only batches hand-off goes through the queue """
+    __slots__ = ('channel', 'ring', 'ring_idx', 'layout', 'batch_size', 'linger', 'head', 'pending', 'n_pending',
+                 'pending_time')
+
+    def __init__(self, channel, ring, ring_idx, layout, batch_size=256, linger=0.1):
+        self.channel = channel
+        self.ring = ring
+        self.ring_idx = ring_idx
+        self.layout = layout
+        self.batch_size = batch_size  # Batches are bounded in count, size and linger time (secs).
+        self.linger = linger
+        self.head = 0
+        self.pending = bytearray()
+        self.n_pending = 0
+        self.pending_time = 0
+
+    def put(self, flow):
+        if flow is None:  # termination
+            self.flush()
+            self.channel.put(None)
+            return
+        try:
+            record = self.layout.pack(flow)
+        except ValueError:
+            record = None
+        if record is None or len(record) > self.ring.size // 4:  # Shipped as is, after pending ones to keep order.
+            self.flush()
+            self.channel.put((self.ring_idx, flow))
+            return
+        if self.n_pending == 0:
+            self.pending_time = tm.monotonic()
+        self.pending += record
+        self.n_pending += 1
+        if self.n_pending >= self.batch_size or len(self.pending) > self.ring.size // 4:
+            self.flush()
+
+    def flush_lingering(self):
+        """ Hand off pending records once the oldest one lingered for linger time """
+        if self.n_pending and tm.monotonic() - self.pending_time >= self.linger:
+            self.flush()
+
+    def flush(self):
+        """ Hand off pending records to streamer """
+        if self.n_pending == 0:
+            return
+        n_bytes = len(self.pending)
+        while self.ring.size - (self.head - self.ring.tail.value) < n_bytes:  # Backpressure: streamer lags behind.
+            tm.sleep(0.001)
+        self.ring.write(self.head, self.pending)
+        self.head += n_bytes
+        self.channel.put((self.ring_idx, n_bytes))
+        self.pending = bytearray()
+        self.n_pending = 0
+
+
+class NFShardChannel(object):
+    """ Channel proxy writing flows to meter own shard file (sink mode), only flows counts go through the queue """
+    __slots__ = ('channel', 'shard_idx', 'layout', 'sink_format', 'path', 'anonymize', 'compression', 'parquet', 'f',
+                 'batch_size', 'linger', 'pending', 'offsets', 'pending_time', 'n_flows')
+
+    def __init__(self, channel, shard_idx, layout, sink_format, path, anonymization, compression, row_group_size,
+                 batch_size=4096, linger=1.0):
+        self.channel = channel
+        self.shard_idx = shard_idx
+        self.layout = layout
+        self.sink_format = sink_format
+        self.path = path  # Shard file is created with its first flow.
+        # Anonymization: (crypto key, prefix preserving) shared by all meters.
+        self.anonymize = anonymizer(*anonymization) if anonymization is not None else None
+        self.compression = compression
+        self.parquet = NFParquetSink(path, None, compression, row_group_size) if sink_format == 'parquet' else None
+        self.f = None
+        self.batch_size = batch_size
+        self.linger = linger
+        self.pending = bytearray()
+        self.offsets = []
+        self.pending_time = 0
+        self.n_flows = 0
+
+    def put(self, flow):
+        if flow is None:  # termination: shard is closed and its flows count reported.
+            self.flush()
+            if self.f is not None:
+                self.f.close()
+            if self.parquet is not None:
+                self.parquet.close()
+            self.channel.put(None)
+            return
+        if self.sink_format == 'binary' and self.anonymize is not None:  # Records are written as is.
+            flow.src_ip, flow.dst_ip = self.anonymize(flow.src_ip), self.anonymize(flow.dst_ip)
+        try:
+            record = self.layout.pack(flow)
+        except ValueError:
+            record = None
+        if record is None:  # Written on its own, after pending ones to keep order.
+            self.flush()
+            if self.sink_format != 'csv':
+                self.channel.put((self.shard_idx, "Flow attributes altered by plugins cannot be exported as {}, "
+                                                  "please use udps to store plugins values.".format(
+                                                      'Arrow' if self.sink_format == 'parquet' else 'binary records')))
+                return
+            flow.id = self.n_flows
+            keys, values = flow.keys(), flow.values()
+            if self.anonymize is not None:
+                for ip_index in [keys.index("src_ip"), keys.index("dst_ip")]:
+                    values[ip_index] = self.anonymize(values[ip_index])
+            csv_converter(values)
+            self.write_csv(keys, [','.join([str(i) for i in values])])
+            self.channel.put((self.shard_idx, 1))
+            return
+        if not self.offsets:
+            self.pending_time = tm.monotonic()
+        self.offsets.append(len(self.pending))
+        self.pending += record
+        if len(self.offsets) >= self.batch_size:
+            self.flush()
+
+    def write_csv(self, keys, rows):
+        """ Write CSV rows, header is written with first ones """
+        if self.f is None:
+            self.f = open_file(self.path, False, 0, self.compression)
+            self.f.write((','.join([str(i) for i in keys]) + "\n").encode('utf-8'))
+        self.f.write(('\n'.join(rows) + "\n").encode('utf-8'))
+        self.n_flows += len(rows)
+
+    def flush_lingering(self):
+        """ Write pending records once the oldest one lingered for linger time """
+        if self.offsets and tm.monotonic() - self.pending_time >= self.linger:
+            self.flush()
+
+    def flush(self):
+        """ Write pending records to shard and report their count to streamer """
+        if not self.offsets:
+            return
+        n_records = len(self.offsets)
+        if self.sink_format == 'csv':
+            self.write_csv(*csv_rows(self.layout, self.pending, self.offsets, self.n_flows, self.anonymize))
+        elif self.sink_format == 'binary':  # Consecutive records, as shipped through meter ring.
+            if self.f is None:
+                self.f = open_file(self.path, False, 0, self.compression)
+            self.f.write(self.pending)
+            self.n_flows += n_records
+        else:
+            batch = arrow_batch(self.layout, self.pending, self.offsets, self.n_flows)
+            if self.anonymize is not None:
+                for name in ['src_ip', 'dst_ip']:
+                    idx = batch.schema.get_field_index(name)
+                    batch = batch.set_column(idx, name, pa.array(anonymize_batch(self.anonymize,
+                                                                                 batch.column(idx).to_pylist())))
+            self.parquet.write(batch)
+            self.n_flows += n_records
+        self.channel.put((self.shard_idx, n_records))
+        self.pending = bytearray()
+        self.offsets = []
+
+
+def meter_scan(meter_tick, cache, wheel, idle_timeout, active_timeout, channel, hooks, sync, n_dissections, statistics,
+               splt, ffi, lib, dissector):
+    """ Expire flows which deadline is reached, work is proportional to due flows """
+    expired = 0
+    for flow_key, flow in wheel.advance(meter_tick):
+        if cache.get(flow_key) is not flow:  # Flow already expired on update or by a plugin.
+            continue
+        deadline = flow.deadline(idle_timeout, active_timeout)
+        if deadline > meter_tick:  # Flow updated since scheduling, we reschedule it lazily on its actual deadline.
+            wheel.schedule(deadline, (flow_key, flow))
+            continue
+        # Idle or active timeout reached (even without new packets), earliest one gives expiration reason.
+        flow.expiration_id = flow.expiration_reason(idle_timeout, active_timeout)
+        channel.put(flow.expire(hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+        del cache[flow_key]
+        del flow
+        expired += 1
+    channel.flush_lingering()  # Export latency is bounded even when no flow expires for a while.
+    return expired
 
 
 def get_flow_key(packet, ffi):
-    """ Create flow key from packet information (6-tuple) """
-    src_ip = ffi.string(packet.src_name).decode('utf-8', errors='ignore')
-    dst_ip = ffi.string(packet.dst_name).decode('utf-8', errors='ignore')
-    return packet.protocol, packet.vlan_id, \
-           min(src_ip, dst_ip), max(src_ip, dst_ip),\
-           min(packet.src_port, packet.dst_port), max(packet.src_port, packet.dst_port)
+    """ Get flow key from packet: canonical symmetric binary key packed by observer """
+    return ffi.buffer(packet.flow_key)[:]
 
 
-def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps, sync, accounting_mode, n_dissections,
-            statistics, splt, dissector):
+def consume(packet, cache, wheel, active_timeout, idle_timeout, channel, ffi, lib, hooks, sync, accounting_mode,
+            n_dissections, statistics, splt, dissector):
     """ consume a packet and produce flow """
     # We maintain state for active flows computation 1 for creation, 0 for update/cut, -1 for custom expire
     flow_key = get_flow_key(packet, ffi)
     try:  # update flow
-        flow = cache[flow_key].update(packet, idle_timeout, active_timeout, ffi, lib, udps, sync, accounting_mode,
+        flow = cache[flow_key].update(packet, idle_timeout, active_timeout, ffi, lib, hooks, sync, accounting_mode,
                                       n_dissections, statistics, splt, dissector)
         if flow is not None:
             if flow.expiration_id < 0:  # custom expiration
@@ -89,8 +309,10 @@ def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps
                 del cache[flow_key]
                 del flow
                 try:
-                    cache[flow_key] = NFlow(packet, ffi, lib, udps, sync, accounting_mode, n_dissections,
-                                            statistics, splt, dissector)
+                    flow = NFlow(packet, ffi, lib, hooks, sync, accounting_mode, n_dissections, statistics, splt,
+                                 dissector)
+                    cache[flow_key] = flow
+                    wheel.schedule(flow.deadline(idle_timeout, active_timeout), (flow_key, flow))
                 except OSError:
                     print("WARNING: Failed to allocate memory space for flow creation. Flow creation aborted.")
                 state = 0
@@ -98,18 +320,20 @@ def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps
             state = 0
     except KeyError:  # create flow
         try:
-            if sync:
-                flow = NFlow(packet, ffi, lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector)
+            if hooks is not None:
+                flow = NFlow(packet, ffi, lib, hooks, sync, accounting_mode, n_dissections, statistics, splt, dissector)
                 if flow.expiration_id == -1:  # A user Plugin forced expiration on the first packet
-                    channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+                    channel.put(flow.expire(hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector))
                     del flow
                     state = 0
                 else:
                     cache[flow_key] = flow
+                    wheel.schedule(flow.deadline(idle_timeout, active_timeout), (flow_key, flow))
                     state = 1
             else:
-                cache[flow_key] = NFlow(packet, ffi, lib, udps, sync, accounting_mode, n_dissections, statistics, splt,
-                                        dissector)
+                flow = NFlow(packet, ffi, lib, hooks, sync, accounting_mode, n_dissections, statistics, splt, dissector)
+                cache[flow_key] = flow
+                wheel.schedule(flow.deadline(idle_timeout, active_timeout), (flow_key, flow))
                 state = 1
         except OSError:
             print("WARNING: Failed to allocate memory space for flow creation. Flow creation aborted.")
@@ -117,12 +341,12 @@ def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps
     return state
 
 
-def meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector):
+def meter_cleanup(cache, channel, hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector):
     """ cleanup all entries in NFCache """
     for flow_key in list(cache.keys()):
         flow = cache[flow_key]
         # Push it on channel.
-        channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+        channel.put(flow.expire(hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector))
         del cache[flow_key]
         del flow
 
@@ -146,17 +370,40 @@ def setup_dissector(ffi, lib, n_dissections):
     return dissector
 
 
-def setup_observer(ffi, lib, root_idx, source, snaplen, promisc, mode, bpf_filter):
+def setup_observer(ffi, lib, root_idx, source, snaplen, promisc, mode, bpf_filter, fanout_mode, fanout_defrag,
+                   fanout_group_id, buffer_size, immediate_mode, poll_timeout, start_time, end_time, source_range):
     """ Setup observer options """
+    if isinstance(source, list):  # Capture files merged into a single time ordered source.
+        observers = []
+        for idx, path in enumerate(source):
+            observer = setup_observer(ffi, lib, root_idx, path, snaplen, promisc, mode, bpf_filter, fanout_mode,
+                                      fanout_defrag, fanout_group_id, buffer_size, immediate_mode, poll_timeout,
+                                      start_time, end_time, None if source_range is None else source_range[idx])
+            if observer is None:
+                for opened in observers:
+                    lib.observer_close(opened)
+                return
+            observers.append(observer)
+        observer = lib.observer_merge(ffi.new("struct nf_observer *[]", observers), len(observers))
+        if observer == ffi.NULL:
+            return
+        return observer
     observer = lib.observer_open(bytes(source, 'utf-8'), mode, root_idx)
     if observer == ffi.NULL:
         return
-    fanout_set_failed = lib.observer_set_fanout(observer, mode, root_idx)
+    fanout_set_failed = lib.observer_set_fanout(observer, mode, root_idx, fanout_mode, int(fanout_defrag),
+                                                fanout_group_id)
     if fanout_set_failed:
         return
-    timeout_set_failed = lib.observer_set_timeout(observer, mode, root_idx)
+    timeout_set_failed = lib.observer_set_timeout(observer, mode, root_idx, poll_timeout)
     if timeout_set_failed:
         return
+    buffer_size_set_failed = lib.observer_set_buffer_size(observer, mode, root_idx, buffer_size)
+    if buffer_size_set_failed:
+        return
+    immediate_mode_set_failed = lib.observer_set_immediate_mode(observer, mode, root_idx, int(immediate_mode))
+    if immediate_mode_set_failed:
+        return
     promisc_set_failed = lib.observer_set_promisc(observer, mode, root_idx, int(promisc))
     if promisc_set_failed:
         return
@@ -167,9 +414,133 @@ def setup_observer(ffi, lib, root_idx, source, snaplen, promisc, mode, bpf_filte
         filter_set_failed = lib.observer_set_filter(observer, bytes(bpf_filter, 'utf-8'), root_idx)
         if filter_set_failed:
             return
+    lib.observer_set_window(observer, start_time, end_time)
+    if source_range is not None:  # Offsets (and pcapng header blocks to replay) resolved from source index.
+        start_offset, end_offset, headers = source_range
+        seek_failed = lib.observer_seek(observer, root_idx, start_offset, end_offset,
+                                        ffi.new("uint64_t[]", headers), len(headers))
+        if seek_failed:
+            return
     return observer
 
 
+def index_source(source, interval):
+    """ Walk offline source and return its pcapng header blocks offsets and time marks (None if not indexable) """
+    ffi, lib = create_context()
+    observer = lib.observer_open(bytes(source, 'utf-8'), 0, 0)
+    if observer == ffi.NULL:
+        ffi.dlclose(lib)
+        return None
+    headers, marks = [], []
+    buffer = ffi.new("struct nf_mark[]", 4096)
+    n_marks = lib.observer_index(observer, buffer, 4096, interval)
+    while n_marks > 0:
+        for i in range(n_marks):
+            if buffer[i].header:
+                headers.append(buffer[i].offset)
+            else:
+                marks.append([buffer[i].time, buffer[i].offset])
+        n_marks = lib.observer_index(observer, buffer, 4096, interval)
+    lib.observer_close(observer)
+    ffi.dlclose(lib)
+    if n_marks < 0:  # Source not mapped (unsupported format)
+        return None
+    return headers, marks
+
+
+def observer_batches(ffi, lib, observer, decode_tunnels, n_roots, root_idx, mode, hash_mode):
+    """ Batches generator reading observer: one native call and no allocation per packet """
+    buffer_size = lib.observer_snapshot(observer)
+    batch_size = max(1, min(256, 4194304 // buffer_size))  # We bound batch content buffers to 4MB.
+    nf_packets = ffi.new("struct nf_packet[]", batch_size)
+    nf_rets = ffi.new("int[]", batch_size)
+    buffers = ffi.new("uint8_t[]", batch_size * buffer_size)
+    while True:
+        n_packets = lib.observer_next_batch(observer, nf_packets, nf_rets, buffers, buffer_size, batch_size,
+                                            decode_tunnels, n_roots, root_idx, mode, hash_mode)
+        yield n_packets, nf_packets, nf_rets
+        if n_packets == -2:  # End of file
+            return
+
+
+def reader_batches(ffi, lib, packets_channel):
+    """ Batches generator consuming packets dispatched by the single pass reader """
+    packet_size = ffi.sizeof("struct nf_packet")
+    ticker = ffi.new("struct nf_packet[]", 1)
+    ticker_ret = ffi.new("int[]", [2])
+    while True:
+        batch = packets_channel.get()
+        if batch is None:  # Reader reached end of file
+            yield -2, ticker, ticker_ret
+            return
+        watermark, headers, contents = batch
+        n_packets = len(headers) // packet_size
+        if n_packets:
+            # Packets are rebased and updated in place: they must be wrapped from a writable buffer owned by meter.
+            if not isinstance(headers, bytearray):
+                headers = bytearray(headers)
+            nf_packets = ffi.from_buffer("struct nf_packet[]", headers, require_writable=True)
+            # Rebase content pointers on received buffer.
+            lib.observer_rebase(nf_packets, n_packets, ffi.from_buffer("uint8_t[]", contents))
+            yield n_packets, nf_packets, ffi.new("int[]", [1] * n_packets)
+        ticker[0].time = watermark  # Reader time watermark is used as time ticker.
+        yield 1, ticker, ticker_ret
+
+
+def batch_packets(batches):
+    """ Packets generator flattening batches """
+    for n_packets, nf_packets, nf_rets in batches:
+        if n_packets > 0:
+            for i in range(n_packets):
+                yield nf_rets[i], nf_packets + i
+        else:
+            yield n_packets, None  # Read error, empty buffer or end of file.
+
+
+def reader_flush(channels, watermark, headers, contents):
+    """ Ship pending packets of each meter with the current time watermark """
+    for idx, channel in enumerate(channels):
+        channel.put((watermark, headers[idx], contents[idx]))
+        # Queue serializes asynchronously, buffers are renewed instead of cleared.
+        headers[idx] = bytearray()
+        contents[idx] = bytearray()
+
+
+def reader_workflow(source, snaplen, decode_tunnels, bpf_filter, promisc, fanout_mode, fanout_defrag, fanout_group_id,
+                    buffer_size, immediate_mode, poll_timeout, start_time, end_time, source_range, n_roots, mode,
+                    hash_mode, channels, batch_size):
+    """ Single pass reader workflow: parse each packet once and dispatch it to its owner meter """
+    ffi, lib = create_context()
+    observer = setup_observer(ffi, lib, 0, source, snaplen, promisc, mode, bpf_filter, fanout_mode, fanout_defrag,
+                              fanout_group_id, buffer_size, immediate_mode, poll_timeout, start_time, end_time,
+                              source_range)
+    if observer is None:
+        ffi.dlclose(lib)
+        for channel in channels:
+            channel.put(None)
+        return
+    headers = [bytearray() for _ in range(n_roots)]
+    contents = [bytearray() for _ in range(n_roots)]
+    watermark, pending = 0, 0
+    # We parse as a single root: hashval is then used to dispatch the packet to its owner.
+    for ret, nf_packet in batch_packets(observer_batches(ffi, lib, observer, decode_tunnels, 1, 0, mode, hash_mode)):
+        if ret > 0:
+            owner = nf_packet.hashval % n_roots
+            headers[owner] += ffi.buffer(nf_packet)
+            contents[owner] += ffi.buffer(nf_packet.ip_content, nf_packet.ip_content_len)
+            if nf_packet.time > watermark:
+                watermark = nf_packet.time
+            pending += 1
+            if pending == batch_size:
+                reader_flush(channels, watermark, headers, contents)
+                pending = 0
+    reader_flush(channels, watermark, headers, contents)
+    lib.observer_close(observer)
+    ffi.dlclose(lib)
+    for channel in channels:
+        channel.put(None)
+
+
 def track(lib, observer, mode, interface_stats, tracker, processed, ignored):
     """ Update shared performance values """
     lib.observer_stats(observer, interface_stats, mode)
@@ -178,26 +549,74 @@ def track(lib, observer, mode, interface_stats, tracker, processed, ignored):
     tracker[2].value = ignored
 
 
-def meter_workflow(source, snaplen, decode_tunnels, bpf_filter, promisc, n_roots, root_idx, mode,
-                   idle_timeout, active_timeout, accounting_mode, udps, n_dissections, statistics, splt,
-                   channel, tracker, lock):
+def engine_drain(engine, expired, channel, hooks, n_dissections, statistics, splt, ffi, lib):
+    """ Collect flows exported by native engine and push them on channel """
+    n_flows = lib.engine_expired(engine, expired, len(expired))
+    while n_flows:
+        for i in range(n_flows):
+            channel.put(NFlow.from_native(expired[i], hooks, n_dissections, statistics, splt, ffi, lib))
+        n_flows = lib.engine_expired(engine, expired, len(expired))
+
+
+def engine_meter(batches, engine, observer, mode, interface_stats, tracker, channel, hooks, n_dissections, statistics,
+                 splt, ffi, lib):
+    """ Native engine metering loop: interpreter only deals with batches and expired flows """
+    expired = ffi.new("struct nf_flow *[]", 256)
+    meter_track_tick, meter_track_interval = 0, 1000  # we update perf each sec.
+    for n_packets, nf_packets, nf_rets in batches:
+        if n_packets > 0:  # Lookup, update and expiration are done within engine.
+            if lib.engine_process_batch(engine, nf_packets, nf_rets, n_packets):
+                engine_drain(engine, expired, channel, hooks, n_dissections, statistics, splt, ffi, lib)
+            channel.flush_lingering()
+        elif n_packets == -2:  # End of file
+            break
+        elif n_packets == -1:  # Read error or empty buffer
+            channel.flush()
+        if engine.tick - meter_track_tick >= meter_track_interval:  # Performance tracking
+            track(lib, observer, mode, interface_stats, tracker, engine.processed_packets, engine.ignored_packets)
+            meter_track_tick = engine.tick
+    track(lib, observer, mode, interface_stats, tracker, engine.processed_packets, engine.ignored_packets)
+    # Expire all remaining flows in the engine.
+    lib.engine_cleanup(engine)
+    engine_drain(engine, expired, channel, hooks, n_dissections, statistics, splt, ffi, lib)
+
+
+def meter_workflow(source, snaplen, decode_tunnels, bpf_filter, promisc, fanout_mode, fanout_defrag, fanout_group_id,
+                   buffer_size, immediate_mode, poll_timeout, start_time, end_time, source_range, range_partitioning,
+                   n_roots, root_idx, mode, hash_mode, idle_timeout, active_timeout, accounting_mode, udps,
+                   n_dissections, statistics, splt, native_engine, channel, ring, tracker, lock, packets_channel=None,
+                   sink=None):
     """ Metering workflow """
     set_affinity(root_idx+1)
     ffi, lib = create_context()
-    observer = setup_observer(ffi, lib, root_idx, source, snaplen, promisc, mode, bpf_filter)
-    if observer is None:
-        ffi.dlclose(lib)
-        channel.put(None)
-        return
-    meter_tick, meter_scan_tick, meter_track_tick = 0, 0, 0  # meter, idle scan and perf track timelines
+    observer = ffi.NULL
+    # Expired flows are shipped as records through meter ring, tagged with its index (source range index if set).
+    # In sink mode, they are written to meter shard: (format, path, anonymization, compression, row group size).
+    layout = NFRecord(n_dissections, statistics, splt, len(udps) > 0)
+    if sink is None:
+        channel = NFRingChannel(channel, ring, root_idx, layout)
+    else:
+        channel = NFShardChannel(channel, root_idx, layout, *sink)
+    if packets_channel is None:  # Meter reads its own observer, otherwise packets are fed by single pass reader.
+        observer = setup_observer(ffi, lib, root_idx, source, snaplen, promisc, mode, bpf_filter, fanout_mode,
+                                  fanout_defrag, fanout_group_id, buffer_size, immediate_mode, poll_timeout,
+                                  start_time, end_time, source_range)
+        if observer is None:
+            ffi.dlclose(lib)
+            channel.put(None)
+            return
+    meter_tick, meter_scan_tick, meter_track_tick = 0, 0, 0  # meter, expiration scan and perf track timelines
     meter_scan_interval, meter_track_interval = 10, 1000  # we scan each 10 msecs and update perf each sec.
     cache = NFCache()
+    wheel = NFWheel()
     dissector = setup_dissector(ffi, lib, n_dissections)
     active_flows, ignored_packets, processed_packets = 0, 0, 0
-    sync = False
-    if len(udps) > 0:  # streamer started with udps: sync internal structures on update.
-        sync = True
-    remaining_packets = True
+    hooks, sync = None, False
+    if len(udps) > 0:  # streamer started with udps: each entrypoint only calls plugins overriding it.
+        hooks = NFHooks(udps, ffi)
+        sync = len(hooks.on_update) > 0  # sync internal structures on update only when plugins follow packets.
+        if hooks.fields is not None:  # Plugins declared flow fields they read, we sync only these on update.
+            hooks.fields = sync_plan(hooks.fields, n_dissections, statistics, splt)
     interface_stats = ffi.new("struct nf_stat *")
     # We ensure that processes start at the same time
     if root_idx == n_roots - 1:
@@ -205,53 +624,70 @@ def meter_workflow(source, snaplen, decode_tunnels, bpf_filter, promisc, n_roots
     else:
         lock.acquire()
         lock.release()
-    activation_failed = lib.observer_activate(observer, mode, root_idx)
-    if activation_failed:
-        ffi.dlclose(lib)
-        channel.put(None)
-        return
-    while remaining_packets:
-        nf_packet = ffi.new("struct nf_packet *")
-        ret = lib.observer_next(observer, nf_packet, decode_tunnels, n_roots, root_idx, mode)
-        if ret > 0:  # Valid must be processed by meter
-            packet_time = nf_packet.time
-            if packet_time > meter_tick:
-                meter_tick = packet_time
-            else:
-                nf_packet.time = meter_tick  # Force time order
-            if ret == 1:  # Must be processed
-                processed_packets += 1
-                go_scan = False
-                if meter_tick - meter_scan_tick >= meter_scan_interval:
-                    go_scan = True  # Activate scan
-                    meter_scan_tick = meter_tick
-                # Consume packet and return diff
-                diff = consume(nf_packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps, sync,
-                               accounting_mode, n_dissections, statistics, splt, dissector)
-                active_flows += diff
-                if go_scan:
-                    idles = meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections,
-                                       statistics, splt, ffi, lib, dissector)
-                    active_flows -= idles
-            else:  # time ticker
-                if meter_tick - meter_scan_tick >= meter_scan_interval:
-                    idles = meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections,
-                                       statistics, splt, ffi, lib, dissector)
-                    active_flows -= idles
-                    meter_scan_tick = meter_tick
-        elif ret == 0:  # Ignored packet
-            ignored_packets += 1
-        elif ret == -1:  # Read error or empty buffer
-            pass
-        else:  # End of file
-            remaining_packets = False  # end of loop
-        if meter_tick - meter_track_tick >= meter_track_interval:  # Performance tracking
-            track(lib, observer, mode, interface_stats, tracker, processed_packets, ignored_packets)
-            meter_track_tick = meter_tick
-    # Expire all remaining flows in the cache.
-    meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector)
+    if packets_channel is None:
+        activation_failed = lib.observer_activate(observer, mode, root_idx)
+        if activation_failed:
+            ffi.dlclose(lib)
+            channel.put(None)
+            return
+        if range_partitioning:
+            batches = observer_batches(ffi, lib, observer, decode_tunnels, 1, 0, mode, hash_mode)
+        else:
+            batches = observer_batches(ffi, lib, observer, decode_tunnels, n_roots, root_idx, mode, hash_mode)
+    else:
+        batches = reader_batches(ffi, lib, packets_channel)
+    engine = ffi.NULL
+    if native_engine and not sync and (hooks is None or not (hooks.on_init or hooks.on_update_batch)):
+        # Without per packet plugins entrypoints, flows can be handled entirely by native engine until expiration.
+        engine = lib.engine_init(idle_timeout, active_timeout, accounting_mode, statistics, splt, n_dissections,
+                                 dissector, ffi.NULL if hooks is None else hooks.natives)
+    if engine != ffi.NULL:
+        engine_meter(batches, engine, observer, mode, interface_stats, tracker, channel, hooks, n_dissections,
+                     statistics, splt, ffi, lib)
+        lib.engine_free(engine)
+    else:
+        for ret, nf_packet in batch_packets(batches):
+            if ret > 0:  # Valid must be processed by meter
+                packet_time = nf_packet.time
+                if packet_time > meter_tick:
+                    meter_tick = packet_time
+                else:
+                    nf_packet.time = meter_tick  # Force time order
+                if ret == 1:  # Must be processed
+                    processed_packets += 1
+                    go_scan = False
+                    if meter_tick - meter_scan_tick >= meter_scan_interval:
+                        go_scan = True  # Activate scan
+                        meter_scan_tick = meter_tick
+                    # Consume packet and return diff
+                    diff = consume(nf_packet, cache, wheel, active_timeout, idle_timeout, channel, ffi, lib, hooks,
+                                   sync, accounting_mode, n_dissections, statistics, splt, dissector)
+                    active_flows += diff
+                    if go_scan:
+                        idles = meter_scan(meter_tick, cache, wheel, idle_timeout, active_timeout, channel, hooks,
+                                           sync, n_dissections, statistics, splt, ffi, lib, dissector)
+                        active_flows -= idles
+                else:  # time ticker
+                    if meter_tick - meter_scan_tick >= meter_scan_interval:
+                        idles = meter_scan(meter_tick, cache, wheel, idle_timeout, active_timeout, channel, hooks,
+                                           sync, n_dissections, statistics, splt, ffi, lib, dissector)
+                        active_flows -= idles
+                        meter_scan_tick = meter_tick
+            elif ret == 0:  # Ignored packet
+                ignored_packets += 1
+            elif ret == -1:  # Read error or empty buffer
+                channel.flush()  # No traffic: pending flows are handed off.
+            else:  # End of file
+                break  # end of loop
+            if meter_tick - meter_track_tick >= meter_track_interval:  # Performance tracking
+                track(lib, observer, mode, interface_stats, tracker, processed_packets, ignored_packets)
+                meter_track_tick = meter_tick
+        track(lib, observer, mode, interface_stats, tracker, processed_packets, ignored_packets)
+        # Expire all remaining flows in the cache.
+        meter_cleanup(cache, channel, hooks, sync, n_dissections, statistics, splt, ffi, lib, dissector)
     # Close observer
-    lib.observer_close(observer)
+    if packets_channel is None:
+        lib.observer_close(observer)
     # Clean dissector
     lib.dissector_cleanup(dissector)
     # Release context library
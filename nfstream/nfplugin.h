@@ -0,0 +1,73 @@
+/*
+------------------------------------------------------------------------------------------------------------------------
+nfplugin.h
+Copyright (C) 2019-20 - NFStream Developers
+This file is part of NFStream, a Flexible Network Data Analysis Framework (https://www.nfstream.org/).
+NFStream is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+version.
+NFStream is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+You should have received a copy of the GNU Lesser General Public License along with NFStream.
+If not, see <http://www.gnu.org/licenses/>.
+------------------------------------------------------------------------------------------------------------------------
+*/
+
+#ifndef NFPLUGIN_H
+#define NFPLUGIN_H
+
+#include <stdint.h>
+
+#define NF_PLUGIN_ABI_VERSION 1
+
+
+// Main structure for packet information.
+typedef struct nf_packet {
+  uint8_t direction;
+  uint64_t time;
+  uint64_t delta_time;
+  uint16_t src_port;
+  uint16_t dst_port;
+  uint8_t protocol;
+  uint16_t vlan_id;
+  uint8_t src_addr[16], dst_addr[16]; // Raw addresses (IPv4 ones use the first 4 bytes).
+  uint8_t flow_key[40]; // Canonical symmetric flow key.
+  uint8_t ip_version;
+  uint16_t fin:1, syn:1, rst:1, psh:1, ack:1, urg:1, ece:1, cwr:1; /* TCP Flags */
+  uint16_t raw_size;
+  uint16_t ip_size;
+  uint16_t transport_size;
+  uint16_t payload_size;
+  uint16_t ip_content_len;
+  uint8_t *ip_content;
+  uint64_t hashval;
+} nf_packet_t;
+
+
+/*
+ Native plugin ABI: a compiled NFPlugin is a shared library exporting a "nf_plugin" descriptor.
+   - state: per flow state block members declaration. Block is zeroed at flow creation and its members are exported
+            as flow udps at expiration (members prefixed with "_" are kept private).
+   - state_size: state block size.
+   - on_init, on_update, on_expire: callbacks (NULL when unused) called with flow state block within native meter.
+ Plugins are expected to declare them using NF_PLUGIN_STATE and NF_PLUGIN macros:
+   NF_PLUGIN_STATE(my_state, uint64_t my_counter; double my_mean;);
+   NF_PLUGIN(my_state, my_on_init, my_on_update, NULL);
+*/
+typedef struct nf_plugin {
+  uint32_t abi_version;
+  const char *state;
+  uint32_t state_size;
+  void (*on_init)(void *state, const struct nf_packet *packet);
+  void (*on_update)(void *state, const struct nf_packet *packet);
+  void (*on_expire)(void *state);
+} nf_plugin_t;
+
+#define NF_STRINGIFY(...) #__VA_ARGS__
+#define NF_PLUGIN_STATE(name, ...) struct name { __VA_ARGS__ }; \
+  static const char name##_declaration[] = NF_STRINGIFY(__VA_ARGS__)
+#define NF_PLUGIN(name, on_init, on_update, on_expire) \
+  nf_plugin_t nf_plugin = {NF_PLUGIN_ABI_VERSION, name##_declaration, sizeof(struct name), \
+                           on_init, on_update, on_expire}
+
+#endif
@@ -16,9 +16,24 @@ If not, see <http://www.gnu.org/licenses/>.
 ------------------------------------------------------------------------------------------------------------------------
 """
 
+from os.path import abspath
+import numpy as np
+import cffi
+from .context import create_context
+
+NF_PLUGIN_ABI_VERSION = 1  # Native plugins ABI version, as defined in nfplugin.h.
+
 
 class NFPlugin(object):
     """ NFPlugin class: Main entry point to extend NFStream """
+    # Packets are lazy views valid only during entrypoints calls. Plugins keeping packets set it to get namedtuples.
+    packet_copy = False
+    # Maximum number of packets accumulated across flows before calling on_update_batch.
+    batch_size = 4096
+    # Flow attributes read by on_update (e.g. ['bidirectional_packets']), only these are synced on each packet.
+    # None (default) syncs all attributes.
+    flow_fields = None
+
     def __init__(self, **kwargs):
         """
         NFPlugin Parameters:
@@ -49,6 +64,20 @@ class NFPlugin(object):
         ----------------------------------------------------------------
         """
 
+    def on_update_batch(self, packets, flows):
+        """
+        on_update_batch(self, packets, flows): Method called with packets accumulated across flows (including flows
+        first packets), as a dict of numpy arrays (time, delta_time, direction, raw_size, ip_size, transport_size,
+        payload_size, src_port, dst_port, protocol, vlan_id, ip_version, syn, cwr, ece, urg, ack, psh, rst, fin)
+        where flow_idx array gives each packet flow in flows list. Pending packets of a flow are always delivered
+        before its on_expire call. Note that flows attributes are only synced for on_update and on_expire.
+        Example: -------------------------------------------------------
+                 sizes = numpy.bincount(packets["flow_idx"], weights=packets["raw_size"], minlength=len(flows))
+                 for flow, size in zip(flows, sizes):
+                    flow.udps.total_size = getattr(flow.udps, "total_size", 0) + size
+        ----------------------------------------------------------------
+        """
+
     def on_expire(self, flow):
         """
         on_expire(self, flow):      Method called at flow expiration.
@@ -66,6 +95,185 @@ class NFPlugin(object):
         ----------------------------------------------------------------
         """
 
+
+class NFNativePlugin(NFPlugin):
+    """
+    NFNativePlugin class: compiled plugin, a shared library exporting nf_plugin descriptor (see nfplugin.h).
+    Its callbacks run within native flows updates and its state block members are exported as udps at expiration.
+    """
+    def __init__(self, path, **kwargs):
+        """
+        NFNativePlugin Parameters:
+        path : compiled plugin shared library path
+        kwargs : user defined named arguments that will be stored as Plugin attributes
+        """
+        NFPlugin.__init__(self, **kwargs)
+        self.path = abspath(path)
+        ffi, lib = create_context()  # We validate plugin library and state declaration on a dedicated context.
+        try:
+            self.load(ffi, 0, 0)
+        finally:
+            self.release(ffi)
+            ffi.dlclose(lib)
+
+    def load(self, ffi, idx, offset):
+        """ load plugin library within meter context, return its descriptor """
+        try:
+            self._lib = ffi.dlopen(self.path)
+            descriptor = ffi.addressof(self._lib, "nf_plugin")
+        except (OSError, AttributeError, KeyError):
+            raise ValueError("Please specify a valid native plugin path (shared library exporting nf_plugin).")
+        if descriptor.abi_version != NF_PLUGIN_ABI_VERSION:
+            raise ValueError("Native plugin ABI version mismatch (plugin: {}, nfstream: {}), please rebuild it "
+                             "against nfplugin.h.".format(descriptor.abi_version, NF_PLUGIN_ABI_VERSION))
+        self._state = "struct nf_plugin_state_{}".format(idx)
+        try:
+            ffi.cdef("{} {{ {} }};".format(self._state, ffi.string(descriptor.state).decode('utf-8')))
+        except cffi.CDefError:
+            raise ValueError("Native plugin state declaration must use fixed size C types only.")
+        if ffi.sizeof(self._state) != descriptor.state_size:
+            raise ValueError("Native plugin state declaration does not match its state size.")
+        self._ffi = ffi
+        self._offset = offset
+        # Exported state members: arrays are exported as lists, char arrays as strings.
+        self._members = []
+        for name, member in ffi.typeof(self._state).fields:
+            if not name.startswith('_'):
+                kind = 0
+                if member.type.kind == 'array':
+                    kind = 2 if member.type.item.cname == 'char' else 1
+                self._members.append((name, kind))
+        return descriptor
+
+    def release(self, ffi):
+        """ release plugin library """
+        if getattr(self, '_lib', None) is not None:
+            ffi.dlclose(self._lib)
+            self._lib = None
+
+    def on_expire(self, flow):
+        state = self._ffi.cast(self._state + " *", self._ffi.cast("uint8_t *", flow._C.plugins_state) + self._offset)
+        for name, kind in self._members:
+            value = getattr(state, name)
+            if kind == 1:
+                value = list(value)
+            elif kind == 2:
+                value = self._ffi.string(value).decode('utf-8', errors='ignore')
+            setattr(flow.udps, name, value)
+
+    def __getstate__(self):
+        """ only parameters are shared with meters, library is loaded within each meter context """
+        return {key: value for key, value in self.__dict__.items() if not key.startswith('_')}
+
+
+def native_plugins(udps, ffi):
+    """ load native plugins and build their registry, state blocks are 8 bytes aligned """
+    plugins = ffi.new("struct nf_plugin *[]", len(udps))
+    offsets = ffi.new("uint32_t[]", len(udps))
+    state_size = 0
+    for idx, udp in enumerate(udps):
+        descriptor = udp.load(ffi, idx, state_size)
+        plugins[idx] = descriptor
+        offsets[idx] = state_size
+        state_size += (descriptor.state_size + 7) & ~7
+    registry = ffi.new("struct nf_plugins *", {'n_plugins': len(udps), 'plugins': plugins, 'offsets': offsets,
+                                                'state_size': state_size})
+    return registry, (plugins, offsets)
+
+
+def overrides(udp, entrypoint):
+    """ check if a plugin overrides NFPlugin entrypoint (as class method or instance attribute) """
+    return getattr(getattr(udp, entrypoint), '__func__', None) is not getattr(NFPlugin, entrypoint)
+
+
+class NFBatch(object):
+    """ NFBatch class: packets accumulated across flows as raw packet C structures for on_update_batch plugins """
+    __slots__ = ('udps', 'batch_size', 'dtype', 'flags', 'packets', 'flows_idx', 'flows', 'packets_idx')
+
+    def __init__(self, udps, ffi):
+        self.udps = udps
+        self.batch_size = min([udp.batch_size for udp in udps])
+        fields = [('time', 'u8'), ('delta_time', 'u8'), ('direction', 'u1'), ('raw_size', 'u2'), ('ip_size', 'u2'),
+                  ('transport_size', 'u2'), ('payload_size', 'u2'), ('src_port', 'u2'), ('dst_port', 'u2'),
+                  ('protocol', 'u1'), ('vlan_id', 'u2'), ('ip_version', 'u1')]
+        offsets = [ffi.offsetof("struct nf_packet", name) for name, _ in fields]
+        # TCP flags are bit fields (layout is compiler defined): we locate each flag byte and bit on a probe packet.
+        self.flags = {}
+        for name in ['syn', 'cwr', 'ece', 'urg', 'ack', 'psh', 'rst', 'fin']:
+            probe = ffi.new("struct nf_packet *")
+            setattr(probe, name, 1)
+            offset, value = [(idx, value) for idx, value in enumerate(ffi.buffer(probe)[:]) if value][0]
+            self.flags[name] = value.bit_length() - 1
+            fields.append((name, 'u1'))
+            offsets.append(offset)
+        self.dtype = np.dtype({'names': [name for name, _ in fields], 'formats': [code for _, code in fields],
+                               'offsets': offsets, 'itemsize': ffi.sizeof("struct nf_packet")})
+        self.packets = bytearray()
+        self.flows_idx = {}
+        self.flows = []
+        self.packets_idx = []
+
+    def add(self, flow, packet, ffi):
+        """ add a flow packet, batch is delivered once full """
+        idx = self.flows_idx.get(id(flow))  # pending flows are referenced by flows list, their ids are unique.
+        if idx is None:
+            idx = len(self.flows)
+            self.flows_idx[id(flow)] = idx
+            self.flows.append(flow)
+        self.packets_idx.append(idx)
+        self.packets += ffi.buffer(packet)
+        if len(self.packets_idx) >= self.batch_size:
+            self.flush()
+
+    def expire(self, flow):
+        """ deliver pending packets before flow expiration """
+        if id(flow) in self.flows_idx:
+            self.flush()
+
+    def flush(self):
+        """ deliver pending packets to each on_update_batch plugin """
+        if not self.packets_idx:
+            return
+        raw = np.frombuffer(self.packets, dtype=self.dtype)
+        packets = {name: raw[name] for name in self.dtype.names if name not in self.flags}
+        for name, bit in self.flags.items():
+            packets[name] = (raw[name] >> bit) & 1
+        packets['flow_idx'] = np.array(self.packets_idx, dtype=np.int64)
+        flows = self.flows
+        self.packets = bytearray()
+        self.flows_idx = {}
+        self.flows = []
+        self.packets_idx = []
+        for udp in self.udps:
+            udp.on_update_batch(packets, flows)
+
+
+class NFHooks(object):
+    """ NFHooks class: plugins per entrypoint, each entrypoint only calls plugins that override it """
+    __slots__ = ('on_init', 'on_update', 'on_update_batch', 'on_expire', 'packet_copy', 'fields', 'batch',
+                 'natives', 'natives_arrays')
+
+    def __init__(self, udps, ffi=None):
+        self.on_init = [udp for udp in udps if overrides(udp, 'on_init')]
+        self.on_update = [udp for udp in udps if overrides(udp, 'on_update')]
+        self.on_update_batch = [udp for udp in udps if overrides(udp, 'on_update_batch')]
+        self.on_expire = [udp for udp in udps if overrides(udp, 'on_expire')]
+        # A single plugin opting in packet copy is enough: all plugins are served with the same packet object.
+        self.packet_copy = any([udp.packet_copy for udp in self.on_init + self.on_update])
+        # Flow fields synced on update: all of them (None) unless each on_update plugin declared the ones it reads.
+        self.fields = None
+        if all([udp.flow_fields is not None for udp in self.on_update]):
+            self.fields = sorted(set([field for udp in self.on_update for field in udp.flow_fields]))
+        self.batch = NFBatch(self.on_update_batch, ffi) if self.on_update_batch else None
+        # Native plugins registry is passed to native meter, its arrays must be kept alive with it.
+        self.natives, self.natives_arrays = None, None
+        natives = [udp for udp in udps if isinstance(udp, NFNativePlugin)]
+        if natives:
+            self.natives, self.natives_arrays = native_plugins(natives, ffi)
+        elif ffi is not None:
+            self.natives = ffi.NULL
+
+
 # A working example.
 class SPLT(NFPlugin):
     """
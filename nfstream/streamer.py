@@ -18,17 +18,22 @@ If not, see <http://www.gnu.org/licenses/>.
 
 import multiprocessing as mp
 import pandas as pd
-import time as tm
 import secrets
 import os
+import re
+import warnings
 import platform
+from glob import glob, escape
 from collections.abc import Iterable
 from psutil import net_if_addrs, cpu_count
-from hashlib import blake2b
-from os.path import isfile
-from .meter import meter_workflow
-from.plugin import NFPlugin
-from .utils import csv_converter, open_file, RepeatedTimer, update_performances, set_affinity
+from .meter import meter_workflow, reader_workflow, index_source, NFRing
+from .flow import NFlow, NFRecord
+from .exporter import NFExporter
+from.plugin import NFPlugin, overrides
+from .utils import csv_converter, csv_rows, anonymizer, NFWriter, RepeatedTimer, update_performances, set_affinity
+from .utils import capture_files, write_manifest, NFColumns, NFParquetSink, arrow_batch, pa, zstandard, lz4_frame
+from .utils import write_index, read_index, index_window, index_ranges, range_hold, range_stitch
+from .utils import COMPRESSION_EXTENSIONS, fanout_group
 
 # Set fork as method to avoid issues on macos with spawn default value
 mp.set_start_method("fork")
@@ -51,8 +56,21 @@ class NFStreamer(object):
                  statistical_analysis=False,
                  splt_analysis=0,
                  n_meters=0,
-                 performance_report=0):
+                 performance_report=0,
+                 single_pass=False,
+                 native_engine=False,
+                 dispatch_hash=0,
+                 fanout_mode=0,
+                 fanout_defrag=True,
+                 fanout_group_id=None,
+                 buffer_size=0,
+                 immediate_mode=False,
+                 poll_timeout=1000,
+                 start_time=None,
+                 end_time=None,
+                 range_partitioning=False):
         NFStreamer.streamer_id += 1
+        self._instance_id = NFStreamer.streamer_id
         self._mode = 0
         self.source = source
         self.decode_tunnels = decode_tunnels
@@ -68,6 +86,18 @@ class NFStreamer(object):
         self.splt_analysis = splt_analysis
         self.n_meters = n_meters
         self.performance_report = performance_report
+        self.single_pass = single_pass
+        self.native_engine = native_engine
+        self.dispatch_hash = dispatch_hash
+        self.fanout_mode = fanout_mode
+        self.fanout_defrag = fanout_defrag
+        self.fanout_group_id = fanout_group_id
+        self.buffer_size = buffer_size
+        self.immediate_mode = immediate_mode
+        self.poll_timeout = poll_timeout
+        self.start_time = start_time
+        self.end_time = end_time
+        self.range_partitioning = range_partitioning
 
     @property
     def source(self):
@@ -75,15 +105,17 @@ class NFStreamer(object):
 
     @source.setter
     def source(self, value):
-        if not isinstance(value, str):
-            raise ValueError("Please specify a pcap file path or a valid network interface name as source.")
         available_interfaces = net_if_addrs().keys()
-        if value in available_interfaces:
+        if isinstance(value, str) and value in available_interfaces:
             self._mode = 1
-        elif ".pcap" in value[-5:] and isfile(value):
-            self._mode = 0
+            self._files = [value]
         else:
-            raise ValueError("Please specify a pcap file path or a valid network interface name as source.")
+            files = capture_files(value)
+            if len(files) == 0:
+                raise ValueError("Please specify a pcap file path (or a list, glob or directory of pcap files) "
+                                 "or a valid network interface name as source.")
+            self._mode = 0
+            self._files = files
         self._source = value
 
     @property
@@ -180,6 +212,12 @@ class NFStreamer(object):
                     self._udps = ()
                 else:
                     raise ValueError("User defined plugins must inherit from NFPlugin type.")
+        for plugin in self._udps:
+            if plugin.flow_fields is not None:
+                if isinstance(plugin.flow_fields, str) or not isinstance(plugin.flow_fields, Iterable) or \
+                        not set(plugin.flow_fields) <= set(NFlow.__slots__) - {'_C', 'udps'}:
+                    raise ValueError("Please specify a valid flow_fields plugin parameter (list of flow attributes "
+                                     "names or None).")
 
     @property
     def n_dissections(self):
@@ -244,10 +282,180 @@ class NFStreamer(object):
             pass
         else:
             raise ValueError("Please specify a valid performance_report parameter (>=1 for reporting interval (seconds)"
-                             " or 0 to disaable). [Available only for Live capture]")
+                             " or 0 to disaable).")
         self._performance_report = value
 
+    @property
+    def single_pass(self):
+        return self._single_pass
+
+    @single_pass.setter
+    def single_pass(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid single_pass parameter (possible values: True, False). "
+                             "[Available only for Offline capture]")
+        self._single_pass = value
+
+    @property
+    def native_engine(self):
+        return self._native_engine
+
+    @native_engine.setter
+    def native_engine(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid native_engine parameter (possible values: True, False). "
+                             "[Ignored when udps override on_init, on_update or on_update_batch]")
+        self._native_engine = value
+
+    @property
+    def dispatch_hash(self):
+        return self._dispatch_hash
+
+    @dispatch_hash.setter
+    def dispatch_hash(self, value):
+        if not isinstance(value, int) or (isinstance(value, int) and value not in [0, 1, 2]):
+            raise ValueError("Please specify a valid dispatch_hash parameter (possible values: 0, 1, 2). "
+                             "[Offline capture or non Linux live capture]")
+        self._dispatch_hash = value
+
+    @property
+    def fanout_mode(self):
+        return self._fanout_mode
+
+    @fanout_mode.setter
+    def fanout_mode(self, value):
+        if not isinstance(value, int) or (isinstance(value, int) and value not in [0, 1, 2, 3, 4, 5]):
+            raise ValueError("Please specify a valid fanout_mode parameter (possible values: 0: hash, 1: lb, 2: cpu, "
+                             "3: rollover, 4: rnd, 5: qm). [Available only for Linux Live capture]")
+        self._fanout_mode = value
+
+    @property
+    def fanout_defrag(self):
+        return self._fanout_defrag
+
+    @fanout_defrag.setter
+    def fanout_defrag(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid fanout_defrag parameter (possible values: True, False). "
+                             "[Available only for Linux Live capture]")
+        self._fanout_defrag = value
+
+    @property
+    def fanout_group_id(self):
+        return self._fanout_group_id
+
+    @fanout_group_id.setter
+    def fanout_group_id(self, value):
+        if value is None or (isinstance(value, int) and 0 <= value <= 65535):
+            pass
+        else:
+            raise ValueError("Please specify a valid fanout_group_id parameter (0 <= fanout_group_id <= 65535 or None "
+                             "for an id reserved among NFStream instances). [Available only for Linux Live capture]")
+        self._fanout_group_id = value
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    @buffer_size.setter
+    def buffer_size(self, value):
+        if isinstance(value, int) and 0 <= value <= 2147483647:
+            pass
+        else:
+            raise ValueError("Please specify a valid buffer_size parameter (kernel buffer size in bytes or 0 for "
+                             "default). [Available only for Live capture]")
+        self._buffer_size = value
+
+    @property
+    def immediate_mode(self):
+        return self._immediate_mode
+
+    @immediate_mode.setter
+    def immediate_mode(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid immediate_mode parameter (possible values: True, False). "
+                             "[Available only for Live capture]")
+        self._immediate_mode = value
+
+    @property
+    def poll_timeout(self):
+        return self._poll_timeout
+
+    @poll_timeout.setter
+    def poll_timeout(self, value):
+        if isinstance(value, int) and 1 <= value <= 60000:
+            pass
+        else:
+            raise ValueError("Please specify a valid poll_timeout parameter (1 <= poll_timeout <= 60000 msecs). "
+                             "[Available only for Live capture]")
+        self._poll_timeout = value
+
+    @property
+    def start_time(self):
+        return self._start_time
+
+    @start_time.setter
+    def start_time(self, value):
+        if value is None or (isinstance(value, int) and value >= 0):
+            pass
+        else:
+            raise ValueError("Please specify a valid start_time parameter (epoch msecs or None). "
+                             "[Available only for Offline capture]")
+        self._start_time = value
+
+    @property
+    def end_time(self):
+        return self._end_time
+
+    @end_time.setter
+    def end_time(self, value):
+        if value is None or (isinstance(value, int) and value > 0):
+            pass
+        else:
+            raise ValueError("Please specify a valid end_time parameter (epoch msecs or None). "
+                             "[Available only for Offline capture]")
+        self._end_time = value
+
+    @property
+    def range_partitioning(self):
+        return self._range_partitioning
+
+    @range_partitioning.setter
+    def range_partitioning(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid range_partitioning parameter (possible values: True, False). "
+                             "[Available only for single file Offline capture, "
+                             "ignored when udps or single_pass are set]")
+        self._range_partitioning = value
+
+    def build_index(self, interval=1000):
+        """ Build source index sidecars (capture file path + .nfindex) mapping packets time (msecs) to file offsets """
+        if self._mode != 0:
+            raise ValueError("Index is available only for Offline capture.")
+        if not isinstance(interval, int) or interval <= 0:
+            raise ValueError("Please specify a valid interval parameter (positive integer in msecs).")
+        n_marks = 0
+        for path in self._files:
+            index = index_source(path, interval)
+            if index is None:
+                raise ValueError("Unable to index source (pcap or pcapng file expected).")
+            headers, marks = index
+            write_index(path + '.nfindex', path, interval, headers, marks)
+            n_marks += len(marks)
+        return n_marks
+
     def __iter__(self):
+        return self._iterate()
+
+    def _iterate(self, records=False, sinks=None):
+        """
+            Flows generator, records batches are yielded as (records, offsets) without building flows if records is
+            set. With per meter sinks, meters write flows and (meter index, flows count) are yielded.
+        """
+        if self.native_engine and any([overrides(udp, entrypoint) for udp in self.udps
+                                       for entrypoint in ['on_init', 'on_update', 'on_update_batch']]):
+            warnings.warn("native_engine is ignored: udps override on_init, on_update or on_update_batch "
+                          "(per packet plugins entrypoints run in Python meters).", RuntimeWarning)
         set_affinity(0) # we pin streamer to core 0 as it's the less intensive task and several services runs
                         # by default on this core.
         lock = mp.Lock()
@@ -259,18 +467,95 @@ class NFStreamer(object):
         channel = mp.Queue(maxsize=32767)  # Backpressure strategy.
         # We set it to (2^15-1) to cope with OSX maximum semaphore value.
         n_meters = self.n_meters
+        fanout_group_id, fanout_group_lock = self.fanout_group_id, None
+        if fanout_group_id is None and self._mode == 1:  # Reserved among NFStream instances to avoid collisions.
+            fanout_group_id, fanout_group_lock = fanout_group((os.getpid() * 64 + self._instance_id) % 65536)
+        elif fanout_group_id is None:
+            fanout_group_id = 0  # Offline: fanout is done by meters.
+        start_time, end_time = self.start_time or 0, self.end_time or 0
+        # Capture files are merged by meters into a single time ordered source.
+        source = self._files[0] if len(self._files) == 1 else self._files
+        range_partitioning = self._mode == 0 and self.range_partitioning and not self.udps and not self.single_pass \
+            and len(self._files) == 1 and sinks is None
+        source_ranges, boundaries, held = [None] * n_meters, None, []
+        if self._mode == 0 and len(self._files) > 1 and (start_time or end_time):
+            files_ranges = []  # Indexed capture files seek their own time window.
+            for path in self._files:
+                index = read_index(path + '.nfindex', path)
+                if index is None:
+                    files_ranges.append(None)
+                else:
+                    start_offset, end_offset = index_window(index[1], start_time, end_time)
+                    files_ranges.append((start_offset, end_offset, index[0]))
+            source_ranges = [files_ranges] * n_meters
+        elif self._mode == 0 and (start_time or end_time or range_partitioning):
+            index = read_index(source + '.nfindex', source)
+            if index is None and range_partitioning:  # No sidecar: index is built on the fly.
+                index = index_source(source, 1000)
+            if index is not None:  # Otherwise, source is read from its start and time window applied on packets.
+                headers, marks = index
+                start_offset, end_offset = index_window(marks, start_time, end_time)
+                if range_partitioning:  # Each meter owns all flows of a byte range, ranges are stitched on return.
+                    ranges = index_ranges(marks, n_meters, start_offset, end_offset, self.idle_timeout*1000)
+                    n_meters = len(ranges)
+                    source_ranges = [(r[0], r[1], headers) for r in ranges]
+                    boundaries = [r[2] for r in ranges]
+                else:
+                    source_ranges = [(start_offset, end_offset, headers)] * n_meters
+        range_partitioning = boundaries is not None
+        reader = None
+        packets_channels = [None] * n_meters
+        if self._mode == 0 and self.single_pass:  # Offline single pass: packets parsed once and fed to meters.
+            packets_channels = [mp.Queue(maxsize=64) for _ in range(n_meters)]
+            reader = mp.Process(target=reader_workflow,
+                                args=(source,
+                                      self.snapshot_length,
+                                      self.decode_tunnels,
+                                      self.bpf_filter,
+                                      self.promiscuous_mode,
+                                      self.fanout_mode,
+                                      self.fanout_defrag,
+                                      fanout_group_id,
+                                      self.buffer_size,
+                                      self.immediate_mode,
+                                      self.poll_timeout,
+                                      start_time,
+                                      end_time,
+                                      source_ranges[0],
+                                      n_meters,
+                                      self._mode,
+                                      self.dispatch_hash,
+                                      packets_channels,
+                                      4096,))
+            reader.daemon = True  # demonize reader
+        if sinks is None:
+            rings = [NFRing() for _ in range(n_meters)]  # Per meter flow records rings.
+        else:
+            rings = [None] * n_meters
+        layout = NFRecord(self.n_dissections, self.statistical_analysis, self.splt_analysis, len(self.udps) > 0)
         try:
             for i in range(n_meters):
                 performances.append([mp.Value('I', 0), mp.Value('I', 0), mp.Value('I', 0)])
                 meters.append(mp.Process(target=meter_workflow,
-                                         args=(self.source,
+                                         args=(source,
                                                self.snapshot_length,
                                                self.decode_tunnels,
                                                self.bpf_filter,
                                                self.promiscuous_mode,
+                                               self.fanout_mode,
+                                               self.fanout_defrag,
+                                               fanout_group_id,
+                                               self.buffer_size,
+                                               self.immediate_mode,
+                                               self.poll_timeout,
+                                               start_time,
+                                               end_time,
+                                               source_ranges[i],
+                                               range_partitioning,
                                                n_meters,
                                                i,
                                                self._mode,
+                                               self.dispatch_hash,
                                                self.idle_timeout*1000,
                                                self.active_timeout*1000,
                                                self.accounting_mode,
@@ -278,17 +563,22 @@ class NFStreamer(object):
                                                self.n_dissections,
                                                self.statistical_analysis,
                                                self.splt_analysis,
+                                               self.native_engine,
                                                channel,
+                                               rings[i],
                                                performances[i],
-                                               lock,)))
+                                               lock,
+                                               packets_channels[i],
+                                               sinks[i] if sinks is not None else None,)))
                 meters[i].daemon = True  # demonize meter
                 meters[i].start()
+            if reader is not None:
+                reader.start()
             idx_generator = mp.Value('i', 0)
-            if self._mode == 1 and self.performance_report > 0:
-                if platform.system() == "Linux":
-                    rt = RepeatedTimer(self.performance_report, update_performances, performances, True, idx_generator)
-                else:
-                    rt = RepeatedTimer(self.performance_report, update_performances, performances, False, idx_generator)
+            # Kernel stats are per meter only on Linux live capture, offline meters share the same file.
+            is_linux = self._mode == 1 and platform.system() == "Linux"
+            if self.performance_report > 0:
+                rt = RepeatedTimer(self.performance_report, update_performances, performances, is_linux, idx_generator)
             while True:
                 try:
                     recv = channel.get()
@@ -296,85 +586,313 @@ class NFStreamer(object):
                         n_terminated += 1
                         if n_terminated == n_meters:
                             break  # We finish up when all metering jobs are terminated
-                    else:
-                        recv.id = idx_generator.value  # Unify ID
+                        continue
+                    ring_idx, recv = recv
+                    if sinks is not None:  # Flows written by meters, only counts (or sink error) are reported.
+                        if isinstance(recv, str):
+                            for i in range(n_meters):
+                                meters[i].terminate()
+                            raise ValueError(recv)
+                        idx_generator.value = idx_generator.value + recv
+                        yield ring_idx, recv
+                        continue
+                    if isinstance(recv, int):  # Records batch handed off, flows are built while iterated.
+                        recv = rings[ring_idx].read(recv)
+                        if records and not range_partitioning:  # Flows IDs are set by consumer in same order.
+                            offsets = layout.offsets(recv)
+                            idx_generator.value = idx_generator.value + len(offsets)
+                            yield recv, offsets
+                            continue
+                        recv = layout.unpack_all(recv)
+                    else:  # Flow not fitting records layout.
+                        recv = [recv]
+                    for flow in recv:
+                        # Ring index is the source range one: flows are stitched once all ranges are metered.
+                        if range_partitioning and range_hold(flow, ring_idx, boundaries, self.idle_timeout*1000,
+                                                             self.active_timeout*1000):
+                            held.append((ring_idx, flow))
+                            continue
+                        flow.id = idx_generator.value  # Unify ID
                         idx_generator.value = idx_generator.value + 1
-                        yield recv
+                        yield flow
                 except KeyboardInterrupt:
+                    if reader is not None:
+                        reader.terminate()
                     for i in range(n_meters):  # We break workflow loop
                         meters[i].terminate()
                     break
+            if range_partitioning:
+                for recv in range_stitch(held, boundaries, self.idle_timeout*1000, self.active_timeout*1000,
+                                         self.statistical_analysis, self.splt_analysis):
+                    recv.id = idx_generator.value
+                    idx_generator.value = idx_generator.value + 1
+                    yield recv
+            if reader is not None:
+                reader.join()  # Join reader job
             for i in range(n_meters):
                 meters[i].join()  # Join metring jobs
-            if self._mode == 1 and self.performance_report > 0:
+            if self.performance_report > 0:
                 rt.stop()
+                update_performances(performances, is_linux, idx_generator)  # Final report
             channel.close()  # We close the queue
             channel.join_thread()  # and we join its thread
+            if fanout_group_lock is not None:  # Fanout group id is released.
+                fanout_group_lock.close()
         except ValueError as observer_error: # job initiation failed due to some bad observer parameters.
             raise ValueError(observer_error)
 
-    def to_csv(self, path=None, ip_anonymization=False, flows_per_file=0):
+    def iter_batches(self, batch_size=65536):
+        """ Arrow RecordBatch generator, filled from flows binary records """
+        if pa is None:
+            raise ImportError("pyarrow package is required for Arrow export interfaces.")
+        if not isinstance(batch_size, int) or isinstance(batch_size, bool) or batch_size <= 0:
+            raise ValueError("Please specify a valid batch_size parameter (> 0).")
+        layout = NFRecord(self.n_dissections, self.statistical_analysis, self.splt_analysis, len(self.udps) > 0)
+        staged, offsets, first_id = bytearray(), [], 0
+        for recv in self._iterate(records=True):
+            try:
+                if isinstance(recv, tuple):
+                    base = len(staged)
+                    staged += recv[0]
+                    offsets += [base + offset for offset in recv[1]]
+                else:  # Flow built by streamer (stitched or not fitting layout) is packed back.
+                    try:
+                        record = layout.pack(recv)
+                    except ValueError:
+                        raise ValueError("Flow attributes altered by plugins cannot be exported as Arrow, "
+                                         "please use udps to store plugins values.")
+                    offsets.append(len(staged))
+                    staged += record
+                while len(offsets) >= batch_size:
+                    yield arrow_batch(layout, staged, offsets[:batch_size], first_id)
+                    first_id += batch_size
+                    if len(offsets) > batch_size:  # Remaining records are rebased.
+                        base = offsets[batch_size]
+                        staged = staged[base:]
+                        offsets = [offset - base for offset in offsets[batch_size:]]
+                    else:
+                        staged, offsets = bytearray(), []
+            except KeyboardInterrupt:
+                pass
+        if offsets:
+            yield arrow_batch(layout, staged, offsets, first_id)
+
+    def to_arrow(self, batch_size=65536):
+        """ streamer to Arrow Table function """
+        batches = list(self.iter_batches(batch_size))
+        if not batches:
+            return pa.table({})
+        # udps columns types are inferred per batch (e.g. null typed when unset), they are unified here.
+        return pa.concat_tables([pa.Table.from_batches([batch]) for batch in batches], promote_options="default")
+
+    def to_parquet(self, path=None, partition_by=None, compression='snappy', row_group_size=65536):
+        """ streamer to Parquet function, flows are written by row groups as they expire """
+        if pa is None:
+            raise ImportError("pyarrow package is required for Parquet export interface.")
+        if partition_by == 'application_name' and self.n_dissections == 0 or \
+                partition_by not in [None, 'application_name'] and \
+                (not isinstance(partition_by, int) or isinstance(partition_by, bool) or partition_by <= 0):
+            raise ValueError("Please specify a valid partition_by parameter (None, 'application_name' or time bucket "
+                             "in msecs > 0). [application_name available only when n_dissections > 0]")
+        if compression not in [None, 'snappy', 'gzip', 'brotli', 'lz4', 'zstd']:
+            raise ValueError("Please specify a valid compression parameter "
+                             "(None, 'snappy', 'gzip', 'brotli', 'lz4', 'zstd').")
+        if not isinstance(row_group_size, int) or isinstance(row_group_size, bool) or row_group_size <= 0:
+            raise ValueError("Please specify a valid row_group_size parameter (> 0).")
+        if path is None:  # A directory when partitioned.
+            path = str(self._files[0]) + '.parquet'
+        # Time buckets are closed once flows expiration passed their end by timeouts: no more flows can land in them.
+        sink = NFParquetSink(path, partition_by, compression, row_group_size,
+                             (self.idle_timeout + self.active_timeout) * 1000)
+        try:
+            for batch in self.iter_batches(row_group_size):
+                sink.write(batch)
+        finally:
+            total_flows = sink.close()
+        return total_flows
+
+    def to_shards(self, path=None, sink_format='csv', ip_anonymization=False, compression=None,
+                  row_group_size=65536):
+        """
+            Per meter sinks: each meter writes its own shard file (flows IDs are per shard) to path directory, flows do
+            not go through streamer. A manifest.json file ties shards together, binary shards are consecutive flows
+            records which layout is described by the manifest.
+        """
+        if sink_format not in ['csv', 'parquet', 'binary']:
+            raise ValueError("Please specify a valid sink_format parameter (possible values: 'csv', 'parquet', "
+                             "'binary').")
+        if ip_anonymization not in [False, True, 'prefix']:
+            raise ValueError("Please specify a valid ip_anonymization parameter (possible values: False, True, "
+                             "'prefix' for prefix preserving addresses).")
+        if sink_format == 'parquet':
+            if pa is None:
+                raise ImportError("pyarrow package is required for Parquet export interface.")
+            if compression not in [None, 'snappy', 'gzip', 'brotli', 'lz4', 'zstd']:
+                raise ValueError("Please specify a valid compression parameter "
+                                 "(None, 'snappy', 'gzip', 'brotli', 'lz4', 'zstd').")
+            if not isinstance(row_group_size, int) or isinstance(row_group_size, bool) or row_group_size <= 0:
+                raise ValueError("Please specify a valid row_group_size parameter (> 0).")
+            extension = 'parquet'
+        else:
+            if compression not in [None, 'gzip', 'zstd', 'lz4']:
+                raise ValueError("Please specify a valid compression parameter (None, 'gzip', 'zstd', 'lz4').")
+            if compression == 'zstd' and zstandard is None or compression == 'lz4' and lz4_frame is None:
+                raise ImportError("{} package is required for {} compression.".format(
+                    'zstandard' if compression == 'zstd' else 'lz4', compression))
+            extension = 'csv' if sink_format == 'csv' else 'bin'
+        if path is None:
+            path = str(self._files[0]) + '.shards'
+        os.makedirs(path, exist_ok=True)
+        # Previous run shards are removed: meters without flows do not create their shard.
+        for previous in glob(os.path.join(escape(path), 'meter-*')):
+            if re.fullmatch(r'meter-[0-9]+\.(csv|parquet|bin)(\.gz|\.zst|\.lz4)?', os.path.basename(previous)):
+                os.remove(previous)
+        if os.path.exists(os.path.join(path, "manifest.json")):
+            os.remove(os.path.join(path, "manifest.json"))
+        # Meters share the same anonymization key, so anonymized addresses match across shards.
+        anonymization = (secrets.token_bytes(64), ip_anonymization == 'prefix') if ip_anonymization else None
+        shards = [os.path.join(path, "meter-{}.{}".format(i, extension)) for i in range(self.n_meters)]
+        n_flows = [0] * self.n_meters
+        for shard_idx, shard_flows in self._iterate(sinks=[(sink_format, shard, anonymization, compression,
+                                                            row_group_size) for shard in shards]):
+            n_flows[shard_idx] += shard_flows
+        if sink_format != 'parquet':  # Compressed shards get compression extension.
+            shards = [shard + COMPRESSION_EXTENSIONS[compression] for shard in shards]
+        layout = None
+        if sink_format == 'binary':
+            layout = {"n_dissections": self.n_dissections, "statistical_analysis": self.statistical_analysis,
+                      "splt_analysis": self.splt_analysis, "udps": len(self.udps) > 0}
+        write_manifest(os.path.join(path, "manifest.json"), sink_format, compression, layout,
+                       [str(f) for f in self._files],
+                       [[os.path.basename(shard), n_flows[i]] for i, shard in enumerate(shards)
+                        if os.path.exists(shard)])
+        return sum(n_flows)
+
+    def to_ipfix(self, collector, version=10, mtu=1400, template_refresh=600, observation_domain_id=0,
+                 enterprise_number=32473):
+        """
+            streamer to IPFIX (version=10) or NetFlow v9 (version=9) collector (host, port) over UDP. Flows without
+            IANA element are exported as enterprise_number specific elements (32473 is the documentation example).
+        """
+        if not isinstance(collector, tuple) or len(collector) != 2 or not isinstance(collector[0], str) or \
+                not isinstance(collector[1], int) or not 0 < collector[1] < 65536:
+            raise ValueError("Please specify a valid collector parameter (host, port) tuple.")
+        if version not in [9, 10]:
+            raise ValueError("Please specify a valid version parameter (possible values: 9, 10).")
+        if not isinstance(mtu, int) or not 512 <= mtu <= 65507:
+            raise ValueError("Please specify a valid mtu parameter (512 <= mtu <= 65507 bytes).")
+        if not isinstance(template_refresh, int) or template_refresh <= 0:
+            raise ValueError("Please specify a valid template_refresh parameter (> 0 secs).")
+        if not isinstance(observation_domain_id, int) or not 0 <= observation_domain_id < 2**32 or \
+                not isinstance(enterprise_number, int) or not 0 < enterprise_number < 2**32:
+            raise ValueError("Please specify valid observation_domain_id and enterprise_number parameters "
+                             "(32 bits unsigned integers).")
+        exporter = None
+        total_flows = 0
+        try:
+            for flow in self:
+                try:
+                    if exporter is None:  # Templates are derived from first flow keys as done for csv header.
+                        exporter = NFExporter(collector, flow.keys(), self.splt_analysis, version, mtu,
+                                              template_refresh, observation_domain_id, enterprise_number)
+                    if exporter.export(flow):
+                        total_flows += 1
+                except KeyboardInterrupt:
+                    pass
+        finally:
+            if exporter is not None:
+                exporter.close()
+        return total_flows
+
+    def to_csv(self, path=None, ip_anonymization=False, flows_per_file=0, compression=None):
         if not isinstance(flows_per_file, int) or isinstance(flows_per_file, int) and flows_per_file < 0:
             raise ValueError("Please specify a valid flows_per_file parameter (>= 0).")
+        if compression not in [None, 'gzip', 'zstd', 'lz4']:
+            raise ValueError("Please specify a valid compression parameter (None, 'gzip', 'zstd', 'lz4').")
+        if ip_anonymization not in [False, True, 'prefix']:
+            raise ValueError("Please specify a valid ip_anonymization parameter (possible values: False, True, "
+                             "'prefix' for prefix preserving addresses).")
+        if compression == 'zstd' and zstandard is None or compression == 'lz4' and lz4_frame is None:
+            raise ImportError("{} package is required for {} compression.".format(
+                'zstandard' if compression == 'zstd' else 'lz4', compression))
         chunked = True
         chunk_idx = -1
         if flows_per_file == 0:
             chunked = False
         if path is None:
-            output_path = str(self.source) + '.csv'
+            output_path = str(self._files[0]) + '.csv'
         else:
             output_path = path
         total_flows = 0
         chunk_flows = 0
-        # We generate a random secret key
-        crypto_key = secrets.token_bytes(64)
-        f = None
-        for flow in self:
+        # Anonymization use generated secret key to hash using blake2B algo src and dst IPs.
+        anonymize = anonymizer(secrets.token_bytes(64), ip_anonymization == 'prefix') if ip_anonymization else None
+        layout = NFRecord(self.n_dissections, self.statistical_analysis, self.splt_analysis, len(self.udps) > 0)
+        header = None
+        f = None  # Compression and writes are done by a background writer.
+        for recv in self._iterate(records=True):
             try:
-                if total_flows == 0 or (chunked and (chunk_flows > flows_per_file)):  # header creation
-                    if f is not None:
-                        f.close()
-                    chunk_flows = 1
-                    chunk_idx += 1
-                    f = open_file(output_path, chunked, chunk_idx)
-                    header = ','.join([str(i) for i in flow.keys()]) + "\n"
-                    src_ip_index = flow.keys().index("src_ip")
-                    dst_ip_index = flow.keys().index("dst_ip")
-                    f.write(header.encode('utf-8'))
-                values = flow.values()
-                if ip_anonymization:
-                    # Anonymization use generated secret key to hash using blake2B algo src and dst IPs.
-                    values[src_ip_index] = blake2b(values[src_ip_index].encode(),
-                                                    digest_size=64,
-                                                    key=crypto_key).hexdigest()
-                    values[dst_ip_index] = blake2b(values[dst_ip_index].encode(),
-                                                   digest_size=64,
-                                                   key=crypto_key).hexdigest()
-                csv_converter(values)
-                to_export = ','.join([str(i) for i in values]) + "\n"
-                f.write(to_export.encode('utf-8'))
-                total_flows = total_flows + 1
-                chunk_flows += 1
+                if isinstance(recv, tuple):  # Records batch formatted as a whole.
+                    keys, rows = csv_rows(layout, recv[0], recv[1], total_flows, anonymize)
+                else:  # Flow not fitting records layout.
+                    keys, values = recv.keys(), recv.values()
+                    if anonymize is not None:
+                        for ip_index in [keys.index("src_ip"), keys.index("dst_ip")]:
+                            values[ip_index] = anonymize(values[ip_index])
+                    csv_converter(values)
+                    rows = [','.join([str(i) for i in values])]
+                if header is None:
+                    header = (','.join([str(i) for i in keys]) + "\n").encode('utf-8')
+                while rows:
+                    if f is None or (chunked and chunk_flows == flows_per_file):  # header creation
+                        if f is None:
+                            f = NFWriter(compression)
+                        chunk_flows = 0
+                        chunk_idx += 1
+                        f.open(output_path, chunked, chunk_idx)
+                        f.write(header)
+                    n_rows = len(rows) if not chunked else min(len(rows), flows_per_file - chunk_flows)
+                    f.write(('\n'.join(rows[:n_rows]) + "\n").encode('utf-8'))
+                    rows = rows[n_rows:]
+                    total_flows = total_flows + n_rows
+                    chunk_flows += n_rows
             except KeyboardInterrupt:
                 pass
         if f is not None:
-            if not f.closed:
-                f.close()
+            f.close()
         return total_flows
 
     def to_pandas(self, ip_anonymization=False):
         """ streamer to pandas function """
-        temp_file_path = "nfstream-{pid}-{iid}-{ts}?csv".format(pid=os.getpid(),
-                                                                iid=NFStreamer.streamer_id,
-                                                                ts=tm.time())
-        total_flows = self.to_csv(path=temp_file_path, ip_anonymization=ip_anonymization, flows_per_file=0)
-        if total_flows >= 0:
-            df = pd.read_csv(temp_file_path)
-            if total_flows != df.shape[0]:
-                print("WARNING: {} flows ignored by pandas type conversion. Consider using to_csv() "
-                      "method if drops are critical.".format(abs(df.shape[0] - total_flows)))
-        else:
-            df = None
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        if ip_anonymization not in [False, True, 'prefix']:
+            raise ValueError("Please specify a valid ip_anonymization parameter (possible values: False, True, "
+                             "'prefix' for prefix preserving addresses).")
+        layout = NFRecord(self.n_dissections, self.statistical_analysis, self.splt_analysis, len(self.udps) > 0)
+        columns = None
+        n_flows = 0
+        for recv in self._iterate(records=True):
+            try:
+                if isinstance(recv, tuple):  # Records batch appended column by column.
+                    decoded = layout.columns(recv[0], recv[1])
+                    if columns is None:  # Columns are set by first flows as done for csv header.
+                        udps = decoded.get('udps', [])
+                        columns = NFColumns(layout.keys(list(udps[0].keys()) if udps else []))
+                    columns.extend_records(layout, decoded, len(recv[1]), n_flows)
+                    n_flows += len(recv[1])
+                else:  # Flow not fitting records layout.
+                    if columns is None:
+                        columns = NFColumns(recv.keys())
+                    recv.id = n_flows
+                    columns.append(recv.values())
+                    n_flows += 1
+            except KeyboardInterrupt:
+                pass
+        if columns is None:
+            return pd.DataFrame()
+        df = columns.to_pandas()
+        if ip_anonymization:
+            # Anonymization use generated secret key to hash using blake2B algo src and dst IPs.
+            anonymize = anonymizer(secrets.token_bytes(64), ip_anonymization == 'prefix')
+            for column in ["src_ip", "dst_ip"]:  # Categorical columns: each address is anonymized once.
+                df[column] = df[column].map(anonymize)
         return df
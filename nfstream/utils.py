@@ -16,10 +16,38 @@ If not, see <http://www.gnu.org/licenses/>.
 ------------------------------------------------------------------------------------------------------------------------
 """
 
+import fcntl
+import gzip
 import json
+import os
+import queue
+import tempfile
+from collections import OrderedDict
+from functools import lru_cache
+from hashlib import blake2b
+from socket import inet_pton, inet_ntop, AF_INET, AF_INET6
 import platform
 import psutil
-from threading import Timer
+import numpy as np
+import pandas as pd
+from array import array
+from bisect import bisect_left, bisect_right
+from glob import glob, escape
+from threading import Timer, Thread
+from urllib.parse import quote
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional dependency, only required by Arrow export interfaces.
+    pa, pq = None, None
+try:
+    import zstandard
+except ImportError:  # Optional dependency, only required by zstd compressed outputs.
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # Optional dependency, only required by lz4 compressed outputs.
+    lz4_frame = None
 
 
 def csv_converter(values):
@@ -31,10 +59,163 @@ def csv_converter(values):
             values[idx] = "\"" + values[idx] + "\""
 
 
-def open_file(path, chunked, chunk_idx):
-    if not chunked:
-        return open(path, 'wb')
-    return open(path.replace("csv", "{}.csv".format(chunk_idx)), 'wb')
+def anonymizer(crypto_key, prefix_preserving=False, cache_size=65536):
+    """
+        IP anonymization function with a bounded LRU cache: blake2b keyed hash of the address or, if prefix preserving,
+        Crypto-PAn style address where each bit is flipped by a keyed pseudorandom function of its prefix. Addresses
+        sharing a k bits prefix are then anonymized into addresses sharing a k bits prefix.
+    """
+    def hashed(address):
+        return blake2b(address.encode(), digest_size=64, key=crypto_key).hexdigest()
+    if not prefix_preserving:
+        return lru_cache(maxsize=cache_size)(hashed)
+
+    @lru_cache(maxsize=cache_size * 16)  # Prefixes are shared by subnet addresses.
+    def flip(n_bits, length, prefix):
+        return blake2b(bytes([n_bits, length]) + prefix.to_bytes(16, 'big'), digest_size=1,
+                       key=crypto_key).digest()[0] & 1
+
+    @lru_cache(maxsize=cache_size)
+    def anonymize(address):
+        try:
+            family, n_bits = (AF_INET6, 128) if ':' in address else (AF_INET, 32)
+            value = int.from_bytes(inet_pton(family, address), 'big')
+        except (OSError, TypeError):  # Not an address (e.g. altered by a plugin): hashed.
+            return hashed(str(address))
+        anonymized = 0
+        for length in range(n_bits):
+            bit = (value >> (n_bits - 1 - length)) & 1
+            anonymized = (anonymized << 1) | (bit ^ flip(n_bits, length, value >> (n_bits - length)))
+        return inet_ntop(family, anonymized.to_bytes(n_bits // 8, 'big'))
+    return anonymize
+
+
+def anonymize_batch(anonymize, addresses):
+    """ Anonymize addresses batch, each distinct address is computed once """
+    anonymized = {address: anonymize(address) for address in set(addresses)}
+    return [anonymized[address] for address in addresses]
+
+
+def csv_rows(layout, records, offsets, first_id, anonymize=None):
+    """
+        Format consecutive binary records as CSV rows (keys, rows), column by column with csv_converter semantics:
+        numeric values as is, others quoted with escaped quotes. src_ip and dst_ip are mapped through anonymize if set.
+    """
+    columns = layout.columns(records, offsets)
+    n_records = len(offsets)
+    udps = columns.pop('udps', [])
+    keys = layout.keys(list(udps[0].keys()) if udps else [])
+    cells = []
+    for name in keys:
+        if name == 'id':
+            cells.append(map(str, range(first_id, first_id + n_records)))
+        elif name.startswith('udps.'):
+            values = [udps_values.get(name[5:]) for udps_values in udps]
+            csv_converter(values)
+            cells.append(map(str, values))
+        elif name in layout.texts:
+            value_offsets, data = columns[name]
+            content = data.tobytes()
+            bounds = value_offsets.tolist()
+            values = [content[start:end].decode('utf-8') for start, end in zip(bounds[:-1], bounds[1:])]
+            if anonymize is not None and name in ['src_ip', 'dst_ip']:
+                values = anonymize_batch(anonymize, values)
+            if b'"' in content:
+                values = [value.replace('\"', '\\"') for value in values]
+            cells.append(['"' + value + '"' for value in values])
+        elif name.startswith('splt_'):  # Lists are quoted as csv_converter does.
+            cells.append(['"' + str(value) + '"' for value in columns[name].tolist()])
+        else:  # Python integers and floats formatting.
+            cells.append(map(str, columns[name].tolist()))
+    return keys, list(map(','.join, zip(*cells)))
+
+
+COMPRESSION_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst', 'lz4': '.lz4'}
+
+
+def open_file(path, chunked, chunk_idx, compression=None):
+    """ open output file, compressed ones get compression extension (.gz, .zst or .lz4) """
+    if chunked:
+        path = path.replace("csv", "{}.csv".format(chunk_idx))
+    path += COMPRESSION_EXTENSIONS[compression]
+    if compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    if compression == 'lz4':
+        return lz4_frame.open(path, 'wb')
+    return open(path, 'wb')
+
+
+class NFWriter(object):
+    """
+        Background files writer: files opening, compression and writes are done by a thread fed through a bounded
+        queue, producer only waits when the queue is full. Writer errors are raised on producer side.
+    """
+    def __init__(self, compression=None, max_pending=64):
+        self.compression = compression
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        f = None
+        while True:
+            item = self.queue.get()
+            try:
+                if isinstance(item, tuple) or item is None:  # Next file or termination.
+                    if f is not None:
+                        f.close()
+                        f = None
+                    if item is None:
+                        return
+                    if self.error is None:
+                        f = open_file(*item, compression=self.compression)
+                elif self.error is None:
+                    f.write(item)
+            except Exception as writer_error:  # Queue is still drained to never block producer.
+                self.error = writer_error
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+    def open(self, path, chunked, chunk_idx):
+        """ Following writes go to a new file """
+        self.put((path, chunked, chunk_idx))
+
+    def write(self, data):
+        self.put(data)
+
+    def close(self):
+        """ Wait for pending writes and close current file """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def is_capture(path):
+    """ Check if path is a pcap or pcapng file """
+    return isinstance(path, str) and path.endswith((".pcap", ".pcapng")) and os.path.isfile(path)
+
+
+def capture_files(source):
+    """ Resolve capture file, list of capture files, glob or directory to capture files list (empty if invalid) """
+    if isinstance(source, (list, tuple)):
+        if all(is_capture(path) for path in source):
+            return list(source)
+        return []
+    if not isinstance(source, str):
+        return []
+    if is_capture(source):
+        return [source]
+    if os.path.isdir(source):
+        return sorted(path for path in glob(os.path.join(escape(source), "*")) if is_capture(path))
+    return sorted(path for path in glob(source) if is_capture(path))
 
 
 def update_performances(performances, is_linux, flows_count):
@@ -52,11 +233,447 @@ def update_performances(performances, is_linux, flows_count):
             ignored = max(meter[2].value, ignored)
         processed += meter[1].value
         load.append(meter[1].value)
+    imbalance = 0.0
+    if processed > 0:  # Busiest meter load over mean load (1.0 for a perfect balance)
+        imbalance = round(max(load) * len(load) / processed, 3)
     print(json.dumps({"flows_expired": flows_count.value,
                       "packets_processed": processed,
                       "packets_ignored": ignored,
                       "packets_dropped_filtered_by_kernel": drops,
-                      "meters_packets_processing_balance": load}))
+                      "meters_packets_processing_balance": load,
+                      "meters_packets_processing_imbalance": imbalance}))
+
+
+def fanout_group(candidate):
+    """
+        Reserve a fanout group id among NFStream instances of the host: first free one from candidate, it is held
+        (as a locked file) until returned file is closed.
+    """
+    for idx in range(65536):
+        group_id = (candidate + idx) % 65536
+        f = open(os.path.join(tempfile.gettempdir(), "nfstream-fanout-{}.lock".format(group_id)), 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return group_id, f
+        except OSError:  # Already used by another instance.
+            f.close()
+    raise ValueError("Please specify a valid fanout_group_id parameter (no free fanout group id found).")
+
+
+def write_manifest(path, sink_format, compression, layout, sources, shards):
+    """
+        Write shards manifest: output format, compression, records layout (binary shards), capture sources and
+        [shard file, flows count] per meter.
+    """
+    with open(path, 'w') as f:
+        json.dump({"version": 1,
+                   "format": sink_format,
+                   "compression": compression,
+                   "layout": layout,
+                   "sources": sources,
+                   "n_flows": sum([shard[1] for shard in shards]),
+                   "shards": [{"path": shard[0], "n_flows": shard[1]} for shard in shards]}, f, indent=1)
+
+
+def write_index(path, source, interval, headers, marks):
+    """ Write source index sidecar: pcapng header blocks offsets and [time, offset] marks """
+    source_stat = os.stat(source)
+    with open(path, 'w') as f:
+        json.dump({"version": 1,
+                   "source_size": source_stat.st_size,
+                   "source_mtime_ns": source_stat.st_mtime_ns,
+                   "interval": interval,
+                   "headers": headers,
+                   "marks": marks}, f)
+
+
+def read_index(path, source):
+    """ Read source index sidecar, None if missing or outdated """
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+        source_stat = os.stat(source)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != 1 or index.get("source_size") != source_stat.st_size or \
+            index.get("source_mtime_ns") != source_stat.st_mtime_ns:
+        return None
+    return index["headers"], index["marks"]
+
+
+def index_window(marks, start_time, end_time):
+    """ Resolve [start_time, end_time[ time window to source offsets (0 for unbounded) """
+    times = [mark[0] for mark in marks]
+    start_offset, end_offset = 0, 0
+    if start_time:
+        idx = bisect_right(times, start_time) - 1
+        if idx >= 0:  # Last mark at or before start time.
+            start_offset = marks[idx][1]
+    if end_time:
+        idx = bisect_left(times, end_time)
+        if idx < len(marks):  # First mark at or after end time.
+            end_offset = marks[idx][1]
+    return start_offset, end_offset
+
+
+def index_ranges(marks, n_ranges, start_offset, end_offset, min_duration):
+    """ Split source window in up to n_ranges byte ranges of similar size, each one spanning min_duration at least """
+    window = [mark for mark in marks if mark[1] >= start_offset and (end_offset == 0 or mark[1] < end_offset)]
+    if len(window) == 0:
+        return [(start_offset, end_offset, 0)]
+    first_offset = window[0][1]
+    span = (end_offset if end_offset else window[-1][1]) - first_offset
+    cuts = [window[0]]
+    for mark in window[1:]:
+        if len(cuts) == n_ranges:
+            break
+        # Ranges shorter than min_duration would let flows span more than two ranges.
+        if mark[1] >= first_offset + span * len(cuts) // n_ranges and mark[0] >= cuts[-1][0] + min_duration:
+            cuts.append(mark)
+    ranges = []
+    for idx, cut in enumerate(cuts):
+        range_start = start_offset if idx == 0 else cut[1]
+        range_end = cuts[idx + 1][1] if idx + 1 < len(cuts) else end_offset
+        ranges.append((range_start, range_end, cut[0]))
+    return ranges
+
+
+def stitch_key(flow):
+    """ Direction agnostic flow key used to stitch flows across source ranges """
+    endpoints = sorted([(flow.src_ip, flow.src_port), (flow.dst_ip, flow.dst_port)])
+    return flow.protocol, flow.vlan_id, flow.ip_version, endpoints[0], endpoints[1]
+
+
+def flow_deadline(flow, idle_timeout, active_timeout):
+    """ Earliest time an expired flow would have been expired without further packets """
+    return min(flow.bidirectional_last_seen_ms + idle_timeout, flow.bidirectional_first_seen_ms + active_timeout)
+
+
+def range_hold(flow, range_idx, boundaries, idle_timeout, active_timeout):
+    """ Fix expiration of a flow metered on a source range and check if it may continue on a neighbour range """
+    hold = False
+    if range_idx + 1 < len(boundaries):
+        if flow.expiration_id >= 0:  # Range end cleanup is replaced by timeout reached later on source.
+            flow.expiration_id = int(flow.bidirectional_last_seen_ms + idle_timeout >
+                                     flow.bidirectional_first_seen_ms + active_timeout)
+        if flow_deadline(flow, idle_timeout, active_timeout) > boundaries[range_idx + 1]:  # Active at range end
+            hold = True
+    if range_idx > 0 and flow.bidirectional_first_seen_ms < boundaries[range_idx] + idle_timeout:
+        hold = True  # Started early enough on range to be the continuation of a previous range flow.
+    return hold
+
+
+def range_stitch(held, boundaries, idle_timeout, active_timeout, statistics, splt):
+    """ Merge flows held at source ranges boundaries and yield resulting flows """
+    tails = [dict() for _ in boundaries]
+    heads = [dict() for _ in boundaries]
+    for range_idx, flow in held:
+        key = stitch_key(flow)
+        if range_idx + 1 < len(boundaries) and \
+                flow_deadline(flow, idle_timeout, active_timeout) > boundaries[range_idx + 1]:
+            tails[range_idx][key] = flow
+        if range_idx > 0 and flow.bidirectional_first_seen_ms < boundaries[range_idx] + idle_timeout:
+            head = heads[range_idx].get(key)
+            if head is None or flow.bidirectional_first_seen_ms < head.bidirectional_first_seen_ms:
+                heads[range_idx][key] = flow
+    merged = set()
+    for range_idx in range(len(boundaries) - 1):
+        for key, tail in tails[range_idx].items():
+            head = heads[range_idx + 1].get(key)
+            if head is not None and \
+                    head.bidirectional_first_seen_ms < flow_deadline(tail, idle_timeout, active_timeout):
+                tail.merge(head, statistics, splt)
+                merged.add(id(head))
+                if tails[range_idx + 1].get(key) is head:  # Merged flow is still active at next range end.
+                    tails[range_idx + 1][key] = tail
+    for range_idx, flow in held:
+        if id(flow) not in merged:
+            yield flow
+
+
+def column_type(name):
+    """ Column buffer type of an NFlow key: array typecode, 'category' or None for generic values """
+    if name.startswith("udps.") or name.startswith("splt_"):
+        return None
+    if name in ["src_ip", "dst_ip", "application_name", "application_category_name", "requested_server_name",
+                "client_fingerprint", "server_fingerprint", "user_agent", "content_type"]:
+        return 'category'
+    if name == "expiration_id":
+        return 'b'
+    if name in ["protocol", "ip_version", "application_is_guessed"] or name.endswith("_is_private"):
+        return 'B'
+    if name in ["src_port", "dst_port", "vlan_id"]:
+        return 'H'
+    if name.endswith("_mean_ps") or name.endswith("_stddev_ps") or name.endswith("_mean_piat_ms") or \
+            name.endswith("_stddev_piat_ms"):
+        return 'd'
+    if name == "id" or name.endswith("_ms") or name.endswith("_packets") or name.endswith("_bytes") or \
+            name.endswith("_ps"):
+        return 'Q'
+    return None
+
+
+class NFColumns(object):
+    """ Typed column buffers filled as flows arrive and turned into a DataFrame without intermediate file """
+    def __init__(self, names):
+        self.names = names
+        self.types = [column_type(name) for name in names]
+        self.buffers = []
+        self.appenders = []
+        for idx, column in enumerate(self.types):
+            if column == 'category':  # Dictionary encoded: codes buffer and categories mapping.
+                self.buffers.append((array('i'), {}))
+                self.appenders.append(self.category_appender(*self.buffers[idx]))
+            elif column is None:
+                self.buffers.append([])
+                self.appenders.append(self.buffers[idx].append)
+            else:
+                self.buffers.append(array(column))
+                self.appenders.append(self.buffers[idx].append)
+
+    @staticmethod
+    def category_appender(codes, categories):
+        def append(value):
+            code = categories.get(value)
+            if code is None:
+                if not isinstance(value, str):
+                    raise TypeError("category values must be strings")
+                code = categories[value] = len(categories)
+            codes.append(code)
+        return append
+
+    def generic(self, idx):
+        """ Turn column into a generic one, used when a value does not fit its type (e.g. set by a plugin) """
+        if self.types[idx] == 'category':
+            codes, categories = self.buffers[idx]
+            names = list(categories.keys())
+            self.buffers[idx] = [names[code] for code in codes]
+        else:
+            self.buffers[idx] = list(self.buffers[idx])
+        self.types[idx] = None
+        self.appenders[idx] = self.buffers[idx].append
+
+    def append(self, values):
+        """ Append a flow values (same order as names) """
+        idx = 0
+        while idx < len(values):
+            try:
+                for idx in range(idx, len(values)):
+                    self.appenders[idx](values[idx])
+                return
+            except (TypeError, OverflowError):
+                self.generic(idx)
+                self.appenders[idx](values[idx])
+                idx += 1
+
+    def extend(self, idx, values):
+        """ Append a column values: numpy arrays fitting column type are appended at once """
+        column = self.types[idx]
+        if column == 'category':
+            codes, categories = self.buffers[idx]
+            codes.extend([categories.setdefault(value, len(categories)) for value in values])
+            return
+        if column is not None and isinstance(values, np.ndarray):
+            if values.dtype.kind != 'f' or column == 'd':
+                if column == 'd' or len(values) == 0 or values.min() >= np.iinfo(np.dtype(column)).min and \
+                        values.max() <= np.iinfo(np.dtype(column)).max:
+                    self.buffers[idx].frombytes(values.astype(column).tobytes())
+                    return
+            values = values.tolist()
+        for value in values:
+            try:
+                self.appenders[idx](value)
+            except (TypeError, OverflowError):
+                self.generic(idx)
+                self.appenders[idx](value)
+
+    def extend_records(self, layout, columns, n_records, first_id):
+        """ Append records decoded as columns (see NFRecord.columns) without building flows """
+        udps = columns.get('udps', [])
+        for idx, name in enumerate(self.names):
+            if name == 'id':
+                values = np.arange(first_id, first_id + n_records, dtype=np.uint64)
+            elif name.startswith('udps.'):
+                values = [udps_values.get(name[5:]) for udps_values in udps]
+            elif name in layout.texts:
+                value_offsets, data = columns[name]
+                content = data.tobytes()
+                bounds = value_offsets.tolist()
+                values = [content[start:end].decode('utf-8') for start, end in zip(bounds[:-1], bounds[1:])]
+            elif name.startswith('splt_'):
+                values = columns[name].tolist()
+            else:
+                values = columns[name]
+            self.extend(idx, values)
+
+    def to_pandas(self):
+        """ Build DataFrame from buffers: numeric columns are typed, names are categorical """
+        columns = {}
+        for name, column, buffer in zip(self.names, self.types, self.buffers):
+            if column == 'category':
+                codes, categories = buffer
+                names = np.array(list(categories.keys()), dtype=object)
+                order = np.argsort(names)  # Categories are sorted to keep values order on sort.
+                ranks = np.empty(len(order), dtype=np.int32)
+                ranks[order] = np.arange(len(order), dtype=np.int32)
+                columns[name] = pd.Categorical.from_codes(ranks[np.frombuffer(codes, dtype=np.int32)],
+                                                          categories=names[order])
+            elif column is None:
+                # Lists and other structures are represented as text as in CSV export.
+                columns[name] = pd.Series([value if value is None or isinstance(value, (bool, int, float, str))
+                                           else str(value) for value in buffer])
+            else:
+                columns[name] = np.frombuffer(buffer, dtype=column)
+        return pd.DataFrame(columns, columns=self.names)
+
+
+def arrow_batch(layout, records, offsets, first_id):
+    """ Build an Arrow RecordBatch from consecutive binary records, flows IDs starting from first_id """
+    columns = layout.columns(records, offsets)
+    n_records = len(offsets)
+    udps = columns.pop('udps', [])
+    udps_keys = list(udps[0].keys()) if udps else []
+    names = layout.keys(udps_keys)
+    arrays = []
+    for name in names:
+        column = column_type(name)
+        if name == 'id':
+            arrays.append(pa.array(np.arange(first_id, first_id + n_records, dtype=np.uint64)))
+        elif name.startswith('udps.'):
+            values = [udps_values.get(name[5:]) for udps_values in udps]
+            try:
+                arrays.append(pa.array(values))
+            except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                # Values without Arrow type are represented as text as in CSV export.
+                arrays.append(pa.array([value if value is None else str(value) for value in values]))
+        elif column == 'category':
+            value_offsets, data = columns[name]
+            arrays.append(pa.StringArray.from_buffers(n_records, pa.py_buffer(value_offsets), pa.py_buffer(data)))
+        elif column is None:  # splt: fixed size lists over flattened values.
+            arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(columns[name].reshape(-1)), layout.splt))
+        else:
+            values = columns[name]
+            if values.dtype.kind == 'i' and n_records:  # Narrowed only when all values fit.
+                bounds = np.iinfo(np.dtype(column))
+                if values.min() >= bounds.min and values.max() <= bounds.max:
+                    values = values.astype(column)
+            arrays.append(pa.array(np.ascontiguousarray(values)))
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+class NFParquetSink(object):
+    """
+        Parquet files sink: batches are split by partition (hive style directories) and buffered until they fill a
+        row group. Partitions are retired (flushed and closed) once no more flows can land in their time bucket
+        (bucket end is retention msecs behind expired flows watermark) or, least recently used first, when more than
+        max_partitions are open: memory is bounded by row group size times max_partitions. Rows landing in a retired
+        partition are written to a new part file.
+    """
+    def __init__(self, path, partition_by, compression, row_group_size, retention=0, max_partitions=64):
+        self.path = path
+        self.partition_by = partition_by
+        self.compression = compression
+        self.row_group_size = row_group_size
+        self.retention = retention
+        self.max_partitions = max_partitions
+        self.schema = None  # Shared by all files, udps columns types are fixed by first written rows.
+        self.writers = {}
+        self.pending = {}
+        self.active = OrderedDict()  # Partitions with pending rows or open file, least recently used first.
+        self.parts = {}
+        self.watermark = 0
+        self.n_rows = 0
+
+    def partitions(self, batch):
+        """ Split batch as (partition directory, batch) pairs """
+        if self.partition_by is None:
+            return [(None, batch)]
+        if self.partition_by == 'application_name':
+            keys = batch.column('application_name').to_numpy(zero_copy_only=False)
+            batch = batch.drop_columns(['application_name'])  # Restored from directory name on read.
+        else:  # Time bucket start of flows first seen.
+            keys = batch.column('bidirectional_first_seen_ms').to_numpy()
+            keys = keys - keys % self.partition_by
+        if len(keys) == 0:
+            return []
+        uniques, inverse = np.unique(keys, return_inverse=True)
+        partitions = []
+        for idx, key in enumerate(uniques.tolist()):
+            if self.partition_by == 'application_name':
+                directory = 'application_name=' + quote(key, safe='')
+            else:
+                directory = 'time_bucket=' + str(key)
+            partitions.append((directory, batch.filter(pa.array(inverse == idx))))
+        return partitions
+
+    def write(self, batch):
+        """ Write batch, full row groups are flushed to their partition file and unused partitions retired """
+        for partition, rows in self.partitions(batch):
+            pending = self.pending.setdefault(partition, [])
+            pending.append(rows)
+            self.active[partition] = None
+            self.active.move_to_end(partition)
+            if sum([rows.num_rows for rows in pending]) >= self.row_group_size:
+                self.flush(partition)
+        if isinstance(self.partition_by, int) and batch.num_rows:
+            self.watermark = max(self.watermark, batch.column('bidirectional_last_seen_ms').to_numpy().max())
+            for partition in list(self.active.keys()):
+                if int(partition[12:]) + self.partition_by + self.retention <= self.watermark:
+                    self.retire(partition)
+        while len(self.active) > self.max_partitions:
+            self.retire(next(iter(self.active)))
+        self.n_rows += batch.num_rows
+
+    def conform(self, table):
+        """ Cast table to files schema """
+        if self.schema is None:  # udps columns without values yet are typed as text.
+            self.schema = pa.schema([pa.field(field.name, pa.string()) if pa.types.is_null(field.type) else field
+                                     for field in table.schema])
+        if table.schema == self.schema:
+            return table
+        columns = []
+        for field in self.schema:
+            column = table.column(field.name)
+            if column.type != field.type:  # udps columns types are inferred per batch.
+                try:
+                    column = column.cast(field.type)
+                except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+                    raise ValueError("Please use consistent {} values types for Parquet export ({} column type is "
+                                     "set by first written flows).".format(field.name, field.type))
+            columns.append(column)
+        return pa.Table.from_arrays(columns, schema=self.schema)
+
+    def flush(self, partition):
+        """ Write partition pending rows as row groups """
+        pending = self.pending.pop(partition, [])
+        if not pending:
+            return
+        table = self.conform(pa.concat_tables([pa.Table.from_batches([rows]) for rows in pending],
+                                              promote_options="default"))
+        writer = self.writers.get(partition)
+        if writer is None:
+            if partition is None:
+                path = self.path
+            else:
+                os.makedirs(os.path.join(self.path, partition), exist_ok=True)
+                part = self.parts[partition] = self.parts.get(partition, -1) + 1
+                path = os.path.join(self.path, partition, 'part-{}.parquet'.format(part))
+            writer = self.writers[partition] = pq.ParquetWriter(path, self.schema, compression=self.compression)
+        writer.write_table(table, row_group_size=self.row_group_size)
+
+    def retire(self, partition):
+        """ Flush partition pending rows and close its file """
+        self.flush(partition)
+        writer = self.writers.pop(partition, None)
+        if writer is not None:
+            writer.close()
+        del self.active[partition]
+
+    def close(self):
+        """ Flush pending rows and close files, return number of written rows """
+        for partition in list(self.active.keys()):
+            self.retire(partition)
+        return self.n_rows
 
 
 class RepeatedTimer(object):
@@ -112,6 +112,9 @@ setup(
     author_email='aouinizied@gmail.com',
     packages=['nfstream'],
     install_requires=install_requires,
+    # pyarrow 14 (required by Arrow and Parquet interfaces) is only available for Python 3.8+.
+    extras_require={'arrow': ['pyarrow>=14.0.0; python_version >= "3.8"'],
+                    'compression': ['zstandard>=0.15.0', 'lz4>=3.1.0']},
     cmdclass=cmdclass,
     setup_requires=pytest_runner,
     tests_require=['pytest>=5.0.1'],
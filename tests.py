@@ -18,11 +18,21 @@ If not, see <http://www.gnu.org/licenses/>.
 
 import unittest
 import pandas as pd
+import numpy as np
 import json
 import os
 import csv
+import glob
+import socket
+import struct
+import subprocess
+import math
 from nfstream import NFStreamer, NFPlugin
-from nfstream.plugin import SPLT
+from nfstream.plugin import SPLT, NFHooks, NFNativePlugin
+from nfstream.flow import NFRecord
+from nfstream.exporter import NFExporter
+from nfstream.utils import anonymizer, NFParquetSink, pa, fanout_group
+import ipaddress
 
 
 def get_files_list(path):
@@ -60,6 +70,37 @@ def build_ndpi_dict(path):
     return ndpi
 
 
+def count_ipfix_records(datagrams):
+    """ Count IPFIX data records, records are walked using received templates fields lengths """
+    templates, n_records = {}, 0
+    for datagram in datagrams:
+        offset = 16
+        while offset < len(datagram):
+            set_id, set_length = struct.unpack_from('>HH', datagram, offset)
+            position, end = offset + 4, offset + set_length
+            while position < end:
+                if set_id == 2:  # Template set
+                    template_id, n_fields = struct.unpack_from('>HH', datagram, position)
+                    position += 4
+                    templates[template_id] = []
+                    for _ in range(n_fields):
+                        element_id, length = struct.unpack_from('>HH', datagram, position)
+                        position += 8 if element_id & 0x8000 else 4
+                        templates[template_id].append(length)
+                    continue
+                for length in templates[set_id]:
+                    if length == 65535:  # Variable length
+                        length = datagram[position]
+                        position += 1
+                        if length == 255:
+                            length = struct.unpack_from('>H', datagram, position)[0]
+                            position += 2
+                    position += length
+                n_records += 1
+            offset = end
+    return n_records
+
+
 class OnePacketExpire(NFPlugin):
     def on_init(self, packet, flow):
         flow.expiration_id = -1
@@ -71,6 +112,80 @@ class FourPacketExpire(NFPlugin):
             flow.expiration_id = -1
 
 
+class EndpointsCheck(NFPlugin):
+    def on_init(self, packet, flow):
+        flow.udps.mismatches = int((packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port) !=
+                                   (flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port))
+
+    def on_update(self, packet, flow):
+        if packet.direction == 0:
+            endpoints = (packet.src_ip, packet.src_port, packet.dst_ip, packet.dst_port)
+        else:
+            endpoints = (packet.dst_ip, packet.dst_port, packet.src_ip, packet.src_port)
+        flow.udps.mismatches += int(endpoints != (flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port))
+
+
+class EndpointsLabel(NFPlugin):
+    def on_expire(self, flow):
+        flow.udps.endpoints = (flow.src_ip, flow.dst_ip)
+        if flow.protocol == 17:  # Altered slot type, flow no more fits records layout.
+            flow.src_port = str(flow.src_port)
+
+
+class PacketsLabel(NFPlugin):
+    def on_expire(self, flow):
+        flow.udps.packets = flow.bidirectional_packets
+
+
+class PacketContent(NFPlugin):
+    def on_init(self, packet, flow):
+        flow.udps.packet_type = type(packet.ip_packet).__name__
+        flow.udps.version_mismatches = 0
+
+    def on_update(self, packet, flow):
+        if len(packet.ip_packet):
+            flow.udps.version_mismatches += int(packet.ip_packet[0] >> 4 != packet.ip_version)
+
+
+class BatchCounters(NFPlugin):
+    def on_update_batch(self, packets, flows):
+        sizes = np.bincount(packets["flow_idx"], weights=packets["raw_size"], minlength=len(flows))
+        syns = np.bincount(packets["flow_idx"], weights=packets["syn"], minlength=len(flows))
+        for flow, size, syn in zip(flows, sizes, syns):
+            flow.udps.batch_bytes = getattr(flow.udps, "batch_bytes", 0) + int(size)
+            flow.udps.batch_syn_packets = getattr(flow.udps, "batch_syn_packets", 0) + int(syn)
+
+
+class PayloadEntropy(NFPlugin):
+    def on_init(self, packet, flow):
+        flow.udps.histogram = [0] * 256
+        self.on_update(packet, flow)
+
+    def on_update(self, packet, flow):
+        for byte in packet.ip_packet[packet.ip_size - packet.payload_size:]:
+            flow.udps.histogram[byte] += 1
+
+    def on_expire(self, flow):
+        total = sum(flow.udps.histogram)
+        flow.udps.entropy = -sum([count / total * math.log2(count / total) for count in flow.udps.histogram if count])
+        del flow.udps.histogram
+
+
+class FieldsReader(NFPlugin):
+    flow_fields = ['bidirectional_packets', 'bidirectional_last_seen_ms', 'bidirectional_stddev_ps', 'splt_ps']
+
+    def on_init(self, packet, flow):
+        flow.udps.updates = 0
+
+    def on_update(self, packet, flow):
+        flow.udps.updates += 1
+        flow.udps.packets = flow.bidirectional_packets
+        flow.udps.last_seen = flow.bidirectional_last_seen_ms
+        flow.udps.stddev_ps = flow.bidirectional_stddev_ps
+        flow.udps.splt_ps = flow.splt_ps
+        flow.udps.bytes = flow.bidirectional_bytes  # Not declared: synced at expiration only.
+
+
 class TestMethods(unittest.TestCase):
 
     def test_parameters_handling(self):
@@ -132,7 +247,8 @@ class TestMethods(unittest.TestCase):
                     print(flow)
             except ValueError:
                 value_errors += 1
-        udps = [lambda y: y+1, "NFPlugin"]
+        udps = [lambda y: y+1, "NFPlugin", NFPlugin(flow_fields=['inexisting']),
+                NFPlugin(flow_fields='bidirectional_packets')]
         for x in udps:
             try:
                 for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', udps=x):
@@ -174,7 +290,78 @@ class TestMethods(unittest.TestCase):
                     print(flow)
             except ValueError:
                 value_errors += 1
-        self.assertEqual(value_errors, 31)
+        single_pass = ["yes", 1]
+        for x in single_pass:
+            try:
+                for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', single_pass=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        native_engine = ["yes", 1]
+        for x in native_engine:
+            try:
+                for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', native_engine=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        dispatch_hash = ["yes", 3]
+        for x in dispatch_hash:
+            try:
+                for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', dispatch_hash=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        capture_parameters = {"fanout_mode": ["yes", 6], "fanout_defrag": ["yes", 1], "fanout_group_id": ["yes", 65536],
+                              "buffer_size": ["yes", -1], "immediate_mode": ["yes", 1], "poll_timeout": ["yes", 0]}
+        for parameter, values in capture_parameters.items():
+            for x in values:
+                try:
+                    for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', **{parameter: x}):
+                        print(flow)
+                except ValueError:
+                    value_errors += 1
+        window_parameters = {"start_time": ["yes", -1], "end_time": ["yes", 0], "range_partitioning": ["yes", 1]}
+        for parameter, values in window_parameters.items():
+            for x in values:
+                try:
+                    for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', **{parameter: x}):
+                        print(flow)
+                except ValueError:
+                    value_errors += 1
+        try:
+            NFStreamer(source='tests/pcap/google_ssl.pcap').build_index(interval=0)
+        except ValueError:
+            value_errors += 1
+        try:
+            list(NFStreamer(source='tests/pcap/google_ssl.pcap').iter_batches(batch_size=0))
+        except ValueError:
+            value_errors += 1
+        parquet_parameters = {"partition_by": ["yes", 0], "compression": ["rar"], "row_group_size": [0]}
+        for parameter, values in parquet_parameters.items():
+            for x in values:
+                try:
+                    NFStreamer(source='tests/pcap/google_ssl.pcap').to_parquet(**{parameter: x})
+                except ValueError:
+                    value_errors += 1
+        for shards_parameters in [{"sink_format": "json"}, {"sink_format": "csv", "compression": "snappy"}]:
+            try:
+                NFStreamer(source='tests/pcap/google_ssl.pcap').to_shards(**shards_parameters)
+            except ValueError:
+                value_errors += 1
+        try:
+            NFStreamer(source='tests/pcap/google_ssl.pcap').to_csv(compression="bz2")
+        except ValueError:
+            value_errors += 1
+        ipfix_parameters = {"collector": ["127.0.0.1:4739", ("127.0.0.1", 0)], "version": [5], "mtu": [100],
+                            "template_refresh": [0], "observation_domain_id": [-1]}
+        for parameter, values in ipfix_parameters.items():
+            for x in values:
+                try:
+                    NFStreamer(source='tests/pcap/google_ssl.pcap').to_ipfix(**dict({"collector": ("127.0.0.1", 4739)},
+                                                                                    **{parameter: x}))
+                except ValueError:
+                    value_errors += 1
+        self.assertEqual(value_errors, 72)
         print("{}\t: \033[94mOK\033[0m".format(".Test parameters handling".ljust(60, ' ')))
 
     def test_expiration_management(self):
@@ -193,6 +380,14 @@ class TestMethods(unittest.TestCase):
         for flow in streamer_expiration:
             last_id = flow.id
         self.assertEqual(last_id, 27)
+        # Active expiration without further packets (timer wheel)
+        for native_engine in [False, True]:
+            active_expirations = 0
+            for flow in NFStreamer(source='tests/pcap/teams.pcap', active_timeout=2, native_engine=native_engine,
+                                   n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+                active_expirations += flow.expiration_id
+                self.assertLess(flow.bidirectional_duration_ms, 2000)
+            self.assertEqual(active_expirations, 100)
         # Custom expiration
 
         streamer_expiration = NFStreamer(source='tests/pcap/google_ssl.pcap', udps=OnePacketExpire(),
@@ -321,6 +516,59 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(df_anon.shape[1], df.shape[1])
         self.assertEqual(df_anon['src_ip'].nunique(), df['src_ip'].nunique())
         self.assertEqual(df_anon['dst_ip'].nunique(), df['dst_ip'].nunique())
+        df_prefix = NFStreamer(source='tests/pcap/steam.pcap', n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                               n_dissections=20).to_pandas(ip_anonymization='prefix')
+        self.assertEqual(df_prefix['src_ip'].nunique(), df['src_ip'].nunique())
+        self.assertTrue(all([ipaddress.ip_address(address) for address in df_prefix['dst_ip']]))
+        anonymize = anonymizer(os.urandom(64), prefix_preserving=True)
+        addresses = ['192.168.1.1', '192.168.1.2', '192.168.2.1', '10.0.0.1', 'fe80::1', 'fe80::1:2']
+        for address in addresses:
+            for other in [x for x in addresses if (':' in x) == (':' in address)]:
+                address_bits, other_bits = [bin(int(ipaddress.ip_address(x)))[2:].zfill(128) for x in [address, other]]
+                anonymized_bits, other_anonymized_bits = [bin(int(ipaddress.ip_address(anonymize(x))))[2:].zfill(128)
+                                                          for x in [address, other]]
+                prefix = os.path.commonprefix([address_bits, other_bits])
+                self.assertEqual(len(os.path.commonprefix([anonymized_bits, other_anonymized_bits])), len(prefix))
+        self.assertEqual(df['bidirectional_packets'].dtype, 'uint64')
+        self.assertEqual(df['src2dst_mean_ps'].dtype, 'float64')
+        self.assertEqual(df['dst_port'].dtype, 'uint16')
+        self.assertEqual(df['application_name'].dtype, 'category')
+        batches = list(NFStreamer(source='tests/pcap/steam.pcap',
+                                  statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                  n_dissections=20).iter_batches(batch_size=10))
+        table = NFStreamer(source='tests/pcap/steam.pcap',
+                           statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                           n_dissections=20).to_arrow()
+        self.assertTrue(all([batch.num_rows <= 10 for batch in batches]))
+        self.assertEqual(sum([batch.num_rows for batch in batches]), df.shape[0])
+        self.assertEqual(table.column_names, list(df.columns))
+        self.assertEqual(table.column('id').to_pylist(), list(range(df.shape[0])))
+        self.assertEqual(str(table.schema.field('dst_port').type), 'uint16')
+        self.assertEqual(sorted(table.column('src2dst_bytes').to_pylist()), sorted(df['src2dst_bytes'].tolist()))
+        self.assertEqual(sorted(table.column('requested_server_name').to_pylist()),
+                         sorted(df['requested_server_name'].tolist()))
+        total_flows_parquet = NFStreamer(source='tests/pcap/steam.pcap',
+                                         statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                         n_dissections=20).to_parquet(row_group_size=10)
+        df_from_parquet = pd.read_parquet('tests/pcap/steam.pcap.parquet')
+        os.remove('tests/pcap/steam.pcap.parquet')
+        self.assertEqual(total_flows_parquet, df.shape[0])
+        self.assertEqual(list(df_from_parquet.columns), list(df.columns))
+        self.assertEqual(sorted(df_from_parquet['bidirectional_bytes'].tolist()),
+                         sorted(df['bidirectional_bytes'].tolist()))
+        total_flows_parquet = NFStreamer(source='tests/pcap/steam.pcap',
+                                         n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                         n_dissections=20).to_parquet(partition_by=60000)
+        df_from_parquet = pd.read_parquet('tests/pcap/steam.pcap.parquet')
+        for partition in glob.glob('tests/pcap/steam.pcap.parquet/*/*.parquet'):
+            os.remove(partition)
+        for partition in glob.glob('tests/pcap/steam.pcap.parquet/*'):
+            os.rmdir(partition)
+        os.rmdir('tests/pcap/steam.pcap.parquet')
+        self.assertEqual(total_flows_parquet, df.shape[0])
+        self.assertEqual(df_from_parquet.shape[0], df.shape[0])
+        self.assertTrue((df_from_parquet['time_bucket'].astype('int64') ==
+                         df_from_parquet['bidirectional_first_seen_ms'] // 60000 * 60000).all())
 
         total_flows = NFStreamer(source='tests/pcap/steam.pcap',
                                  statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
@@ -335,8 +583,61 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(total_flows_anon, df_anon_from_csv.shape[0])
         self.assertEqual(total_flows, df.shape[0])
         self.assertEqual(total_flows_anon, df_anon.shape[0])
+        self.assertEqual(df_from_csv['src2dst_bytes'].sum(), df['src2dst_bytes'].sum())
+        self.assertEqual(sorted(df_from_csv['requested_server_name'].fillna('').tolist()),
+                         sorted(df['requested_server_name'].tolist()))
+        total_flows_chunked = NFStreamer(source='tests/pcap/steam.pcap',
+                                         statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                         n_dissections=20).to_csv(ip_anonymization=True, flows_per_file=10)
+        chunks = sorted(glob.glob('tests/pcap/steam.pcap.*.csv'))
+        df_chunks = [pd.read_csv(chunk) for chunk in chunks]
+        for chunk in chunks:
+            os.remove(chunk)
+        self.assertEqual(total_flows_chunked, total_flows)
+        self.assertEqual(len(chunks), (total_flows + 9) // 10)
+        self.assertTrue(all([df_chunk.shape[0] <= 10 for df_chunk in df_chunks]))
+        self.assertEqual(sum([df_chunk.shape[0] for df_chunk in df_chunks]), total_flows)
+        total_flows_gzip = NFStreamer(source='tests/pcap/steam.pcap',
+                                      statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                      n_dissections=20).to_csv(flows_per_file=30, compression='gzip')
+        chunks = sorted(glob.glob('tests/pcap/steam.pcap.*.csv.gz'))
+        df_chunks = [pd.read_csv(chunk, compression='gzip') for chunk in chunks]
+        for chunk in chunks:
+            os.remove(chunk)
+        self.assertEqual(total_flows_gzip, total_flows)
+        self.assertEqual(len(chunks), (total_flows + 29) // 30)
+        self.assertEqual(pd.concat(df_chunks)['bidirectional_bytes'].sum(), df['bidirectional_bytes'].sum())
         print("{}\t: \033[94mOK\033[0m".format(".Test export interfaces".ljust(60, ' ')))
 
+    def test_parquet_sink(self):
+        print("\n----------------------------------------------------------------------")
+        path = 'tests/pcap/sink.parquet'
+        sink = NFParquetSink(path, 1000, None, 10, retention=0, max_partitions=2)
+        for first_seen, last_seen, value in [(0, 500, None), (1500, 2100, 1), (0, 2200, 2)]:
+            sink.write(pa.RecordBatch.from_pydict({'bidirectional_first_seen_ms': pa.array([first_seen], pa.uint64()),
+                                                   'bidirectional_last_seen_ms': pa.array([last_seen], pa.uint64()),
+                                                   'udps.x': [value]}))
+            self.assertEqual(len(sink.writers), 0)  # Buckets behind watermark are closed.
+        self.assertEqual(sink.close(), 3)
+        self.assertEqual(sorted(os.listdir(os.path.join(path, 'time_bucket=0'))), ['part-0.parquet', 'part-1.parquet'])
+        df_sink = pd.read_parquet(path)
+        self.assertEqual(sorted(df_sink['udps.x'].fillna('').tolist()), ['', '1', '2'])
+        sink = NFParquetSink(path, 'application_name', None, 1, max_partitions=2)
+        for application_name in ['TLS', 'DNS', 'QUIC', 'TLS']:
+            sink.write(pa.RecordBatch.from_pydict({'application_name': [application_name], 'udps.x': [1]}))
+            self.assertTrue(len(sink.writers) <= 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(path, 'application_name=TLS'))),
+                         ['part-0.parquet', 'part-1.parquet'])
+        with self.assertRaises(ValueError):
+            sink.write(pa.RecordBatch.from_pydict({'application_name': ['DNS'], 'udps.x': ['a']}))
+        sink.close()
+        for partition in glob.glob(os.path.join(path, '*', '*.parquet')):
+            os.remove(partition)
+        for partition in glob.glob(os.path.join(path, '*')):
+            os.rmdir(partition)
+        os.rmdir(path)
+        print("{}\t: \033[94mOK\033[0m".format(".Test Parquet sink".ljust(60, ' ')))
+
     def test_bpf(self):
         print("\n----------------------------------------------------------------------")
         streamer_test = NFStreamer(source='tests/pcap/facebook.pcap',
@@ -350,6 +651,321 @@ class TestMethods(unittest.TestCase):
         del streamer_test
         print("{}\t: \033[94mOK\033[0m".format(".Test BPF".ljust(60, ' ')))
 
+    def test_single_pass(self):
+        print("\n----------------------------------------------------------------------")
+        multiple_pass = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True,
+                                   n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        single_pass = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True,
+                                 n_meters=int(os.getenv('MAX_NFMETERS', 0)), single_pass=True).to_pandas()
+        self.assertEqual(single_pass.shape, multiple_pass.shape)
+        to_compare = ["src_ip", "src_port", "dst_ip", "dst_port", "protocol", "bidirectional_first_seen_ms",
+                      "bidirectional_packets", "bidirectional_bytes", "src2dst_packets", "bidirectional_mean_ps"]
+        multiple_pass = multiple_pass[to_compare].sort_values(to_compare).reset_index(drop=True)
+        single_pass = single_pass[to_compare].sort_values(to_compare).reset_index(drop=True)
+        self.assertTrue(single_pass.equals(multiple_pass))
+        print("{}\t: \033[94mOK\033[0m".format(".Test single pass offline reader".ljust(60, ' ')))
+
+    def test_native_engine(self):
+        print("\n----------------------------------------------------------------------")
+        interpreted = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True, splt_analysis=10,
+                                 n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        native = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True, splt_analysis=10,
+                            n_meters=int(os.getenv('MAX_NFMETERS', 0)), native_engine=True).to_pandas()
+        self.assertEqual(native.shape, interpreted.shape)
+        to_compare = list(interpreted.columns.drop("id"))
+        interpreted = interpreted[to_compare].astype(str).sort_values(to_compare).reset_index(drop=True)
+        native = native[to_compare].astype(str).sort_values(to_compare).reset_index(drop=True)
+        self.assertTrue(native.equals(interpreted))
+        # Idle expiration handled by native engine
+        last_id = 0
+        for flow in NFStreamer(source='tests/pcap/google_ssl.pcap', idle_timeout=0,
+                               n_meters=int(os.getenv('MAX_NFMETERS', 0)), native_engine=True):
+            last_id = flow.id
+        self.assertEqual(last_id, 27)
+        # Per packet plugins entrypoints run in Python meters: native engine is ignored with a warning.
+        with self.assertWarns(RuntimeWarning):
+            flows = list(NFStreamer(source='tests/pcap/google_ssl.pcap', udps=PacketContent(),
+                                    n_meters=int(os.getenv('MAX_NFMETERS', 0)), native_engine=True))
+        self.assertTrue(all([flow.udps.version_mismatches == 0 for flow in flows]))
+        print("{}\t: \033[94mOK\033[0m".format(".Test native flow engine".ljust(60, ' ')))
+
+    def test_fanout_group(self):
+        print("\n----------------------------------------------------------------------")
+        group_id, group_lock = fanout_group(65535)
+        other_group_id, other_group_lock = fanout_group(group_id)  # Reserved ids are skipped.
+        self.assertNotEqual(other_group_id, group_id)
+        group_lock.close()
+        self.assertEqual(fanout_group(group_id)[0], group_id)
+        other_group_lock.close()
+        print("{}\t: \033[94mOK\033[0m".format(".Test fanout group reservation".ljust(60, ' ')))
+
+    def test_dispatch_hash(self):
+        print("\n----------------------------------------------------------------------")
+        to_compare = ["src_ip", "src_port", "dst_ip", "dst_port", "protocol", "bidirectional_first_seen_ms",
+                      "bidirectional_packets", "bidirectional_bytes", "src2dst_packets"]
+        for pcap in ['tests/pcap/steam.pcap', 'tests/pcap/6in6tunnel.pcap']:
+            results = []
+            for dispatch_hash in [0, 1, 2]:
+                flows = NFStreamer(source=pcap, dispatch_hash=dispatch_hash, n_dissections=0,
+                                   n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()[to_compare]
+                results.append(flows.sort_values(to_compare).reset_index(drop=True))
+            # Symmetric hashes: both flow directions are handled by the same meter whatever the hash.
+            self.assertTrue(results[0].equals(results[1]))
+            self.assertTrue(results[0].equals(results[2]))
+        print("{}\t: \033[94mOK\033[0m".format(".Test dispatch hash".ljust(60, ' ')))
+
+    def test_flow_key(self):
+        print("\n----------------------------------------------------------------------")
+        for pcap in ['tests/pcap/google_ssl.pcap', 'tests/pcap/6in6tunnel.pcap']:
+            n_flows = 0
+            for flow in NFStreamer(source=pcap, udps=EndpointsCheck(), n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+                self.assertEqual(flow.udps.mismatches, 0)
+                n_flows += 1
+            self.assertGreater(n_flows, 0)
+        ipv6 = NFStreamer(source='tests/pcap/6in6tunnel.pcap', decode_tunnels=False,
+                          n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        self.assertTrue(all(":" in ip for ip in ipv6["src_ip"]))
+        print("{}\t: \033[94mOK\033[0m".format(".Test binary flow key".ljust(60, ' ')))
+
+    def test_source_index(self):
+        print("\n----------------------------------------------------------------------")
+        pcap = 'tests/pcap/webex.pcap'
+        to_compare = ["src_ip", "src_port", "dst_ip", "dst_port", "protocol", "bidirectional_first_seen_ms",
+                      "bidirectional_last_seen_ms", "bidirectional_packets", "bidirectional_bytes", "src2dst_packets",
+                      "dst2src_bytes", "bidirectional_mean_ps", "expiration_id"]
+        sequential = NFStreamer(source=pcap, idle_timeout=1, statistical_analysis=True,
+                                n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()[to_compare]
+        ranges = NFStreamer(source=pcap, idle_timeout=1, statistical_analysis=True, range_partitioning=True,
+                            n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()[to_compare]
+        # Stitched statistics are merged moments: equal up to floating point rounding.
+        sequential = sequential.round(6).astype(str).sort_values(to_compare).reset_index(drop=True)
+        ranges = ranges.round(6).astype(str).sort_values(to_compare).reset_index(drop=True)
+        self.assertTrue(ranges.equals(sequential))  # Flows spanning ranges boundaries are stitched.
+        start_time, end_time = 1444570650000, 1444570700000
+        scanned = NFStreamer(source=pcap, start_time=start_time, end_time=end_time,
+                             n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        self.assertGreater(NFStreamer(source=pcap).build_index(interval=100), 0)
+        indexed = NFStreamer(source=pcap, start_time=start_time, end_time=end_time,
+                             n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        os.remove(pcap + '.nfindex')
+        self.assertGreater(indexed.shape[0], 0)
+        self.assertTrue(indexed["bidirectional_first_seen_ms"].min() >= start_time)
+        self.assertTrue(indexed["bidirectional_last_seen_ms"].max() < end_time)
+        to_compare = to_compare[:-2]
+        scanned = scanned[to_compare].astype(str).sort_values(to_compare).reset_index(drop=True)
+        indexed = indexed[to_compare].astype(str).sort_values(to_compare).reset_index(drop=True)
+        self.assertTrue(indexed.equals(scanned))
+        print("{}\t: \033[94mOK\033[0m".format(".Test source index".ljust(60, ' ')))
+
+    def test_multiple_files(self):
+        print("\n----------------------------------------------------------------------")
+        pcaps = sorted(glob.glob('tests/pcap/443-*.pcap'))
+        n_flows = sum([len(list(NFStreamer(source=pcap))) for pcap in pcaps])
+        self.assertEqual(len(list(NFStreamer(source='tests/pcap/443-*.pcap',
+                                             n_meters=int(os.getenv('MAX_NFMETERS', 0))))), n_flows)
+        single = NFStreamer(source='tests/pcap/google_ssl.pcap').to_pandas()
+        # Same file twice: packets are interleaved in time order and each flow is seen with twice its packets.
+        merged = NFStreamer(source=['tests/pcap/google_ssl.pcap', 'tests/pcap/google_ssl.pcap'],
+                            n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        self.assertEqual(merged.shape[0], single.shape[0])
+        self.assertEqual(merged["bidirectional_packets"].sum(), 2 * single["bidirectional_packets"].sum())
+        self.assertEqual(merged["bidirectional_duration_ms"].sum(), single["bidirectional_duration_ms"].sum())
+        print("{}\t: \033[94mOK\033[0m".format(".Test multiple files".ljust(60, ' ')))
+
+    def test_flow_records(self):
+        print("\n----------------------------------------------------------------------")
+        n_flows, n_udp = 0, 0
+        for flow in NFStreamer(source='tests/pcap/instagram.pcap', udps=EndpointsLabel(), splt_analysis=5,
+                               statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+            self.assertEqual(flow.udps.endpoints, (flow.src_ip, flow.dst_ip))
+            self.assertEqual(len(flow.splt_ps), 5)
+            self.assertIsInstance(flow.bidirectional_mean_ps, float)
+            if flow.protocol == 17:
+                self.assertIsInstance(flow.src_port, str)
+                n_udp += 1
+            n_flows += 1
+        self.assertEqual(n_flows, len(list(NFStreamer(source='tests/pcap/instagram.pcap'))))
+        self.assertGreater(n_udp, 0)
+        print("{}\t: \033[94mOK\033[0m".format(".Test flow records".ljust(60, ' ')))
+
+    def test_plugin_hooks(self):
+        print("\n----------------------------------------------------------------------")
+        hooks = NFHooks([EndpointsCheck(), FourPacketExpire(), PacketsLabel(), NFPlugin(on_expire=lambda flow: None)])
+        self.assertEqual([type(udp) for udp in hooks.on_init], [EndpointsCheck])
+        self.assertEqual([type(udp) for udp in hooks.on_update], [EndpointsCheck, FourPacketExpire])
+        self.assertEqual([type(udp) for udp in hooks.on_expire], [PacketsLabel, NFPlugin])
+        # Expiration only plugin: flows are unchanged, with and without native engine.
+        to_compare = ["src_ip", "src_port", "dst_ip", "dst_port", "protocol", "bidirectional_packets",
+                      "bidirectional_bytes", "bidirectional_mean_ps", "splt_ps"]
+        df = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True, splt_analysis=5,
+                        n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+        df = df[to_compare].astype(str).sort_values(to_compare).reset_index(drop=True)
+        for native_engine in [False, True]:
+            labeled = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True, splt_analysis=5,
+                                 udps=PacketsLabel(), native_engine=native_engine,
+                                 n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+            self.assertTrue((labeled["udps.packets"] == labeled["bidirectional_packets"]).all())
+            labeled = labeled[to_compare].astype(str).sort_values(to_compare).reset_index(drop=True)
+            self.assertTrue(labeled.equals(df))
+        print("{}\t: \033[94mOK\033[0m".format(".Test plugin hooks".ljust(60, ' ')))
+
+    def test_packet_view(self):
+        print("\n----------------------------------------------------------------------")
+        for packet_copy, packet_type in [(False, 'memoryview'), (True, 'bytes')]:
+            n_flows = 0
+            for flow in NFStreamer(source='tests/pcap/instagram.pcap', udps=[PacketContent(packet_copy=packet_copy),
+                                                                              EndpointsCheck()],
+                                   n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+                self.assertEqual(flow.udps.packet_type, packet_type)
+                self.assertEqual(flow.udps.version_mismatches, 0)
+                self.assertEqual(flow.udps.mismatches, 0)
+                n_flows += 1
+            self.assertGreater(n_flows, 0)
+        print("{}\t: \033[94mOK\033[0m".format(".Test packet view".ljust(60, ' ')))
+
+    def test_batch_plugin(self):
+        print("\n----------------------------------------------------------------------")
+        for batch_size in [7, 4096]:
+            n_flows = 0
+            for flow in NFStreamer(source='tests/pcap/instagram.pcap', statistical_analysis=True,
+                                   udps=[BatchCounters(batch_size=batch_size), EndpointsCheck()],
+                                   n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+                self.assertEqual(flow.udps.batch_bytes, flow.bidirectional_bytes)
+                self.assertEqual(flow.udps.batch_syn_packets, flow.bidirectional_syn_packets)
+                self.assertEqual(flow.udps.mismatches, 0)
+                n_flows += 1
+            self.assertEqual(n_flows, len(list(NFStreamer(source='tests/pcap/instagram.pcap'))))
+        print("{}\t: \033[94mOK\033[0m".format(".Test batch plugin".ljust(60, ' ')))
+
+    def test_native_plugin(self):
+        print("\n----------------------------------------------------------------------")
+        subprocess.check_call(['gcc', '-shared', '-fPIC', '-O2', '-Infstream', 'examples/native_plugin.c', '-o',
+                               'tests/native_plugin.so', '-lm'])
+        to_compare = ["src_ip", "src_port", "dst_ip", "dst_port", "protocol", "bidirectional_first_seen_ms",
+                      "udps.payload_bytes", "udps.payload_entropy", "udps.max_burst_packets"]
+        results = []
+        for native_engine in [False, True]:
+            df = NFStreamer(source='tests/pcap/instagram.pcap', accounting_mode=3, native_engine=native_engine,
+                            udps=[NFNativePlugin('tests/native_plugin.so'), PayloadEntropy()] if not native_engine
+                            else NFNativePlugin('tests/native_plugin.so'),
+                            n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()
+            self.assertTrue((df["udps.payload_bytes"] == df["bidirectional_bytes"]).all())
+            self.assertGreater(df["udps.max_burst_packets"].min(), 0)
+            if not native_engine:  # Native and Python implementations match.
+                self.assertTrue(((df["udps.payload_entropy"] - df["udps.entropy"]).abs() < 1e-9).all())
+            results.append(df[to_compare].sort_values(to_compare[:6]).reset_index(drop=True))
+        self.assertTrue(results[0].equals(results[1]))
+        for path in ['tests/inexisting.so', 'tests/pcap/google_ssl.pcap']:
+            with self.assertRaises(ValueError):
+                NFNativePlugin(path)
+        os.remove('tests/native_plugin.so')
+        print("{}\t: \033[94mOK\033[0m".format(".Test native plugin".ljust(60, ' ')))
+
+    def test_flow_fields(self):
+        print("\n----------------------------------------------------------------------")
+        n_updated = 0
+        flows = []
+        for flow in NFStreamer(source='tests/pcap/instagram.pcap', statistical_analysis=True, splt_analysis=5,
+                               udps=FieldsReader(), n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+            if flow.udps.updates:
+                self.assertEqual(flow.udps.packets, flow.bidirectional_packets)
+                self.assertEqual(flow.udps.last_seen, flow.bidirectional_last_seen_ms)
+                self.assertEqual(flow.udps.stddev_ps, flow.bidirectional_stddev_ps)
+                self.assertEqual(flow.udps.splt_ps, flow.splt_ps)
+                self.assertLess(flow.udps.bytes, flow.bidirectional_bytes)
+                n_updated += 1
+            flows.append(flow)
+        self.assertGreater(n_updated, 0)
+        # All flow attributes are synced at expiration.
+        to_compare = [key for key in flows[0].keys() if not key.startswith('udps.') and key != 'id']
+        synced = pd.DataFrame([[str(getattr(flow, key)) for key in to_compare] for flow in flows], columns=to_compare)
+        df = NFStreamer(source='tests/pcap/instagram.pcap', statistical_analysis=True, splt_analysis=5,
+                        n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_pandas()[to_compare].astype(str)
+        synced = synced.sort_values(to_compare).reset_index(drop=True)
+        df = df.sort_values(to_compare).reset_index(drop=True)
+        self.assertTrue(synced.equals(df))
+        print("{}\t: \033[94mOK\033[0m".format(".Test flow fields declaration".ljust(60, ' ')))
+
+    def test_shards(self):
+        print("\n----------------------------------------------------------------------")
+        df = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True).to_pandas()
+        for sink_format, compression in [('csv', None), ('csv', 'gzip'), ('parquet', 'snappy'), ('binary', None)]:
+            os.makedirs('tests/pcap/steam.pcap.shards', exist_ok=True)
+            with open('tests/pcap/steam.pcap.shards/meter-99.csv', 'w') as f:  # Previous run shard is removed.
+                f.write("id\n0\n")
+            total_flows = NFStreamer(source='tests/pcap/steam.pcap', statistical_analysis=True,
+                                     n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_shards(sink_format=sink_format,
+                                                                                           compression=compression)
+            self.assertFalse(os.path.exists('tests/pcap/steam.pcap.shards/meter-99.csv'))
+            with open('tests/pcap/steam.pcap.shards/manifest.json') as f:
+                manifest = json.load(f)
+            shards = []
+            for shard in manifest["shards"]:
+                shard_path = os.path.join('tests/pcap/steam.pcap.shards', shard["path"])
+                if sink_format == 'csv':
+                    shards.append(pd.read_csv(shard_path, compression='infer'))
+                elif sink_format == 'parquet':
+                    shards.append(pd.read_parquet(shard_path))
+                else:
+                    layout = NFRecord(manifest["layout"]["n_dissections"], manifest["layout"]["statistical_analysis"],
+                                      manifest["layout"]["splt_analysis"], manifest["layout"]["udps"])
+                    with open(shard_path, 'rb') as f:
+                        flows = list(layout.unpack_all(f.read()))
+                    shards.append(pd.DataFrame([flow.values() for flow in flows], columns=flows[0].keys()))
+                self.assertEqual(shards[-1].shape[0], shard["n_flows"])
+                self.assertEqual(shard_path.endswith('.gz'), compression == 'gzip')
+                os.remove(shard_path)
+            os.remove('tests/pcap/steam.pcap.shards/manifest.json')
+            os.rmdir('tests/pcap/steam.pcap.shards')
+            df_shards = pd.concat(shards)
+            self.assertEqual(manifest["format"], sink_format)
+            self.assertEqual(total_flows, df.shape[0])
+            self.assertEqual(manifest["n_flows"], df.shape[0])
+            self.assertEqual(sorted(df_shards["bidirectional_bytes"].tolist()),
+                             sorted(df["bidirectional_bytes"].tolist()))
+            self.assertEqual(df_shards["src2dst_max_ps"].sum(), df["src2dst_max_ps"].sum())
+        print("{}\t: \033[94mOK\033[0m".format(".Test per meter sinks".ljust(60, ' ')))
+
+    def test_ipfix(self):
+        print("\n----------------------------------------------------------------------")
+        collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        collector.bind(('127.0.0.1', 0))
+        collector.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        collector.settimeout(0.5)
+        total_flows = NFStreamer(source='tests/pcap/steam.pcap', udps=EndpointsCheck(), splt_analysis=5,
+                                 n_meters=int(os.getenv('MAX_NFMETERS', 0))).to_ipfix(collector.getsockname(),
+                                                                                     mtu=1000)
+        datagrams = []
+        try:
+            while True:
+                datagrams.append(collector.recv(65535))
+        except socket.timeout:
+            pass
+        collector.close()
+        self.assertEqual(total_flows, len(list(NFStreamer(source='tests/pcap/steam.pcap'))))
+        self.assertTrue(all([struct.unpack_from('>HH', datagram) == (10, len(datagram)) for datagram in datagrams]))
+        self.assertTrue(all([len(datagram) <= 1000 for datagram in datagrams]))
+        self.assertEqual(count_ipfix_records(datagrams), total_flows)
+        # Long texts are truncated to fit MTU and lingering records are sent without further exports.
+        collector = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        collector.bind(('127.0.0.1', 0))
+        collector.settimeout(2)
+        flow = next(iter(NFStreamer(source='tests/pcap/steam.pcap', udps=EndpointsCheck())))
+        flow.udps.long_text = 'é' * 5000
+        exporter = NFExporter(collector.getsockname(), flow.keys(), 0, mtu=600, linger=0.2)
+        self.assertTrue(exporter.export(flow))
+        datagrams = []
+        while count_ipfix_records(datagrams) == 0:  # Record is sent by linger timer.
+            datagrams.append(collector.recv(65535))
+        exporter.close()
+        collector.close()
+        self.assertTrue(all([len(datagram) <= 600 for datagram in datagrams]))
+        self.assertEqual(count_ipfix_records(datagrams), 1)
+        splt_flow = next(iter(NFStreamer(source='tests/pcap/steam.pcap', splt_analysis=50)))
+        with self.assertRaises(ValueError):
+            NFExporter(('127.0.0.1', 4739), splt_flow.keys(), 50, version=9, mtu=512)
+        print("{}\t: \033[94mOK\033[0m".format(".Test IPFIX export".ljust(60, ' ')))
+
     def test_ndpi_integration(self):
         files = get_files_list("tests/pcap/")
         ground_truth_ndpi = build_ndpi_dict("tests/result/")